@@ -0,0 +1,230 @@
+"""
+Cold storage for inactive chats.
+
+Chats whose chats.updated_at is older than CHAT_ARCHIVE_AFTER_DAYS have their
+messages moved out of the hot `messages` table into one zlib-compressed row
+in `chat_archive` (JSON of [seq, sender, text, created_at] rows). The chats
+row stays as the index entry (paid, category, updated_at), and the archive
+row keeps the seq range, counts and the last message for previews.
+
+Reads decompress transparently (load / page); the first append to an
+archived chat restores its messages in the same transaction, so the log
+keeps its seq numbering and the hot path never writes to the archive.
+
+run() archives in batches and then compacts the file, releasing free pages
+with PRAGMA incremental_vacuum in short steps so handlers keep running in
+between. That needs auto_vacuum=INCREMENTAL: new databases are created with
+it (db.PRAGMAS); an older file only gets it from one full VACUUM, which holds
+the write lock for as long as it rewrites the file. enable_compaction() runs
+that conversion at startup, before the server takes traffic, for files up to
+CHAT_ARCHIVE_VACUUM_ON_START_MB. Larger files keep running without
+compaction until the deploy step is run once with the server stopped:
+
+    python archive.py --vacuum
+
+CHAT_ARCHIVE_VACUUM=off skips compaction (and the conversion).
+"""
+import json
+import os
+import time
+import zlib
+
+import eventlet
+
+import db
+import search
+
+CHAT_ARCHIVE_AFTER_DAYS = float(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "30"))
+CHAT_ARCHIVE_BATCH = int(os.getenv("CHAT_ARCHIVE_BATCH", "100"))
+CHAT_ARCHIVE_MAX_BATCHES = int(os.getenv("CHAT_ARCHIVE_MAX_BATCHES", "50"))   # per run
+CHAT_ARCHIVE_INTERVAL_SECONDS = float(os.getenv("CHAT_ARCHIVE_INTERVAL_SECONDS", "3600"))
+CHAT_ARCHIVE_VACUUM = os.getenv("CHAT_ARCHIVE_VACUUM", "incremental").lower()
+CHAT_ARCHIVE_VACUUM_PAGES = int(os.getenv("CHAT_ARCHIVE_VACUUM_PAGES", "5000"))   # per run
+CHAT_ARCHIVE_VACUUM_STEP_PAGES = 256   # per write transaction
+CHAT_ARCHIVE_VACUUM_ON_START_MB = float(os.getenv("CHAT_ARCHIVE_VACUUM_ON_START_MB", "256"))
+ZLIB_LEVEL = 6
+
+_AUTO_VACUUM_INCREMENTAL = 2
+
+counts = {'runs': 0, 'chats': 0, 'messages': 0, 'raw_bytes': 0, 'packed_bytes': 0, 'restored': 0,
+          'vacuumed_pages': 0, 'vacuum_skipped': 0}
+
+
+def pack(rows):
+    """rows: (seq, sender, text, created_at) tuples -> compressed blob."""
+    return zlib.compress(json.dumps([list(r) for r in rows], ensure_ascii=False, separators=(',', ':')).encode(),
+                         ZLIB_LEVEL)
+
+
+def unpack(blob):
+    return json.loads(zlib.decompress(blob))
+
+
+def archived_range(conn, user_id):
+    """(first_seq, last_seq) of the archived messages, or None."""
+    return conn.execute("SELECT first_seq, last_seq FROM chat_archive WHERE user_id=?", (user_id,)).fetchone()
+
+
+def load(conn, user_id):
+    """All archived rows [seq, sender, text, created_at], or None if the chat isn't archived."""
+    row = conn.execute("SELECT data FROM chat_archive WHERE user_id=?", (user_id,)).fetchone()
+    return unpack(row[0]) if row else None
+
+
+def restore(conn, user_id):
+    """Move an archived chat back into `messages`; call inside the writing transaction."""
+    rows = load(conn, user_id)
+    if rows is None:
+        return False
+    conn.executemany("INSERT INTO messages (user_id, seq, sender, text, created_at) VALUES (?, ?, ?, ?, ?)",
+                     [(user_id, *r) for r in rows])
+    conn.execute("DELETE FROM chat_archive WHERE user_id=?", (user_id,))
+    counts['restored'] += 1
+    return True
+
+
+def _archive_batch(conn, after_days, limit):
+    conn.execute("BEGIN IMMEDIATE")
+    users = [r[0] for r in conn.execute(
+        "SELECT user_id FROM chats WHERE updated_at < datetime('now', ?) "
+        "AND EXISTS (SELECT 1 FROM messages m WHERE m.user_id = chats.user_id) LIMIT ?",
+        (f"-{after_days} days", limit)).fetchall()]
+    moved = raw = packed = 0
+    for user_id in users:
+        rows = conn.execute("SELECT seq, sender, text, created_at FROM messages WHERE user_id=? ORDER BY seq",
+                            (user_id,)).fetchall()
+        blob = pack(rows)
+        size = sum(len(r[2] or '') for r in rows)
+        conn.execute("INSERT INTO chat_archive (user_id, first_seq, last_seq, message_count, raw_bytes, last_text, "
+                     "data, archived_at) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                     (user_id, rows[0][0], rows[-1][0], len(rows), size, rows[-1][2], blob))
+        conn.execute("DELETE FROM messages WHERE user_id=?", (user_id,))
+        moved += len(rows)
+        raw += size
+        packed += len(blob)
+    return len(users), moved, raw, packed
+
+
+def archive_idle(after_days=CHAT_ARCHIVE_AFTER_DAYS, batch=CHAT_ARCHIVE_BATCH, max_batches=CHAT_ARCHIVE_MAX_BATCHES):
+    """Archive up to max_batches * batch idle chats; returns how many were archived."""
+    total = 0
+    for _ in range(max_batches):
+        chats, moved, raw, packed = db.run(_archive_batch, after_days, batch, op='archive_batch')
+        counts['chats'] += chats
+        counts['messages'] += moved
+        counts['raw_bytes'] += raw
+        counts['packed_bytes'] += packed
+        total += chats
+        if chats < batch:
+            break
+        eventlet.sleep(0)   # let handlers in between batches
+    return total
+
+
+def _incremental(conn):
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == _AUTO_VACUUM_INCREMENTAL
+
+
+def _vacuum_step(conn, pages):
+    if not _incremental(conn):
+        return None
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if free:
+        # executescript steps the pragma to completion; execute() frees a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({int(min(pages, free))});")
+    return free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def compact(pages=CHAT_ARCHIVE_VACUUM_PAGES):
+    """Release up to `pages` free pages, a short write transaction per step; returns pages freed or None."""
+    if CHAT_ARCHIVE_VACUUM == 'off':
+        return None
+    freed = 0
+    while freed < pages:
+        step = db.run(_vacuum_step, min(CHAT_ARCHIVE_VACUUM_STEP_PAGES, pages - freed), op='archive_vacuum')
+        if step is None:
+            counts['vacuum_skipped'] += 1
+            print("[ARCHIVE] auto_vacuum is not INCREMENTAL; run `python archive.py --vacuum` with the server "
+                  "stopped to enable compaction")
+            return None
+        if not step:
+            break
+        freed += step
+        eventlet.sleep(0)   # let handlers in between steps
+    if freed:
+        # In WAL mode the file only shrinks once the rewritten pages are checkpointed
+        db.run(lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall(), op='archive_checkpoint')
+    counts['vacuumed_pages'] += freed
+    return freed
+
+
+def vacuum(conn):
+    """
+    Offline: switch to auto_vacuum=INCREMENTAL and rewrite the file with one
+    VACUUM. Blocks every writer for the whole rewrite; stop the server first.
+    """
+    if not _incremental(conn):
+        conn.execute(f"PRAGMA auto_vacuum={_AUTO_VACUUM_INCREMENTAL}")
+    conn.execute("VACUUM")
+    if search.has_index(conn):
+        # VACUUM may renumber messages' rowids, which the external-content FTS index points at
+        search.rebuild(conn)
+        conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+
+def enable_compaction(max_mb=CHAT_ARCHIVE_VACUUM_ON_START_MB):
+    """
+    Startup: convert a database created before auto_vacuum=INCREMENTAL with one
+    VACUUM if the file is at most max_mb; True if compaction is enabled.
+    """
+    if CHAT_ARCHIVE_VACUUM == 'off' or db.run(_incremental, op='archive_vacuum_mode'):
+        return CHAT_ARCHIVE_VACUUM != 'off'
+    size_mb = os.path.getsize(db.DB_FILE) / 2 ** 20
+    if size_mb > max_mb:
+        print(f"[ARCHIVE] {size_mb:.0f} MB database without auto_vacuum=INCREMENTAL: run `python archive.py "
+              f"--vacuum` with the server stopped (deploy step) to enable compaction")
+        return False
+    start = time.monotonic()
+    db.run(vacuum, op='archive_full_vacuum')
+    print(f"[ARCHIVE] converted the {size_mb:.1f} MB database to auto_vacuum=INCREMENTAL "
+          f"in {time.monotonic() - start:.2f}s")
+    return True
+
+
+def run():
+    """One scheduled pass: archive idle chats, then compact the file."""
+    counts['runs'] += 1
+    start = time.monotonic()
+    archived = archive_idle()
+    result = compact()
+    print(f"[ARCHIVE] archived {archived} chats, freed {result} pages in {time.monotonic() - start:.2f}s")
+    return archived
+
+
+def stats():
+    def _load(conn):
+        return conn.execute("SELECT COUNT(*), COALESCE(SUM(message_count), 0), COALESCE(SUM(raw_bytes), 0), "
+                            "COALESCE(SUM(LENGTH(data)), 0) FROM chat_archive").fetchone()
+    chats, messages, raw, packed = db.run(_load, op='archive_stats')
+    return dict(counts, archived_chats=chats, archived_messages=messages, archived_raw_bytes=raw,
+                archived_packed_bytes=packed, after_days=CHAT_ARCHIVE_AFTER_DAYS)
+
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--vacuum', action='store_true', help="enable incremental compaction (full VACUUM; offline)")
+    args = p.parse_args()
+    if args.vacuum:
+        start = time.monotonic()
+        before = os.path.getsize(db.DB_FILE)
+        db.run(vacuum, op='archive_full_vacuum')
+        print(f"[ARCHIVE] VACUUM {before / 2 ** 20:.1f} MB -> {os.path.getsize(db.DB_FILE) / 2 ** 20:.1f} MB "
+              f"in {time.monotonic() - start:.2f}s; incremental compaction enabled")
+    else:
+        p.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Expert authentication helpers.
+
+- Salted scrypt password hashes ("scrypt$n$r$p$salt$hash"), cost tunable
+  with EXPERT_PASSWORD_SCRYPT_N. The KDF runs in eventlet's tpool so a login
+  never stalls the hub; hashes made with an older cost are flagged for rehash.
+- Signed, expiring session tokens (itsdangerous, which Flask already uses):
+  a reconnecting expert presents the token instead of the password.
+- A sliding-window limiter on failed attempts, per expert id and per client
+  address (server.py trusts TRUSTED_PROXY_HOPS of X-Forwarded-For for it).
+  It is per process, like the rest of the in-memory state.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from collections import OrderedDict, deque
+
+from eventlet import tpool
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+SCRYPT_N = int(os.getenv("EXPERT_PASSWORD_SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = 8
+SCRYPT_P = 1
+TOKEN_MAX_AGE = int(os.getenv("EXPERT_TOKEN_MAX_AGE", str(12 * 3600)))
+LOGIN_MAX_FAILURES = int(os.getenv("LOGIN_MAX_FAILURES", "5"))
+LOGIN_FAILURE_WINDOW = float(os.getenv("LOGIN_FAILURE_WINDOW_SECONDS", "300"))
+
+_SCHEME = "scrypt"
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _kdf(password, salt, n, r, p):
+    """Blocking; call through tpool."""
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * r * n * p + 1024 * 1024, dklen=32)
+
+
+def _hash_blocking(password):
+    salt = secrets.token_bytes(16)
+    digest = _kdf(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"{_SCHEME}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+
+
+def hash_password(password):
+    return tpool.execute(_hash_blocking, password)
+
+
+def is_hashed(stored):
+    return bool(stored) and stored.startswith(_SCHEME + "$")
+
+
+# Verified against when the expert doesn't exist, so response time doesn't reveal valid ids
+_DUMMY_HASH = None
+
+
+def verify_password(password, stored):
+    global _DUMMY_HASH
+    if not password:
+        return False
+    if not is_hashed(stored):
+        if _DUMMY_HASH is None:
+            _DUMMY_HASH = hash_password(secrets.token_hex(8))
+        stored, known = _DUMMY_HASH, False
+    else:
+        known = True
+    _, n, r, p, salt, digest = stored.split("$")
+    candidate = tpool.execute(_kdf, password, _unb64(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(candidate, _unb64(digest)) and known
+
+
+def needs_rehash(stored):
+    return not is_hashed(stored) or stored.split("$")[1:4] != [str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P)]
+
+
+def fingerprint(stored):
+    """Short digest of the stored hash: a password change invalidates issued tokens."""
+    return hashlib.sha256((stored or "").encode()).hexdigest()[:16]
+
+
+class TokenSigner:
+    def __init__(self, secret, max_age=TOKEN_MAX_AGE):
+        self._s = URLSafeTimedSerializer(secret, salt="expert-session")
+        self.max_age = max_age
+
+    def issue(self, expert_id, stored_hash):
+        return self._s.dumps({'id': expert_id, 'pv': fingerprint(stored_hash)})
+
+    def verify(self, token):
+        """Claims dict, or None if the token is forged, malformed or expired."""
+        try:
+            claims = self._s.loads(token, max_age=self.max_age)
+        except BadSignature:
+            return None
+        return claims if isinstance(claims, dict) and 'id' in claims and 'pv' in claims else None
+
+
+class FailureLimiter:
+    """At most max_failures failed attempts per key within `window` seconds."""
+
+    def __init__(self, max_failures=LOGIN_MAX_FAILURES, window=LOGIN_FAILURE_WINDOW, max_keys=10000):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_keys = max_keys
+        self._failures = OrderedDict()   # key -> deque of failure times
+
+    def _recent(self, key, now):
+        times = self._failures.get(key)
+        if times is None:
+            return None
+        while times and times[0] <= now - self.window:
+            times.popleft()
+        if not times:
+            del self._failures[key]
+            return None
+        return times
+
+    def retry_after(self, *keys):
+        """Seconds until the most restrictive key may try again; 0 if none are blocked."""
+        now = time.monotonic()
+        wait = 0.0
+        for key in keys:
+            times = self._recent(key, now)
+            if times and len(times) >= self.max_failures:
+                wait = max(wait, times[0] + self.window - now)
+        return wait
+
+    def failed(self, *keys):
+        now = time.monotonic()
+        for key in keys:
+            times = self._recent(key, now) or deque()
+            times.append(now)
+            self._failures[key] = times
+            self._failures.move_to_end(key)
+        while len(self._failures) > self.max_keys:
+            self._failures.popitem(last=False)
+
+    def reset(self, *keys):
+        for key in keys:
+            self._failures.pop(key, None)
+
+    def stats(self):
+        return {'tracked_keys': len(self._failures), 'max_failures': self.max_failures, 'window': self.window}
@@ -0,0 +1,457 @@
+"""
+End-to-end load test of one server worker over real Socket.IO.
+
+Starts server.py in a child process with a stub Gemini model (fixed latency
+plus a token rate), a throwaway SQLite file, a fake Crisp HTTP API, a fake
+Stripe checkout and an in-memory Firestore. Then drives --users simulated
+customers through
+
+    connect -> register -> N intake messages -> crisp_sync -> checkout
+    -> mark_paid -> M expert-mode messages -> (an expert replies) -> disconnect
+
+while --experts experts log in and stay online. Reports p50/p95/p99 latency
+per step, throughput, server memory and the server's own /metrics histograms,
+and writes everything to JSON so runs can be compared between commits:
+
+    python bench/chat_load.py --users 1000 --concurrency 200
+    python bench/chat_load.py --compare bench/results/<old>.json bench/results/<new>.json
+
+Needs only the server's own requirements (python-socketio's client polls over
+requests; no websocket client library required).
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from eventlet import patcher
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+blocking_sleep = patcher.original('time').sleep
+
+ADMIN_PASSWORD = "bench-admin"
+EXPERT_PASSWORD = "bench-expert"
+REPLY = ("Thanks for the details. Let's narrow this down: check whether the problem happens every time, "
+         "note any error message exactly as shown, and tell me what changed right before it started.")
+
+
+# ---------------------------------------------------------------------------
+# Child process: the server with stubbed dependencies
+# ---------------------------------------------------------------------------
+def _stub_model(latency, token_rate):
+    import google.generativeai as genai
+    from google.generativeai import protos
+    from google.generativeai.types import generation_types
+
+    def chunk(text):
+        return protos.GenerateContentResponse(candidates=[protos.Candidate(
+            content=protos.Content(role='model', parts=[protos.Part(text=text)]), finish_reason=1)])
+
+    class StubModel(genai.GenerativeModel):
+        """Runs in llm's tpool threads, so it blocks like the real gRPC client does."""
+
+        def __init__(self):
+            super().__init__('bench-stub')
+
+        def generate_content(self, contents, stream=False, **kwargs):
+            text = "tech" if isinstance(contents, str) else REPLY
+            words = text.split(' ')
+            if not stream:
+                blocking_sleep(latency + len(words) / token_rate)
+                return generation_types.GenerateContentResponse.from_response(chunk(text))
+
+            def pieces():
+                blocking_sleep(latency)
+                for i in range(0, len(words), 8):
+                    part = words[i:i + 8]
+                    blocking_sleep(len(part) / token_rate)
+                    yield chunk(' '.join(part) + (' ' if i + 8 < len(words) else ''))
+            return generation_types.GenerateContentResponse.from_iterator(pieces())
+
+    return StubModel()
+
+
+def _fake_crisp_app(latency):
+    def app(environ, start_response):
+        eventlet.sleep(latency)
+        path = environ.get('PATH_INFO', '')
+        if '/visitors/token/' in path:
+            body = {'data': {'session_id': 'session_' + path.rsplit('/', 1)[-1]}}
+        else:
+            body = {'error': False}
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps(body).encode()]
+    return app
+
+
+def serve(args):
+    from eventlet import wsgi
+
+    crisp_listener = eventlet.listen(('127.0.0.1', args.crisp_port))
+    eventlet.spawn_n(wsgi.server, crisp_listener, _fake_crisp_app(args.outbound_latency), log_output=False)
+
+    import server
+    import firebase_sync
+    from firebase_batch import FakeFirestore
+
+    server.model = _stub_model(args.llm_latency, args.token_rate)
+    server.expert_model = _stub_model(args.llm_latency, args.token_rate)
+    server.summary_model = _stub_model(args.llm_latency, args.token_rate)
+    server.firebase_batcher = firebase_sync.FirestoreBatcher(FakeFirestore(args.outbound_latency))
+
+    class _Checkout:
+        def __init__(self, user_id, expires_at):
+            self.id = f"cs_bench_{user_id}"
+            self.url = f"https://checkout.example/bench/{user_id}"
+            self.expires_at = expires_at
+
+    def fake_checkout(**kwargs):
+        eventlet.sleep(args.outbound_latency)
+        return _Checkout(kwargs.get('client_reference_id'), kwargs.get('expires_at'))
+    server.stripe.checkout.Session.create = fake_checkout
+
+    print("[BENCH] server ready", flush=True)
+    server.socketio.run(server.app, host='127.0.0.1', port=args.port, log_output=False)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, workdir):
+    port, crisp_port = _free_port(), _free_port()
+    env = dict(os.environ,
+               DB_FILE=os.path.join(workdir, 'bench.db'),
+               ADMIN_PASSWORD=ADMIN_PASSWORD,
+               CRISP_API_IDENTIFIER='bench', CRISP_API_KEY='bench', CRISP_WEBSITE_ID='bench',
+               CRISP_API_BASE=f'http://127.0.0.1:{crisp_port}/v1',
+               STRIPE_SECRET_KEY='sk_test_bench', PUBLIC_SITE_URL='http://127.0.0.1',
+               REPLY_PACING='on' if args.pacing else 'off',
+               GEMINI_MODEL='bench-stub', MODEL_CACHE_FILE=os.path.join(workdir, 'model.json'),
+               PYTHONUNBUFFERED='1')
+    for key in ('GOOGLE_API_KEY', 'FIREBASE_CREDENTIALS', 'REDIS_URL'):
+        env.pop(key, None)
+    cmd = [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(port), '--crisp-port', str(crisp_port),
+           '--llm-latency', str(args.llm_latency), '--token-rate', str(args.token_rate),
+           '--outbound-latency', str(args.outbound_latency)]
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    import requests
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited, see {log.name}")
+        try:
+            requests.get(url + '/', timeout=1)
+            return proc, url
+        except requests.ConnectionError:
+            eventlet.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+# ---------------------------------------------------------------------------
+# Driver
+# ---------------------------------------------------------------------------
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+
+    def add(self, step, seconds):
+        self.samples.setdefault(step, []).append(seconds)
+
+    def error(self, step, exc):
+        self.errors.setdefault(step, {})
+        name = exc.__class__.__name__
+        self.errors[step][name] = self.errors[step].get(name, 0) + 1
+
+    def summary(self):
+        out = {}
+        for step, values in sorted(self.samples.items()):
+            values = sorted(values)
+            out[step] = {
+                'count': len(values),
+                'p50_ms': round(_pct(values, 50) * 1000, 2),
+                'p95_ms': round(_pct(values, 95) * 1000, 2),
+                'p99_ms': round(_pct(values, 99) * 1000, 2),
+                'max_ms': round(values[-1] * 1000, 2),
+                'errors': sum(self.errors.get(step, {}).values()),
+            }
+        for step, errs in self.errors.items():
+            out.setdefault(step, {'count': 0, 'errors': sum(errs.values())})
+        return out
+
+
+def _pct(values, p):
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def _client():
+    import socketio
+    return socketio.Client(reconnection=False, request_timeout=30)
+
+
+def _timed(rec, step, fn):
+    start = time.monotonic()
+    try:
+        result = fn()
+    except Exception as e:
+        rec.error(step, e)
+        raise
+    rec.add(step, time.monotonic() - start)
+    return result
+
+
+def _reply_waiter(sio):
+    """Queue of final bot replies (bot_message or bot_message_done) for this client."""
+    q = eventlet.Queue()
+    sio.on('bot_message', lambda data: q.put(data))
+    sio.on('bot_message_done', lambda data: q.put(data))
+    return q
+
+
+def run_user(url, n, args, rec, experts):
+    import requests
+    sio = _client()
+    replies = _reply_waiter(sio)
+    crisp_result = eventlet.Queue()
+    sio.on('crisp_sync_result', lambda data: crisp_result.put(data))
+    user_id = f"bench-{args.run_id}-{n}"
+    try:
+        _timed(rec, 'connect', lambda: sio.connect(url, transports=['polling'], wait_timeout=30))
+        _timed(rec, 'register', lambda: sio.call('register', {'user_id': user_id}, timeout=30))
+
+        def exchange(step, text):
+            sio.emit('user_message', {'user_id': user_id, 'message': text, 'stream': args.stream})
+            _timed(rec, step, lambda: replies.get(timeout=60))
+
+        for i in range(args.intake_messages):
+            exchange('user_message.intake', f"my laptop wifi keeps dropping, attempt {i}")
+
+        sio.emit('crisp_sync', {'user_id': user_id, 'token_id': user_id})
+        _timed(rec, 'crisp_sync', lambda: crisp_result.get(timeout=30))
+        _timed(rec, 'http.create_checkout_session',
+               lambda: requests.post(url + '/create-checkout-session', json={'userId': user_id}, timeout=30)
+               .raise_for_status())
+        _timed(rec, 'mark_paid', lambda: sio.call('mark_paid', {'user_id': user_id}, timeout=30))
+
+        for i in range(args.expert_messages):
+            exchange('user_message.expert', f"still broken after step {i}")
+
+        if experts:
+            expert = random.choice(experts)
+            expert.emit('agent_message', {'to_user': user_id, 'message': 'An expert here, looking at it now.'})
+            _timed(rec, 'agent_message', lambda: replies.get(timeout=30))
+    except Exception:
+        pass
+    finally:
+        try:
+            sio.disconnect()
+        except Exception:
+            pass
+
+
+def login_experts(url, count, rec):
+    setup = _client()
+    setup.connect(url, transports=['polling'])
+    setup.call('admin_login', {'password': ADMIN_PASSWORD})
+    for i in range(count):
+        # expert passwords are unique
+        setup.call('create_expert', {'name': f'Bench Expert {i}', 'categories': ['tech'],
+                                     'password': f'{EXPERT_PASSWORD}-{i}'})
+    listed = eventlet.Queue()
+    setup.on('experts_list', lambda data: listed.put(data))
+    setup.emit('get_experts')
+    # get_experts never returns passwords; map each listed expert back to the one it was created with
+    logins = [(e['id'], f"{EXPERT_PASSWORD}-{e['name'].rsplit(' ', 1)[1]}")
+              for e in listed.get(timeout=30) if e['name'].startswith('Bench Expert')]
+    setup.disconnect()
+
+    experts = []
+    for expert_id, password in logins:
+        sio = _client()
+        done = eventlet.Queue()
+        sio.on('login_success', lambda data, q=done: q.put(data))
+        sio.on('new_paid_user', lambda data: None)
+        sio.on('user_status_change', lambda data: None)
+        sio.connect(url, transports=['polling'])
+        sio.emit('expert_login', {'expert_id': expert_id, 'password': password})
+        _timed(rec, 'expert_login', lambda: done.get(timeout=30))
+        experts.append(sio)
+    return experts
+
+
+def _rss_kb(pid):
+    out = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    out[line.split(':')[0]] = int(line.split()[1])
+    except OSError:
+        pass
+    return out
+
+
+def _server_histograms(text):
+    """Percentile-free summary of the server's own histograms: count and mean per label set."""
+    sums, counts = {}, {}
+    for line in text.splitlines():
+        if line.startswith('#') or ' ' not in line:
+            continue
+        name, value = line.rsplit(' ', 1)
+        if name.split('{')[0].endswith('_sum'):
+            sums[name.replace('_sum', '', 1)] = float(value)
+        elif name.split('{')[0].endswith('_count'):
+            counts[name.replace('_count', '', 1)] = float(value)
+    return {k: {'count': int(counts[k]), 'mean_ms': round(sums.get(k, 0) / counts[k] * 1000, 2)}
+            for k in sorted(counts) if counts[k]}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def drive(args):
+    import requests
+    args.run_id = int(time.time())
+    workdir = tempfile.mkdtemp(prefix='chat_load_')
+    proc, url = start_server(args, workdir)
+    rec = Recorder()
+    memory = {'start_kb': _rss_kb(proc.pid).get('VmRSS')}
+    peak = {'rss_kb': 0}
+    sampling = {'on': True}
+
+    def sample_memory():
+        while sampling['on']:
+            peak['rss_kb'] = max(peak['rss_kb'], _rss_kb(proc.pid).get('VmRSS', 0))
+            eventlet.sleep(0.5)
+
+    try:
+        eventlet.spawn_n(sample_memory)
+        experts = login_experts(url, args.experts, rec)
+        pool = eventlet.GreenPool(args.concurrency)
+        start = time.monotonic()
+        for n in range(args.users):
+            pool.spawn_n(run_user, url, n, args, rec, experts)
+        pool.waitall()
+        elapsed = time.monotonic() - start
+        server_metrics = requests.get(url + '/metrics', timeout=30).text
+        for sio in experts:
+            sio.disconnect()
+    finally:
+        sampling['on'] = False
+        memory.update(end_kb=_rss_kb(proc.pid).get('VmRSS'), peak_kb=_rss_kb(proc.pid).get('VmHWM'),
+                      sampled_peak_kb=peak['rss_kb'])
+        proc.terminate()
+        proc.wait(timeout=10)
+
+    steps = rec.summary()
+    completed = steps.get('mark_paid', {}).get('count', 0)
+    messages = sum(steps.get(s, {}).get('count', 0) for s in ('user_message.intake', 'user_message.expert'))
+    result = {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {k: v for k, v in vars(args).items() if k not in ('serve', 'compare', 'out', 'run_id')},
+        'elapsed_seconds': round(elapsed, 2),
+        'throughput': {
+            'sessions_per_second': round(completed / elapsed, 2),
+            'messages_per_second': round(messages / elapsed, 2),
+            'sessions_completed': completed,
+        },
+        'steps': steps,
+        'memory': memory,
+        'server_metrics': _server_histograms(server_metrics),
+    }
+    out = args.out or os.path.join(ROOT, 'bench', 'results',
+                                   f"chat_load-{result['commit'] or 'nogit'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+
+    print(f"{args.users} users / {args.experts} experts, concurrency {args.concurrency}: {elapsed:.1f}s")
+    print(f"throughput: {result['throughput']}")
+    print(f"memory: {memory}")
+    print(f"{'step':32} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>6}")
+    for step, s in steps.items():
+        print(f"{step:32} {s['count']:6} {s.get('p50_ms', 0):9} {s.get('p95_ms', 0):9} {s.get('p99_ms', 0):9} "
+              f"{s['errors']:6}")
+    print(f"results: {out}  (server log: {workdir}/server.log)")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    for key in ('sessions_per_second', 'messages_per_second'):
+        a, b = old['throughput'][key], new['throughput'][key]
+        print(f"  {key:30} {a:9} -> {b:9}  ({_delta(a, b)})")
+    for step in sorted(set(old['steps']) | set(new['steps'])):
+        a, b = old['steps'].get(step, {}), new['steps'].get(step, {})
+        for p in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if p in a and p in b:
+                print(f"  {step + ' ' + p:30} {a[p]:9} -> {b[p]:9}  ({_delta(a[p], b[p])})")
+    a, b = old['memory'].get('peak_kb'), new['memory'].get('peak_kb')
+    if a and b:
+        print(f"  {'peak rss kb':30} {a:9} -> {b:9}  ({_delta(a, b)})")
+
+
+def _delta(a, b):
+    return f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--users', type=int, default=200)
+    p.add_argument('--experts', type=int, default=5)
+    p.add_argument('--concurrency', type=int, default=100, help="simulated customers active at once")
+    p.add_argument('--intake-messages', type=int, default=3)
+    p.add_argument('--expert-messages', type=int, default=2)
+    p.add_argument('--stream', action='store_true', help="ask for streamed replies")
+    p.add_argument('--pacing', action='store_true', help="keep human-like reply pacing (REPLY_PACING=on)")
+    p.add_argument('--llm-latency', type=float, default=0.3, help="stub Gemini time to first token, seconds")
+    p.add_argument('--token-rate', type=float, default=200.0, help="stub Gemini output words per second")
+    p.add_argument('--outbound-latency', type=float, default=0.05, help="fake Crisp/Stripe/Firestore latency")
+    p.add_argument('--out', help="results JSON path (default bench/results/chat_load-<commit>-<time>.json)")
+    p.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="diff two results files and exit")
+    p.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    p.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    p.add_argument('--crisp-port', type=int, help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.serve:
+        serve(args)
+    else:
+        drive(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+Checkout session reuse and paid-once confirmation against a local Stripe stub.
+
+The stub serves POST/GET /v1/checkout/sessions on a local port (sessions in
+memory, Idempotency-Key honoured and expires_at checked against the 30 min -
+24 h range like Stripe, --latency per create so double clicks overlap) and
+stripe.api_base points at it; pass --stripe-mock
+http://localhost:12111 to run against stripe-mock instead (it neither
+stores sessions nor replays idempotent requests, so only the in-process
+reuse counts hold there). Checks:
+
+    double click    --clicks concurrent POST /create-checkout-session per user
+                    -> one Stripe session per user, every click gets its URL
+    two workers     the cache row is missing on both sides and no shared lock
+                    -> the idempotency key still yields one session
+    webhook         --replays deliveries of the same signed event, other event
+                    ids for the same session and a burst of mark_paid from the
+                    client -> chats.paid flips once, one payment_confirmed job,
+                    one new_paid_user per room, one "Expert Joined"
+    rejected        bad signature -> 400, unpaid session -> chat stays unpaid
+
+Exits 1 if a check fails.
+
+    python bench/checkout_check.py [--users 20] [--clicks 10] [--replays 5]
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qsl
+
+from eventlet import wsgi
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WEBHOOK_SECRET = "whsec_bench"
+EXPIRES_MIN_SECONDS, EXPIRES_MAX_SECONDS = 30 * 60, 24 * 3600   # Stripe's accepted expires_at range
+
+failures = []
+
+
+def check(name, ok, detail=''):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}{': ' + str(detail) if detail else ''}")
+    if not ok:
+        failures.append(name)
+
+
+class StripeStub:
+    """Just enough of the Checkout Sessions API for payments.py."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.sessions = {}
+        self.replies = {}      # Idempotency-Key -> session id
+        self.creates = 0       # sessions actually created
+        self.rejected = 0      # creates refused for an out-of-range expires_at
+        self.ids = itertools.count(1)
+
+    def __call__(self, environ, start_response):
+        path, method = environ['PATH_INFO'], environ['REQUEST_METHOD']
+        if method == 'POST' and path == '/v1/checkout/sessions':
+            form = dict(parse_qsl(environ['wsgi.input'].read().decode()))
+            key = environ.get('HTTP_IDEMPOTENCY_KEY')
+            eventlet.sleep(self.latency)
+            expires_in = int(form['expires_at']) - time.time()
+            if not EXPIRES_MIN_SECONDS <= expires_in <= EXPIRES_MAX_SECONDS:
+                self.rejected += 1
+                start_response('400 Bad Request', [('Content-Type', 'application/json')])
+                return [json.dumps({'error': {'type': 'invalid_request_error', 'param': 'expires_at',
+                                              'message': f"expires_at is {expires_in:.0f}s away"}}).encode()]
+            if key in self.replies:
+                body = self.sessions[self.replies[key]]
+            else:
+                body = self._create(form)
+                if key:
+                    self.replies[key] = body['id']
+        elif method == 'GET' and path.startswith('/v1/checkout/sessions/'):
+            body = self.sessions.get(path.rsplit('/', 1)[1])
+            if body is None:
+                start_response('404 Not Found', [('Content-Type', 'application/json')])
+                return [json.dumps({'error': {'type': 'invalid_request_error', 'message': 'No such session'}}).encode()]
+        else:
+            start_response('404 Not Found', [('Content-Type', 'application/json')])
+            return [b'{"error": {"type": "invalid_request_error", "message": "stub: unknown route"}}']
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps(body).encode()]
+
+    def _create(self, form):
+        self.creates += 1
+        session_id = f"cs_test_{next(self.ids)}"
+        self.sessions[session_id] = {
+            'id': session_id, 'object': 'checkout.session', 'url': f"https://checkout.stripe.test/{session_id}",
+            'expires_at': int(form['expires_at']), 'payment_status': 'unpaid', 'status': 'open',
+            'client_reference_id': form.get('client_reference_id'),
+            'metadata': {'user_id': form.get('metadata[user_id]')},
+        }
+        return self.sessions[session_id]
+
+
+def signed(event):
+    payload = json.dumps(event)
+    ts = int(time.time())
+    sig = hmac.new(WEBHOOK_SECRET.encode(), f"{ts}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return payload, {'Stripe-Signature': f"t={ts},v1={sig}", 'Content-Type': 'application/json'}
+
+
+def session_event(event_id, session, event_type='checkout.session.completed'):
+    return {'id': event_id, 'object': 'event', 'type': event_type, 'data': {'object': session}}
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--users', type=int, default=20)
+    p.add_argument('--clicks', type=int, default=10)
+    p.add_argument('--replays', type=int, default=5)
+    p.add_argument('--latency', type=float, default=0.2, help="stub seconds per session create")
+    p.add_argument('--stripe-mock', help="stripe-mock base URL to use instead of the stub")
+    args = p.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='checkout_')
+    os.environ.update(DB_FILE=os.path.join(workdir, 'checkout.db'), STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET,
+                      STRIPE_SECRET_KEY='sk_test_bench', GEMINI_MODEL='bench-stub',
+                      MODEL_CACHE_FILE=os.path.join(workdir, 'model.json'), EXPERT_PASSWORD_SCRYPT_N='16',
+                      JOB_POLL_SECONDS='0.1')
+    for key in ('GOOGLE_API_KEY', 'FIREBASE_CREDENTIALS', 'REDIS_URL'):
+        os.environ.pop(key, None)
+
+    import stripe
+    stub = StripeStub(args.latency)
+    if args.stripe_mock:
+        stripe.api_base = args.stripe_mock
+    else:
+        listener = eventlet.listen(('127.0.0.1', 0))
+        eventlet.spawn(wsgi.server, listener, stub, log_output=False)
+        stripe.api_base = f"http://127.0.0.1:{listener.getsockname()[1]}"
+
+    import auth
+    import payments
+    import server
+    app, sio = server.app, server.socketio
+    http = app.test_client()
+    users = [f"buyer{i}" for i in range(args.users)]
+    for user_id in users:
+        server.append_message(user_id, 'user', "my printer shows offline")
+        server.save_category(user_id, 'tech')
+
+    # Double clicks: every click of a user must get the same URL from one Stripe session
+    pool = eventlet.GreenPool(args.users * args.clicks)
+    start, start_wall = time.monotonic(), time.time()
+    replies = list(pool.imap(lambda uid: (uid, http.post('/create-checkout-session', json={'userId': uid})),
+                             [uid for uid in users for _ in range(args.clicks)]))
+    elapsed = time.monotonic() - start
+    urls = {}
+    for uid, r in replies:
+        urls.setdefault(uid, set()).add(r.get_json().get('url'))
+    print(f"double click   {len(replies)} requests, {stub.creates} Stripe sessions for {len(users)} users "
+          f"in {elapsed:.2f}s")
+    check("every click answered", all(r.status_code == 200 for _, r in replies),
+          sorted({r.status_code for _, r in replies}))
+    check("one URL per user", all(len(u) == 1 and None not in u for u in urls.values()))
+    if not args.stripe_mock:
+        check("one Stripe session per user", stub.creates == len(users), stub.creates)
+        check("expires_at within Stripe's range", not stub.rejected and all(
+            EXPIRES_MIN_SECONDS <= s['expires_at'] - start_wall <= EXPIRES_MAX_SECONDS for s in stub.sessions.values()),
+              f"{stub.rejected} rejected")
+
+    # Two workers racing with no cached row: only the idempotency key keeps them to one session
+    before = stub.creates
+    server.db.execute("DELETE FROM checkout_sessions")
+    racers = list(pool.imap(lambda uid: payments.checkout_url(uid, 'https://ok', 'https://cancel'), users * 2))
+    same = all(racers[i] == racers[i + len(users)] == next(iter(urls[uid])) for i, uid in enumerate(users))
+    print(f"two workers    {len(racers)} uncached creates -> {stub.creates - before} new Stripe sessions")
+    if not args.stripe_mock:
+        check("idempotency key: same session for both workers", same and stub.creates == before,
+              f"{stub.creates - before} new sessions")
+
+    # Webhook replays + other event ids + client mark_paid, all at once
+    expert = sio.test_client(app)
+    server.write_experts("INSERT INTO experts (name, photo_url, categories, password) VALUES (?, ?, ?, ?)",
+                         ('Checkout Expert', '', json.dumps(['tech']), auth.hash_password('pw')))
+    expert_id = server.db.query_one("SELECT MAX(id) FROM experts")[0]
+    expert.emit('expert_login', {'expert_id': expert_id, 'password': 'pw'})
+    expert.get_received()
+    customers = {}
+    for uid in users:
+        customers[uid] = sio.test_client(app)
+        customers[uid].emit('register', {'user_id': uid})
+        customers[uid].get_received()
+
+    server_sessions = dict(server.db.query("SELECT user_id, session_id FROM checkout_sessions"))
+    for session_id in server_sessions.values():
+        stub.sessions[session_id].update(payment_status='paid', status='complete')
+    deliveries = []
+    for uid, session_id in server_sessions.items():
+        session = stub.sessions[session_id]
+        deliveries += [('webhook', signed(session_event(f"evt_{session_id}", session)))] * args.replays
+        deliveries.append(('webhook', signed(session_event(f"evt_async_{session_id}", session,
+                                                           'checkout.session.async_payment_succeeded'))))
+        deliveries += [('mark_paid', uid)] * args.replays
+
+    def deliver(item):
+        kind, body = item
+        if kind == 'webhook':
+            return http.post('/stripe-webhook', data=body[0], headers=body[1]).status_code
+        customers[body].emit('mark_paid', {'user_id': body})
+        return 200
+
+    statuses = list(pool.imap(deliver, deliveries))
+    eventlet.sleep(1.0)   # payment_confirmed jobs
+    paid = server.db.query_one("SELECT COUNT(*) FROM chats WHERE paid=1 AND user_id LIKE 'buyer%'")[0]
+    job_counts = dict(server.db.query("SELECT type, COUNT(*) FROM jobs WHERE type IN "
+                                      "('payment_confirmed', 'expert_announce') GROUP BY type"))
+    broadcasts = [m['args'][0]['user_id'] for m in expert.get_received() if m['name'] == 'new_paid_user']
+    confirmed = [sum(m['name'] == 'payment_confirmed' for m in c.get_received()) for c in customers.values()]
+    print(f"webhook        {sum(k == 'webhook' for k, _ in deliveries)} deliveries + "
+          f"{sum(k == 'mark_paid' for k, _ in deliveries)} mark_paid; {payments.stats()}")
+    check("every webhook delivery acknowledged", all(s == 200 for s in statuses), sorted(set(statuses)))
+    check("every chat paid", paid == len(users), f"{paid}/{len(users)}")
+    check("one payment_confirmed job per user", job_counts.get('payment_confirmed', 0) == len(users),
+          job_counts.get('payment_confirmed', 0))
+    check("one expert_announce job per user", job_counts.get('expert_announce', 0) == len(users),
+          job_counts.get('expert_announce', 0))
+    check("new_paid_user once per user", sorted(broadcasts) == sorted(users),
+          f"max {max(broadcasts.count(u) for u in users)}, users {len(set(broadcasts))}")
+    check("payment_confirmed reached every client", min(confirmed) >= 1)
+
+    # Rejected: bad signature, and a completed-but-unpaid session
+    payload, headers = signed(session_event('evt_forged', {'id': 'cs_forged', 'payment_status': 'paid',
+                                                           'client_reference_id': 'victim', 'metadata': {}}))
+    forged = http.post('/stripe-webhook', data=payload, headers=dict(headers, **{'Stripe-Signature': 't=1,v1=00'}))
+    server.append_message('slowpay', 'user', "I'll pay by bank transfer")
+    server.save_category('slowpay', 'tech')
+    payload, headers = signed(session_event('evt_unpaid', {'id': 'cs_unpaid', 'payment_status': 'unpaid',
+                                                           'client_reference_id': 'slowpay', 'metadata': {}}))
+    unpaid = http.post('/stripe-webhook', data=payload, headers=headers)
+    still_unpaid = not server.db.query_one("SELECT paid FROM chats WHERE user_id='slowpay'")[0]
+    victim = server.db.query_one("SELECT paid FROM chats WHERE user_id='victim'")
+    check("bad signature rejected", forged.status_code == 400 and victim is None, forged.status_code)
+    check("unpaid session acknowledged, chat stays unpaid", unpaid.status_code == 200 and still_unpaid,
+          unpaid.status_code)
+
+    print(f"\n{len(failures)} failed" if failures else "\nall passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
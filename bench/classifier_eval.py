@@ -0,0 +1,85 @@
+"""
+Offline evaluation of the local category classifier against stored labels
+(the categories the LLM path assigned so far).
+
+    DB_FILE=/path/to/chat_data.db python bench/classifier_eval.py [--test-fraction 0.2] [--llm 50]
+
+--llm N also runs the current Gemini path on N held-out chats (needs
+GOOGLE_API_KEY) to compare latency and agreement.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--test-fraction", type=float, default=0.2)
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--limit", type=int, default=20000)
+    ap.add_argument("--llm", type=int, default=0, help="also time the LLM path on N test chats")
+    args = ap.parse_args()
+
+    if args.llm:
+        import server  # monkey-patches and sets up Gemini; must come first
+    import classifier
+
+    examples = classifier.load_training_examples(args.limit)
+    if len(examples) < 10:
+        print(f"Only {len(examples)} labelled chats in {os.getenv('DB_FILE', '/data/chat_data.db')}; nothing to evaluate.")
+        return
+    random.Random(args.seed).shuffle(examples)
+    cut = max(1, int(len(examples) * args.test_fraction))
+    test, train = examples[:cut], examples[cut:]
+
+    clf = classifier.CategoryClassifier()
+    start = time.perf_counter()
+    clf.fit(train)
+    train_seconds = time.perf_counter() - start
+
+    correct = confident = confident_correct = 0
+    latencies = []
+    for text, label in test:
+        t0 = time.perf_counter()
+        predicted, confidence = clf.predict(text)
+        latencies.append(time.perf_counter() - t0)
+        correct += predicted == label
+        if confidence >= clf.threshold:
+            confident += 1
+            confident_correct += predicted == label
+
+    print(f"train={len(train)} test={len(test)} fit={train_seconds:.2f}s threshold={clf.threshold}")
+    print(f"local accuracy (all)        {correct / len(test):.3f}")
+    print(f"coverage (>= threshold)     {confident / len(test):.3f}")
+    if confident:
+        print(f"local accuracy (confident)  {confident_correct / confident:.3f}")
+    print(f"local latency p50/p95       {pct(latencies, .5) * 1000:.3f} / {pct(latencies, .95) * 1000:.3f} ms")
+
+    if args.llm:
+        agree = 0
+        llm_latencies = []
+        sample = test[:args.llm]
+        for text, label in sample:
+            t0 = time.perf_counter()
+            predicted = server.llm_classify([{'sender': 'user', 'text': text}])
+            llm_latencies.append(time.perf_counter() - t0)
+            agree += predicted == label
+        print(f"llm agreement with labels   {agree / len(sample):.3f}")
+        print(f"llm latency p50/p95         {pct(llm_latencies, .5) * 1000:.0f} / {pct(llm_latencies, .95) * 1000:.0f} ms"
+              f"  (mean {statistics.mean(llm_latencies) * 1000:.0f} ms)")
+
+
+if __name__ == "__main__":
+    main()
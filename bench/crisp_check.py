@@ -0,0 +1,181 @@
+"""
+crisp.py checks against a local fake Crisp REST API (no network).
+
+The fake serves GET .../visitors/token/<token> and POST .../conversation/<session>/message
+on a local port, records the client connection (remote port) of every
+request and can be scripted per token / per session to answer 404 (not bound
+yet), 429 or 500 a number of times first. Checks:
+
+    pool        sequential requests reuse one keep-alive connection
+    cap         --burst concurrent sends never exceed CRISP_MAX_CONCURRENCY in flight
+    poll        token binding polled with backoff until bound; gives up
+                after CRISP_POLL_SECONDS with a RuntimeError (the job retries)
+    retry       429/5xx sends retried with backoff; a 400 fails at once
+    dedupe      crisp_sync twice for one token while the first waits for the
+                session (through server.py and the job queue) -> one post,
+                carrying the newer transcript
+
+    python bench/crisp_check.py
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+from eventlet import wsgi
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MAX_CONCURRENCY = 4
+POLL_SECONDS = 5.0   # above the worst-case backoff of the scripted 4 misses (3.75 s)
+
+
+class FakeCrisp:
+    def __init__(self):
+        self.requests = []          # (method, path, remote port)
+        self.posts = []             # (session_id, content)
+        self.script = {}            # token or session id -> list of statuses to answer first
+        self.unbound = set()        # tokens that never bind
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.latency = 0.0
+
+    def __call__(self, environ, start_response):
+        method, path = environ['REQUEST_METHOD'], environ['PATH_INFO']
+        self.requests.append((method, path, environ.get('REMOTE_PORT')))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            eventlet.sleep(self.latency)
+            target = path.rsplit('/', 1)[-1] if '/visitors/token/' in path else path.split('/')[-2]
+            pending = self.script.get(target)
+            if pending:
+                status = pending.pop(0)
+                start_response(f"{status} Scripted", [('Content-Type', 'application/json')])
+                return [b'{"error": true}']
+            if method == 'GET':
+                if target in self.unbound:
+                    start_response('404 Not Found', [('Content-Type', 'application/json')])
+                    return [b'{"error": true, "reason": "visitor_not_found"}']
+                body = {'data': {'session_id': f"session_{target}"}}
+            else:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+                self.posts.append((target, json.loads(environ['wsgi.input'].read(length))['content']))
+                body = {'error': False}
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [json.dumps(body).encode()]
+        finally:
+            self.in_flight -= 1
+
+
+failures = []
+
+
+def check(name, ok, detail=''):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}{': ' + str(detail) if detail else ''}")
+    if not ok:
+        failures.append(name)
+
+
+def raises(fn, *args):
+    try:
+        fn(*args)
+    except Exception as e:
+        return e
+    return None
+
+
+def main():
+    fake = FakeCrisp()
+    listener = eventlet.listen(('127.0.0.1', 0))
+    eventlet.spawn_n(wsgi.server, listener, fake, log_output=False)
+    workdir = tempfile.mkdtemp(prefix='crisp_')
+    os.environ.update(CRISP_API_IDENTIFIER='bench', CRISP_API_KEY='bench', CRISP_WEBSITE_ID='site',
+                      CRISP_API_BASE=f"http://127.0.0.1:{listener.getsockname()[1]}/v1",
+                      CRISP_MAX_CONCURRENCY=str(MAX_CONCURRENCY), CRISP_POLL_SECONDS=str(POLL_SECONDS),
+                      DB_FILE=os.path.join(workdir, 'crisp.db'), GEMINI_MODEL='bench-stub',
+                      MODEL_CACHE_FILE=os.path.join(workdir, 'model.json'), JOB_POLL_SECONDS='0.05')
+    for key in ('GOOGLE_API_KEY', 'FIREBASE_CREDENTIALS', 'REDIS_URL'):
+        os.environ.pop(key, None)
+    import crisp
+
+    # pool: one keep-alive connection for sequential calls
+    start = len(fake.requests)
+    for i in range(10):
+        crisp.push_transcript(f"pool{i}", "hello")
+    ports = {port for _, _, port in fake.requests[start:]}
+    check("sequential requests share one connection", len(ports) == 1, f"{len(fake.requests) - start} requests, "
+          f"{len(ports)} connections")
+
+    # cap: concurrent sends stay under CRISP_MAX_CONCURRENCY
+    fake.latency, fake.max_in_flight = 0.05, 0
+    pool = eventlet.GreenPool(40)
+    list(pool.imap(lambda i: crisp.send_message(f"cap{i}", "x"), range(40)))
+    fake.latency = 0.0
+    check("concurrency cap", 1 < fake.max_in_flight <= MAX_CONCURRENCY, f"max in flight {fake.max_in_flight}")
+
+    # poll: 404 until bound, with backoff; gives up after CRISP_POLL_SECONDS
+    fake.script['late'] = [404, 404, 429, 404]
+    start = time.monotonic()
+    crisp.push_transcript('late', "bound late")
+    polls = sum(1 for m, p, _ in fake.requests if m == 'GET' and p.endswith('/late'))
+    check("token polled until bound", polls == 5 and fake.posts[-1] == ('session_late', "bound late"),
+          f"{polls} polls in {time.monotonic() - start:.2f}s")
+    fake.unbound.add('never')
+    start = time.monotonic()
+    error = raises(crisp.push_transcript, 'never', "lost")
+    elapsed = time.monotonic() - start
+    check("unbound token gives up", isinstance(error, RuntimeError) and elapsed <= POLL_SECONDS + 0.1,
+          f"{elapsed:.2f}s, {error!r}")
+
+    # retry: 429/5xx retried, 4xx not
+    fake.script['session_flaky'] = [429, 503]
+    before = len(fake.posts)
+    crisp.send_message('session_flaky', "third time")
+    sends = sum(1 for m, p, _ in fake.requests if m == 'POST' and '/session_flaky/' in p)
+    check("429/503 retried", sends == 3 and len(fake.posts) == before + 1, f"{sends} attempts")
+    fake.script['session_bad'] = [400]
+    error = raises(crisp.send_message, 'session_bad', "rejected")
+    sends = sum(1 for m, p, _ in fake.requests if m == 'POST' and '/session_bad/' in p)
+    check("400 not retried", error is not None and sends == 1, f"{sends} attempts, {error.__class__.__name__}")
+    fake.script['session_down'] = [500] * crisp.CRISP_SEND_RETRIES
+    error = raises(crisp.send_message, 'session_down', "down")
+    sends = sum(1 for m, p, _ in fake.requests if m == 'POST' and '/session_down/' in p)
+    check("gives up after CRISP_SEND_RETRIES", error is not None and sends == crisp.CRISP_SEND_RETRIES,
+          f"{sends} attempts")
+    delays = [crisp.backoff_delay(a) for a in range(10) for _ in range(100)]
+    check("full-jitter backoff bounded", min(delays) >= 0 and max(delays) <= crisp.CRISP_BACKOFF_MAX)
+
+    # dedupe: two syncs for one token through the server and the job queue
+    import server
+    fake.script['tok1'] = [404, 404, 404]   # the first job is still polling when the second sync arrives
+    client = server.socketio.test_client(server.app)
+    server.append_message('dedupe', 'user', "first question")
+    client.emit('crisp_sync', {'user_id': 'dedupe', 'token_id': 'tok1'})
+    eventlet.sleep(0.2)
+    server.append_message('dedupe', 'user', "second question")
+    client.emit('crisp_sync', {'user_id': 'dedupe', 'token_id': 'tok1'})
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and server.db.query_one(
+            "SELECT COUNT(*) FROM jobs WHERE type='crisp_sync' AND status IN ('queued', 'running')")[0]:
+        eventlet.sleep(0.1)
+    posts = [content for session, content in fake.posts if session == 'session_tok1']
+    check("repeat sync while running -> one post with the newer transcript",
+          len(posts) == 1 and "second question" in posts[0], f"{len(posts)} posts")
+    eventlet.sleep(0.2)
+    client.emit('crisp_sync', {'user_id': 'dedupe', 'token_id': 'tok1'})
+    eventlet.sleep(0.5)
+    posts = [content for session, content in fake.posts if session == 'session_tok1']
+    check("sync after the push completed posts again", len(posts) == 2, f"{len(posts)} posts")
+
+    print(f"\n{len(failures)} failed" if failures else "\nall passed")
+    os._exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
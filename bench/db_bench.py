@@ -0,0 +1,80 @@
+"""
+DB events/sec: per-call sqlite3.connect (old handlers) vs the pooled db module.
+
+Each "event" is the DB work of one user_message turn: get_chat + two appends.
+
+    python bench/db_bench.py [--events 5000] [--users 200]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS chats (user_id TEXT PRIMARY KEY, history TEXT, paid BOOLEAN, category TEXT)",
+    "CREATE TABLE IF NOT EXISTS messages (user_id TEXT NOT NULL, seq INTEGER NOT NULL, sender TEXT NOT NULL, "
+    "text TEXT, created_at DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (user_id, seq))",
+)
+LOAD_CHAT = "SELECT paid, category FROM chats WHERE user_id=?"
+LOAD_MSGS = "SELECT sender, text FROM messages WHERE user_id=? ORDER BY seq"
+ENSURE_CHAT = "INSERT OR IGNORE INTO chats (user_id, paid) VALUES (?, 0)"
+APPEND = ("INSERT INTO messages (user_id, seq, sender, text) "
+          "SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ? FROM messages WHERE user_id=?")
+
+
+def event_per_call(path, uid):
+    conn = sqlite3.connect(path)
+    conn.execute(LOAD_CHAT, (uid,)).fetchone()
+    conn.execute(LOAD_MSGS, (uid,)).fetchall()
+    conn.close()
+    for sender in ('user', 'bot'):
+        conn = sqlite3.connect(path)
+        conn.execute(ENSURE_CHAT, (uid,))
+        conn.execute(APPEND, (uid, sender, 'hello there', uid))
+        conn.commit()
+        conn.close()
+
+
+def event_pooled(db, uid):
+    db.run(lambda conn: (conn.execute(LOAD_CHAT, (uid,)).fetchone(),
+                         conn.execute(LOAD_MSGS, (uid,)).fetchall()))
+    for sender in ('user', 'bot'):
+        db.run(lambda conn: (conn.execute(ENSURE_CHAT, (uid,)),
+                             conn.execute(APPEND, (uid, sender, 'hello there', uid))))
+
+
+def measure(label, fn, events, users):
+    start = time.perf_counter()
+    for i in range(events):
+        fn(f"user-{i % users}")
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {events / elapsed:>10.0f} events/sec  ({elapsed:.2f}s)")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--events", type=int, default=5000)
+    ap.add_argument("--users", type=int, default=200)
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    old_path = os.path.join(tmp, "per_call.db")
+    new_path = os.path.join(tmp, "pooled.db")
+    for path in (old_path, new_path):
+        conn = sqlite3.connect(path)
+        for stmt in SCHEMA:
+            conn.execute(stmt)
+        conn.close()
+
+    os.environ["DB_FILE"] = new_path
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import db
+
+    measure("per-call connect", lambda uid: event_per_call(old_path, uid), args.events, args.users)
+    measure("pooled + WAL", lambda uid: event_pooled(db, uid), args.events, args.users)
+
+
+if __name__ == "__main__":
+    main()
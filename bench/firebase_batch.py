@@ -0,0 +1,164 @@
+"""
+Firestore writes for a burst of chat syncs: one add() per sync (old) vs
+FirestoreBatcher (coalesced batched set()).
+
+Two batcher runs, each checked (exit status 1 on a failed check):
+
+    size-triggered  batches flush as they reach FIREBASE_BATCH_SIZE (and
+                    never grow past it): one document per user, one RPC per batch
+    coalescing      every put lands in one flush window (max_batch above the
+                    user count): repeats replace the buffered doc, so one
+                    batch writes one document per user, holding its last put
+
+Runs against an in-memory fake whose commit blocks its OS thread for
+--latency seconds, or against the Firestore emulator with --emulator
+(needs FIRESTORE_EMULATOR_HOST and GOOGLE_CLOUD_PROJECT set).
+
+    python bench/firebase_batch.py [--users 200] [--updates 3] [--latency 0.05]
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import math
+import os
+import sys
+import time
+
+from eventlet import patcher, tpool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import firebase_sync
+
+blocking_sleep = patcher.original('time').sleep
+
+
+class FakeFirestore:
+    """Just enough of firestore.Client: collection().add/document(), batch()."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.docs = {}
+        self.rpcs = 0
+        self._auto = 0
+
+    def _rpc(self):
+        self.rpcs += 1
+        blocking_sleep(self.latency)
+
+    def collection(self, name):
+        return _FakeCollection(self, name)
+
+    def batch(self):
+        return _FakeBatch(self)
+
+
+class _FakeCollection:
+    def __init__(self, client, name):
+        self.client, self.name = client, name
+
+    def document(self, doc_id):
+        return (self.name, doc_id)
+
+    def add(self, doc):
+        self.client._rpc()
+        self.client._auto += 1
+        self.client.docs[(self.name, f"auto{self.client._auto}")] = doc
+
+
+class _FakeBatch:
+    def __init__(self, client):
+        self.client, self.ops = client, []
+
+    def set(self, ref, doc):
+        self.ops.append((ref, doc))
+
+    def commit(self):
+        self.client._rpc()
+        for ref, doc in self.ops:
+            self.client.docs[ref] = doc
+
+
+def make_client(args):
+    if args.emulator:
+        from google.cloud import firestore
+        return firestore.Client()
+    return FakeFirestore(args.latency)
+
+
+def burst(users, updates, write):
+    pool = eventlet.GreenPool(users * updates)
+    start = time.monotonic()
+    for round_ in range(updates):
+        for u in range(users):
+            pool.spawn_n(write, f"user{u}", {'user_id': f"user{u}", 'history': [{'sender': 'user', 'text': 'x'}] * round_})
+        eventlet.sleep(0)
+    pool.waitall()
+    return time.monotonic() - start
+
+
+failures = []
+
+
+def check(name, ok, detail=''):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}{': ' + str(detail) if detail else ''}")
+    if not ok:
+        failures.append(name)
+
+
+def docs_in(client, collection):
+    return {k[1]: v for k, v in getattr(client, 'docs', {}).items() if k[0] == collection}
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--users', type=int, default=200)
+    p.add_argument('--updates', type=int, default=3, help="syncs per user in the burst")
+    p.add_argument('--latency', type=float, default=0.05, help="fake RPC latency in seconds")
+    p.add_argument('--emulator', action='store_true')
+    args = p.parse_args()
+
+    puts = args.users * args.updates
+    client = make_client(args)
+    elapsed = burst(args.users, args.updates, lambda uid, doc: tpool.execute(client.collection('chats_old').add, doc))
+    print(f"add() per sync     : {elapsed:6.2f}s  rpcs={getattr(client, 'rpcs', None)}  "
+          f"docs={len(docs_in(client, 'chats_old'))}")
+
+    client = make_client(args)
+    batcher = firebase_sync.FirestoreBatcher(client, collection='chats_new', window=0.2)
+    elapsed = burst(args.users, args.updates, batcher.put)
+    stats = batcher.stats()
+    print(f"size-triggered     : {elapsed:6.2f}s  rpcs={getattr(client, 'rpcs', None)}  "
+          f"docs={len(docs_in(client, 'chats_new'))}  {stats}")
+    if not args.emulator:
+        check("size-triggered: one document per user", len(docs_in(client, 'chats_new')) == args.users)
+        check("size-triggered: every put written or coalesced",
+              stats['puts'] == puts and stats['writes'] + stats['coalesced'] == puts and not stats['buffered'],
+              f"{stats['writes']} written + {stats['coalesced']} coalesced of {puts}")
+        check("size-triggered: one RPC per batch", client.rpcs == stats['batches'] == math.ceil(stats['writes'] / batcher.max_batch),
+              f"{client.rpcs} rpcs, {stats['batches']} batches")
+
+    # Every put in one window: max_batch above the user count, so only the timer flushes
+    users = min(args.users, 499)
+    client = make_client(args)
+    batcher = firebase_sync.FirestoreBatcher(client, collection='chats_coalesce', max_batch=users + 1, window=0.2)
+    elapsed = burst(users, args.updates, batcher.put)
+    stats = batcher.stats()
+    docs = docs_in(client, 'chats_coalesce')
+    print(f"coalescing         : {elapsed:6.2f}s  rpcs={getattr(client, 'rpcs', None)}  docs={len(docs)}  {stats}")
+    if not args.emulator:
+        check("coalescing: repeat puts coalesced", stats['coalesced'] == users * (args.updates - 1) > 0,
+              f"{stats['coalesced']} coalesced")
+        check("coalescing: documents written == distinct users", stats['writes'] == len(docs) == users,
+              f"{stats['writes']} writes, {len(docs)} docs")
+        check("coalescing: one batch, one RPC", stats['batches'] == client.rpcs == 1,
+              f"{stats['batches']} batches, {client.rpcs} rpcs")
+        check("coalescing: each document holds the user's last put",
+              all(len(d['history']) == args.updates - 1 for d in docs.values()))
+
+    print(f"\n{len(failures)} failed" if failures else "\nall passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Hub responsiveness while slow LLM calls are in flight.
+
+A stub "model" blocks its OS thread for --latency seconds (like a gRPC call
+monkey_patch can't see). A ticker greenlet wakes every 10 ms and records how
+late it was; that lateness is what every other socket on the worker feels.
+
+    python bench/llm_load.py [--calls 20] [--latency 2.0]
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import os
+import sys
+import time
+
+from eventlet import patcher
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import llm
+
+blocking_sleep = patcher.original('time').sleep
+
+
+def slow_model(latency):
+    blocking_sleep(latency)
+    return "ok"
+
+
+def run(label, invoke, calls, latency):
+    lags = []
+    done = {'flag': False}
+
+    def ticker():
+        while not done['flag']:
+            t0 = time.monotonic()
+            eventlet.sleep(0.01)
+            lags.append(time.monotonic() - t0 - 0.01)
+
+    tick = eventlet.spawn(ticker)
+    eventlet.sleep(0.05)
+    start = time.monotonic()
+    pool = eventlet.GreenPool()
+    for _ in range(calls):
+        pool.spawn(invoke, slow_model, latency)
+    pool.waitall()
+    elapsed = time.monotonic() - start
+    done['flag'] = True
+    tick.wait()
+
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0.0
+    print(f"{label:<16} wall={elapsed:6.2f}s  ticks={len(lags):5d}  "
+          f"hub lag p99={p99 * 1000:8.1f}ms  max={max(lags or [0]) * 1000:8.1f}ms")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--calls", type=int, default=20)
+    ap.add_argument("--latency", type=float, default=2.0)
+    args = ap.parse_args()
+
+    run("direct (old)", lambda fn, lat: fn(lat), args.calls, args.latency)
+    run("llm.call", lambda fn, lat: llm.call(fn, lat), args.calls, args.latency)
+    print("llm stats:", llm.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Hub responsiveness during an expert login storm.
+
+--logins concurrent password checks against one scrypt hash, either with the
+KDF run directly on the hub or through auth.verify_password (tpool). A ticker
+greenlet wakes every 10 ms and records how late it was; that lateness is what
+every other socket on the worker feels while the logins run.
+
+    python bench/login_storm.py [--logins 50] [--cost 16384]
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run(label, check, logins):
+    lags = []
+    done = {'flag': False}
+
+    def ticker():
+        while not done['flag']:
+            t0 = time.monotonic()
+            eventlet.sleep(0.01)
+            lags.append(time.monotonic() - t0 - 0.01)
+
+    eventlet.spawn_n(ticker)
+    eventlet.sleep(0.05)
+    pool = eventlet.GreenPool(logins)
+    start = time.monotonic()
+    results = list(pool.imap(lambda _: check(), range(logins)))
+    elapsed = time.monotonic() - start
+    done['flag'] = True
+    eventlet.sleep(0.02)
+    assert all(results)
+    lags.sort()
+    print(f"{label:24} {logins} logins in {elapsed:6.2f}s  ({logins / elapsed:6.1f}/s)  "
+          f"hub lag p50 {statistics.median(lags) * 1000:7.1f} ms  max {lags[-1] * 1000:7.1f} ms")
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--logins', type=int, default=50)
+    p.add_argument('--cost', type=int, default=2 ** 14, help="scrypt N (EXPERT_PASSWORD_SCRYPT_N)")
+    args = p.parse_args()
+    os.environ['EXPERT_PASSWORD_SCRYPT_N'] = str(args.cost)
+
+    import auth
+    stored = auth.hash_password("correct horse")
+    _, n, r, p_, salt, digest = stored.split("$")
+
+    def on_hub():
+        return auth._kdf("correct horse", auth._unb64(salt), int(n), int(r), int(p_)) == auth._unb64(digest)
+
+    run("KDF on the hub", on_hub, args.logins)
+    run("auth.verify_password", lambda: auth.verify_password("correct horse", stored), args.logins)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Admin-room traffic during an expert reconnect storm.
+
+--experts experts are online; then all of them drop at once and reconnect
+with their session tokens over --spread seconds, as after a deploy, except
+--gone of them who don't come back (a shift change), while --admins sockets
+watch presence. Counts the presence messages and JSON bytes each admin
+receives, for three ways of broadcasting:
+
+    legacy      full online_ids list to admin_room on every login/disconnect
+    immediate   one presence delta per change (PRESENCE_FLUSH_SECONDS=0)
+    debounced   deltas coalesced every --window seconds (the default)
+
+and checks, per mode, that applying the deltas from each admin's snapshot
+reproduces the final online set and that every admin got the same count:
+one message per login/disconnect for legacy and immediate, at most one per
+window (plus the trailing flush) for debounced. Exits 1 if a check fails.
+Runs in-process with Flask-SocketIO test clients.
+
+    python bench/presence_storm.py [--experts 300] [--admins 5] [--spread 3] [--window 1.0]
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ADMIN_PASSWORD = "bench-admin"
+PRESENCE_EVENTS = ('online_experts_update', 'online_experts_delta')
+
+failures = []
+
+
+def check(name, ok, detail=''):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}{': ' + str(detail) if detail else ''}")
+    if not ok:
+        failures.append(name)
+
+
+def replay(received):
+    """Online set an admin client ends up with, or None if a delta didn't line up."""
+    version, online = None, set()
+    for msg in received:
+        payload = msg['args'][0]
+        if msg['name'] == 'online_experts_update':
+            online = set(payload['online_ids'])
+            version = payload.get('version')
+        elif version is not None:
+            if payload['version'] != version + 1:
+                return None
+            online = (online | set(payload['joined'])) - set(payload['left'])
+            version = payload['version']
+    return online
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--experts', type=int, default=300)
+    p.add_argument('--admins', type=int, default=5)
+    p.add_argument('--spread', type=float, default=3.0, help="reconnects are spread over this many seconds")
+    p.add_argument('--gone', type=float, default=0.1, help="fraction of experts that don't reconnect")
+    p.add_argument('--window', type=float, default=1.0, help="PRESENCE_FLUSH_SECONDS for the debounced run")
+    args = p.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='presence_')
+    os.environ.update(DB_FILE=os.path.join(workdir, 'presence.db'), ADMIN_PASSWORD=ADMIN_PASSWORD,
+                      GEMINI_MODEL='bench-stub', MODEL_CACHE_FILE=os.path.join(workdir, 'model.json'),
+                      EXPERT_PASSWORD_SCRYPT_N='16')
+    for key in ('GOOGLE_API_KEY', 'FIREBASE_CREDENTIALS', 'REDIS_URL'):
+        os.environ.pop(key, None)
+
+    import auth
+    import server
+    app, sio = server.app, server.socketio
+
+    for i in range(args.experts):
+        server.write_experts("INSERT INTO experts (name, photo_url, categories, password) VALUES (?, ?, ?, ?)",
+                             (f"Presence Expert {i}", '', json.dumps(['tech']), auth.hash_password(f"pw-{i}")))
+    ids = [row[0] for row in server.db.query("SELECT id FROM experts ORDER BY id")]
+    returning = random.Random(1).sample(ids, round(len(ids) * (1 - args.gone)))
+
+    # Log everyone in once for their session tokens
+    tokens = {}
+    for expert_id in ids:
+        c = sio.test_client(app)
+        c.emit('expert_login', {'expert_id': expert_id, 'password': f"pw-{expert_id - ids[0]}"})
+        tokens[expert_id] = next(m for m in c.get_received() if m['name'] == 'login_success')['args'][0]['token']
+        c.disconnect()
+
+    def legacy_broadcast():
+        online_ids = server.shared_state.online_expert_ids()
+        server.socketio.emit('online_experts_update', {'online_ids': online_ids}, to='admin_room')
+
+    debounced = server.broadcast_online_status
+    modes = [('legacy', legacy_broadcast, 0), ('immediate', debounced, 0), ('debounced', debounced, args.window)]
+    print(f"{args.experts} experts drop at once, {len(returning)} reconnect over {args.spread:g}s, "
+          f"{args.admins} admins watching")
+    print(f"{'mode':10} {'msgs/admin':>11} {'KB/admin':>9} {'storm s':>8} {'final set ok':>13}")
+    changes = len(ids) + len(returning)   # every expert drops, the returning ones log back in
+    results = {}
+    for name, broadcast, window in modes:
+        server.broadcast_online_status = broadcast
+        server.online_presence.window = window
+
+        experts = {}
+
+        def connect(expert_id, delay=0):
+            eventlet.sleep(delay)
+            c = sio.test_client(app)
+            c.emit('expert_login', {'token': tokens[expert_id]})
+            experts[expert_id] = c
+
+        pool = eventlet.GreenPool(args.experts)
+        list(pool.imap(connect, ids))
+        server.online_presence.flush()
+        admins = []
+        for _ in range(args.admins):
+            a = sio.test_client(app)
+            a.emit('admin_login', {'password': ADMIN_PASSWORD})
+            a.get_received()
+            a.emit('get_online_experts')   # start every admin from a snapshot
+            admins.append(a)
+
+        start = time.monotonic()
+        online, experts = experts, {}
+        list(pool.imap(lambda c: c.disconnect(), list(online.values())))
+        list(pool.imap(connect, returning, [random.uniform(0, args.spread) for _ in returning]))
+        elapsed = time.monotonic() - start
+        eventlet.sleep(window + 0.1)      # let the last debounced delta go out
+
+        counts, nbytes, ok = [], [], True
+        for a in admins:
+            received = [m for m in a.get_received() if m['name'] in PRESENCE_EVENTS]
+            counts.append(len(received) - 1)   # minus the starting snapshot
+            nbytes.append(sum(len(json.dumps(m['args'][0])) for m in received[1:]))
+            ok = ok and replay(received) == set(returning)
+        print(f"{name:10} {max(counts):11} {max(nbytes) / 1024:9.1f} {elapsed:8.2f} {str(ok):>13}")
+        results[name] = counts, ok, elapsed, window
+
+        for a in admins:
+            a.disconnect()
+        list(pool.imap(lambda c: c.disconnect(), list(experts.values())))
+        server.online_presence.flush()
+
+    print()
+    for name, (counts, ok, elapsed, window) in results.items():
+        check(f"{name}: deltas replay to the final online set", ok)
+        check(f"{name}: every admin got the same messages", min(counts) == max(counts), counts)
+        if window:
+            check(f"{name}: at most one message per window", 1 <= max(counts) <= math.ceil(elapsed / window) + 1,
+                  f"{max(counts)} in {elapsed:.2f}s")
+        else:
+            check(f"{name}: one message per change", max(counts) == changes, f"{max(counts)} for {changes} changes")
+
+    print(f"\n{len(failures)} failed" if failures else "\nall passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+RedisState checks against fakeredis (no Redis server needed).
+
+Several RedisState objects on one fake server stand in for workers:
+
+    presence     experts on two workers, sockets dropping on either
+    per-user     "Expert Joined" claimed once, shared turn counters
+    publish      workers flushing the same change at once publish one delta,
+                 versions stay consecutive; a write landing between WATCH and
+                 EXEC makes the flusher retry and include it
+    heartbeat    a worker stops heartbeating (crash/redeploy): a live worker
+                 reaps its sockets and the next delta reports them as left
+    stats        works without INFO
+
+    python bench/redis_state_check.py
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import os
+import sys
+import time
+
+import fakeredis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import state   # noqa: E402
+
+failures = []
+
+
+def check(name, ok, detail=''):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}{': ' + str(detail) if detail else ''}")
+    if not ok:
+        failures.append(name)
+
+
+def expert(expert_id):
+    return {'id': expert_id, 'name': f"Expert {expert_id}", 'photo_url': '', 'categories': ['tech']}
+
+
+def main():
+    server = fakeredis.FakeServer()
+
+    def worker(ttl=state.PRESENCE_WORKER_TTL_SECONDS):
+        return state.RedisState(fakeredis.FakeRedis(server=server, decode_responses=True), worker_ttl=ttl)
+
+    # presence
+    a, b = worker(), worker()
+    a.add_expert('a1', expert(1))
+    b.add_expert('b1', expert(1))
+    b.add_expert('b2', expert(2))
+    check("online across workers", a.online_expert_ids() == b.online_expert_ids() and
+          sorted(a.online_expert_ids()) == [1, 2])
+    check("get_expert from another worker", b.get_expert('a1') == expert(1))
+    a.remove_sid('a1')
+    check("expert stays online while another socket is open", 1 in b.online_expert_ids())
+    b.remove_sid('b1')
+    check("expert goes offline with the last socket", sorted(a.online_expert_ids()) == [2])
+
+    # per-user
+    check("claim_agent_joined once", (a.claim_agent_joined('u1'), b.claim_agent_joined('u1')) == (True, False))
+    a.incr_turns('u1')
+    b.incr_turns('u1')
+    check("shared turn counter", a.incr_turns('u1') == 3)
+
+    # publish: concurrent flushes of one change
+    a.publish_presence()
+    v0 = a.presence_snapshot()[0]
+    b.add_expert('b3', expert(3))
+    workers = [worker() for _ in range(8)]
+    results = list(eventlet.GreenPool().imap(lambda w: w.publish_presence(), workers))
+    published = [r for r in results if r]
+    check("one of 8 concurrent flushes publishes", len(published) == 1 and published[0] == (v0 + 1, {3}, set()),
+          published)
+    check("snapshot matches", a.presence_snapshot() == (v0 + 1, [2, 3]))
+
+    # publish: a change between WATCH and EXEC forces a retry that includes it
+    c = worker()
+    b.add_expert('b4', expert(4))
+    pipeline = c.r.pipeline
+    raced = []
+
+    def racing_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        multi = pipe.multi
+
+        def multi_then_race():
+            if not raced:
+                raced.append(True)
+                # another worker publishes expert 5's login after c read the sets
+                b.add_expert('b5', expert(5))
+                b.publish_presence()
+            return multi()
+        pipe.multi = multi_then_race
+        return pipe
+    c.r.pipeline = racing_pipeline
+    result = c.publish_presence()
+    c.r.pipeline = pipeline
+    check("WATCH conflict retried", raced and result is None and a.presence_snapshot() == (v0 + 2, [2, 3, 4, 5]),
+          (result, a.presence_snapshot()))
+
+    # heartbeat: worker d dies with two experts online
+    d = worker(ttl=1)
+    d.add_expert('d1', expert(6))
+    d.add_expert('d2', expert(7))
+    a.heartbeat()
+    check("live worker's experts kept", {6, 7} <= set(a.online_expert_ids()))
+    a.publish_presence()
+    version = a.presence_snapshot()[0]
+    time.sleep(1.2)   # d's heartbeat key expires; a and b have the default 30 s
+    removed = a.heartbeat()
+    check("dead worker's sockets reaped", sorted(e['id'] for e in removed) == [6, 7], removed)
+    check("reaped experts offline, others kept", sorted(a.online_expert_ids()) == [2, 3, 4, 5])
+    check("delta reports them as left", a.publish_presence() == (version + 1, set(), {6, 7}))
+    check("second reaper finds nothing", b.heartbeat() == [])
+
+    # stats without INFO
+    stats = a.stats()
+    check("stats", stats['online_experts'] == 4 and stats['reaped_sockets'] == 2, stats)
+
+    print(f"\n{len(failures)} failed" if failures else "\nall passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
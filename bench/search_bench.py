@@ -0,0 +1,120 @@
+"""
+search_chats latency at scale.
+
+Fills a throwaway DB with --messages synthetic messages (Zipf-distributed
+vocabulary plus support phrases, --per-chat messages per chat, 8 categories,
+half of the chats paid), builds the index offline (search.rebuild), then
+times search.search() for rare, common, multi-word and prefix queries, with
+and without the expert filters (categories + paid), and page 2. Also
+reports what the index triggers add to one append.
+
+    python bench/search_bench.py [--messages 1000000] [--per-chat 20] [--runs 20]
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CATEGORIES = ['tech', 'legal', 'medical', 'auto', 'finance', 'home', 'pets', 'other']
+PHRASES = ["printer shows offline", "blue screen after update", "car makes grinding noise", "refund for the charge",
+           "router keeps dropping wifi", "landlord kept the deposit", "dog stopped eating", "leaking kitchen faucet"]
+SCHEMA = (
+    "CREATE TABLE chats (user_id TEXT PRIMARY KEY, history TEXT, paid BOOLEAN, category TEXT, updated_at DATETIME)",
+    "CREATE TABLE messages (user_id TEXT NOT NULL, seq INTEGER NOT NULL, sender TEXT NOT NULL, "
+    "text TEXT, created_at DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (user_id, seq))",
+)
+QUERIES = [
+    ('rare word', 'w4999'),
+    ('common word', 'w1'),
+    ('phrase words', 'printer offline'),
+    ('prefix', 'rout*'),
+    ('no match', 'zzzz'),
+]
+
+
+def synthetic_messages(count, per_chat, rng):
+    vocab = [f"w{i}" for i in range(5000)]
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(len(vocab))))
+    for n in range(count):
+        user_id = f"user{n // per_chat}"
+        words = rng.choices(vocab, cum_weights=cum_weights, k=rng.randint(8, 30))
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words)), rng.choice(PHRASES))
+        yield user_id, n % per_chat + 1, 'user' if n % 2 == 0 else 'bot', ' '.join(words)
+
+
+def timed(fn, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return result, statistics.median(times) * 1000, times[int(len(times) * 0.95) - 1] * 1000
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--messages', type=int, default=1_000_000)
+    p.add_argument('--per-chat', type=int, default=20)
+    p.add_argument('--runs', type=int, default=20)
+    args = p.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='search_')
+    os.environ['DB_FILE'] = os.path.join(workdir, 'search.db')
+    import db
+    import search
+
+    rng = random.Random(7)
+    chats = args.messages // args.per_chat
+    db.run(lambda conn: [conn.execute(sql) for sql in SCHEMA])
+    db.run(lambda conn: conn.executemany(
+        "INSERT INTO chats (user_id, paid, category, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+        [(f"user{i}", i % 2, CATEGORIES[i % len(CATEGORIES)]) for i in range(chats)]))
+
+    insert = "INSERT INTO messages (user_id, seq, sender, text) VALUES (?, ?, ?, ?)"
+    start = time.perf_counter()
+    rows = synthetic_messages(args.messages, args.per_chat, rng)
+    while True:
+        batch = [row for _, row in zip(range(50000), rows)]
+        if not batch:
+            break
+        db.run(lambda conn: conn.executemany(insert, batch))
+    print(f"loaded {args.messages} messages in {chats} chats in {time.perf_counter() - start:.1f}s")
+
+    # One append per transaction, as append_message does, into chats past the loaded ones
+    sample = [(f"new{i}", 1, 'user', row[3]) for i, row in
+              enumerate(synthetic_messages(5000, args.per_chat, random.Random(1)))]
+
+    def appends(label):
+        start = time.perf_counter()
+        for row in sample:
+            db.run(lambda conn: conn.execute(insert, row))
+        print(f"append {label:15} {(time.perf_counter() - start) / len(sample) * 1e6:8.1f} us/message")
+        db.run(lambda conn: conn.execute("DELETE FROM messages WHERE user_id LIKE 'new%'"))
+
+    appends('without index')
+    start = time.perf_counter()
+    db.run(search.rebuild)
+    print(f"offline rebuild: {time.perf_counter() - start:.1f}s "
+          f"(DB {os.path.getsize(os.environ['DB_FILE']) / 2 ** 20:.0f} MB)")
+    appends('with FTS index')
+
+    print(f"\n{'query':14} {'filter':8} {'chats':>6} {'p50 ms':>8} {'p95 ms':>8}")
+    for label, query in QUERIES:
+        for filt, kwargs in (('none', {}), ('expert', {'categories': ['tech', 'home'], 'paid': True})):
+            (results, _), p50, p95 = timed(lambda: search.search(query, **kwargs), args.runs)
+            print(f"{label:14} {filt:8} {len(results):6} {p50:8.1f} {p95:8.1f}")
+    (results, _), p50, p95 = timed(lambda: search.search('printer offline', offset=search.SEARCH_PAGE), args.runs)
+    print(f"{'page 2':14} {'none':8} {len(results):6} {p50:8.1f} {p95:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
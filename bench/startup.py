@@ -0,0 +1,108 @@
+"""
+Worker cold-start time: how long `import server` takes before the app can serve.
+
+Each run is a fresh interpreter. genai.list_models() is replaced by a stub
+that sleeps --list-models-latency seconds (the real call is a network round
+trip over the whole catalogue) and counts how often it was called before
+import finished. Scenarios:
+
+    fresh      new DB file (all migrations run), no model cache
+    warm       migrated DB, fresh model cache on disk
+    pinned     migrated DB, GEMINI_MODEL set
+
+    python bench/startup.py [--runs 5] [--list-models-latency 1.0]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import time
+start = time.perf_counter()
+import eventlet
+eventlet.monkey_patch()
+from eventlet import patcher
+import google.generativeai as genai
+from types import SimpleNamespace
+
+calls = []
+def list_models(*args, **kwargs):
+    calls.append(time.perf_counter())
+    patcher.original('time').sleep(LATENCY)
+    return [SimpleNamespace(name='models/gemini-1.5-flash', supported_generation_methods=['generateContent'])]
+genai.list_models = list_models
+
+import sys
+sys.path.insert(0, ROOT)
+import server
+imported = time.perf_counter()
+eventlet.sleep(LATENCY + 0.5)   # let background discovery finish and write the cache
+print(json.dumps({'import_seconds': imported - start,
+                  'list_models_before_ready': sum(1 for t in calls if t < imported),
+                  'list_models_total': len(calls),
+                  'model': server.model.model_name}))
+"""
+
+
+def run_child(latency, env):
+    code = f"import json\nLATENCY = {latency!r}\nROOT = {ROOT!r}\n" + CHILD
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+    for line in reversed(out.stdout.splitlines()):
+        if line.startswith('{'):
+            return json.loads(line)
+    raise RuntimeError(out.stderr[-2000:])
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--runs', type=int, default=5)
+    p.add_argument('--list-models-latency', type=float, default=1.0)
+    args = p.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='startup_')
+    base = dict(os.environ, GOOGLE_API_KEY='bench', PYTHONWARNINGS='ignore',
+                DB_FILE=os.path.join(workdir, 'chat.db'), MODEL_CACHE_FILE=os.path.join(workdir, 'model.json'))
+    for key in ('GEMINI_MODEL', 'FIREBASE_CREDENTIALS', 'REDIS_URL'):
+        base.pop(key, None)
+
+    def reset():
+        shutil.rmtree(workdir)
+        os.makedirs(workdir)
+
+    scenarios = {}
+    results = []
+    for _ in range(args.runs):
+        reset()
+        results.append(run_child(args.list_models_latency, base))
+    scenarios['fresh'] = results
+
+    results = []
+    for _ in range(args.runs):   # the fresh runs left a migrated DB and a cache behind
+        results.append(run_child(args.list_models_latency, base))
+    scenarios['warm'] = results
+
+    results = []
+    if os.path.exists(base['MODEL_CACHE_FILE']):
+        os.remove(base['MODEL_CACHE_FILE'])
+    for _ in range(args.runs):
+        results.append(run_child(args.list_models_latency, dict(base, GEMINI_MODEL='gemini-1.5-flash')))
+    scenarios['pinned'] = results
+    shutil.rmtree(workdir)
+
+    print(f"list_models() stub latency {args.list_models_latency}s, {args.runs} runs each")
+    print(f"{'scenario':10} {'median import s':>16} {'max s':>8} {'list_models before ready':>26} {'total':>6}")
+    for name, rs in scenarios.items():
+        times = [r['import_seconds'] for r in rs]
+        print(f"{name:10} {statistics.median(times):16.3f} {max(times):8.3f} "
+              f"{max(r['list_models_before_ready'] for r in rs):26} {max(r['list_models_total'] for r in rs):6}")
+
+
+if __name__ == '__main__':
+    main()
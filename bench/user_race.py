@@ -0,0 +1,174 @@
+"""
+Stress check for per-user serialization: interleaved events must not lose updates.
+
+Each simulated customer fires its whole conversation back to back without
+waiting for replies, the way a flaky client or a double-click does:
+intake messages, the one that triggers payment, mark_paid immediately after
+it, expert-mode messages, an appointment request, while an expert sends
+agent messages into the same chat. Socket.IO runs every event in its own
+greenlet, so without serialization these overlap. The stub Gemini model
+(blocking, jittered latency, in llm's tpool like the real client) records
+the conversation it was given, and afterwards the check verifies per user:
+
+    stored      every message sent is stored exactly once
+    context     each LLM call saw all of the user's earlier messages
+    pairing     every reply directly follows the message it answers
+    paid        chats.paid is still 1 (not rewritten by a stale read)
+
+Runs in-process with Flask-SocketIO test clients (one greenlet per event,
+like python-socketio's async_handlers) against a throwaway DB.
+--unlocked swaps server.user_locks for a no-op to show what it prevents.
+
+    python bench/user_race.py [--users 200] [--messages 10] [--unlocked]
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+from eventlet import patcher
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+blocking_sleep = patcher.original('time').sleep
+TRIGGER = "ACTION_TRIGGER_PAYMENT"
+
+
+def _stub_model(seen, latency):
+    import google.generativeai as genai
+    from google.generativeai import protos
+    from google.generativeai.types import generation_types
+
+    class StubModel(genai.GenerativeModel):
+        def __init__(self):
+            super().__init__('bench-stub')
+
+        def generate_content(self, contents, stream=False, **kwargs):
+            if isinstance(contents, str):   # classifier / summary prompts
+                text = "tech"
+            else:
+                texts = [c.parts[0].text for c in contents if c.role == 'user']
+                msg = texts[-1]
+                seen[msg] = texts[:-1]
+                text = f"re: {msg}" + (f" {TRIGGER}" if msg.endswith(" pay") else "")
+            blocking_sleep(random.uniform(0, latency))
+            return generation_types.GenerateContentResponse.from_response(protos.GenerateContentResponse(
+                candidates=[protos.Candidate(content=protos.Content(role='model', parts=[protos.Part(text=text)]),
+                                             finish_reason=1)]))
+
+    return StubModel()
+
+
+class _NoLock:
+    def hold(self, key):
+        return contextlib.nullcontext()
+
+    def stats(self):
+        return {'keys': 0, 'queued': 0, 'waits': 0}
+
+
+def user_script(user_id, messages, agent_messages):
+    """(event, data) in send order, plus the user's own message texts in order."""
+    pay_at = messages // 2 - 1
+    texts = [f"{user_id} m{i}" + (" pay" if i == pay_at else "") for i in range(messages)]
+    events = []
+    for i, text in enumerate(texts):
+        events.append(('user_message', {'user_id': user_id, 'message': text, 'pacing': False}))
+        if i == pay_at:
+            events.append(('mark_paid', {'user_id': user_id}))
+    for j in range(agent_messages):
+        # the expert types into the chat while the customer is still sending
+        events.insert(2 + 3 * j, ('agent_message', {'to_user': user_id, 'message': f"{user_id} agent {j}"}))
+    events.append(('appointment_request', {'user_id': user_id, 'details': {'full_name': user_id}}))
+    return events, texts
+
+
+def check_user(server, user_id, texts, agent_messages, seen):
+    problems = []
+    rows = server.db.query("SELECT sender, text FROM messages WHERE user_id=? ORDER BY seq", (user_id,))
+    stored = [text for _, text in rows]
+    for text in texts + [f"{user_id} agent {j}" for j in range(agent_messages)]:
+        if stored.count(text) != 1:
+            problems.append(('stored', text, stored.count(text)))
+    for i, text in enumerate(texts):
+        if seen.get(text) != texts[:i]:
+            problems.append(('context', text, len(seen.get(text) or ()), i))
+    convo = [(s, t) for s, t in rows if s == 'user' or (s == 'bot' and t.startswith('re: '))]
+    for k, (sender, text) in enumerate(convo):
+        if sender == 'user' and (k + 1 >= len(convo) or convo[k + 1] != ('bot', f"re: {text}")):
+            problems.append(('pairing', text))
+    paid = server.db.query_one("SELECT paid FROM chats WHERE user_id=?", (user_id,))
+    if not paid or not paid[0]:
+        problems.append(('paid', paid))
+    return problems
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--users', type=int, default=200)
+    p.add_argument('--messages', type=int, default=10, help="customer messages per user (half intake, half expert)")
+    p.add_argument('--agent-messages', type=int, default=3)
+    p.add_argument('--llm-latency', type=float, default=0.05, help="max stub latency per call, seconds")
+    p.add_argument('--unlocked', action='store_true', help="disable server.user_locks")
+    args = p.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='user_race_')
+    os.environ.update(DB_FILE=os.path.join(workdir, 'race.db'), REPLY_PACING='off', GEMINI_MODEL='bench-stub',
+                      MODEL_CACHE_FILE=os.path.join(workdir, 'model.json'), ADMIN_PASSWORD='bench-admin')
+    for key in ('GOOGLE_API_KEY', 'FIREBASE_CREDENTIALS', 'REDIS_URL'):
+        os.environ.pop(key, None)
+
+    import server
+    seen = {}
+    server.model = server.expert_model = server.summary_model = _stub_model(seen, args.llm_latency)
+    if args.unlocked:
+        server.user_locks = _NoLock()
+
+    app, sio = server.app, server.socketio
+    expert = sio.test_client(app)
+    scripts = {}
+    start = time.monotonic()
+
+    def run_user(n):
+        user_id = f"race{n}"
+        events, texts = user_script(user_id, args.messages, args.agent_messages)
+        scripts[user_id] = texts
+        client = sio.test_client(app)
+        client.emit('register', {'user_id': user_id})
+        # The test client runs handlers inline; give each event its own greenlet as the server does
+        handlers = [eventlet.spawn((expert if event == 'agent_message' else client).emit, event, data)
+                    for event, data in events]
+        for gt in handlers:
+            gt.wait()
+
+    pool = eventlet.GreenPool(args.users)
+    for n in range(args.users):
+        pool.spawn_n(run_user, n)
+    pool.waitall()
+    elapsed = time.monotonic() - start
+
+    failures = {}
+    broken_users = 0
+    for user_id, texts in scripts.items():
+        problems = check_user(server, user_id, texts, args.agent_messages, seen)
+        broken_users += bool(problems)
+        for problem in problems:
+            failures[problem[0]] = failures.get(problem[0], 0) + 1
+
+    print(f"{'unlocked' if args.unlocked else 'user_locks'}: {args.users} users x "
+          f"{args.messages + args.agent_messages + 2} interleaved events in {elapsed:.2f}s, "
+          f"lock waits {server.user_locks.stats()['waits']}")
+    print(f"users with lost/misordered updates: {broken_users}/{args.users}  "
+          + ("  ".join(f"{k}={v}" for k, v in sorted(failures.items())) or "(none)"))
+    sys.exit(1 if broken_users else 0)
+
+
+if __name__ == '__main__':
+    main()
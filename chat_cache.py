@@ -0,0 +1,139 @@
+"""
+Read-through LRU cache of decoded chat state (paid, category, history).
+
+Every hit is validated against SQLite with one primary-key probe: the chat
+row's paid/category plus the first and last message seq. The message log is
+append-only, so a moved last seq means only the new rows are fetched. A
+changed first seq (messages removed) or a shorter log reloads the chat. That
+keeps several workers sharing one DB file correct without a shared
+invalidation channel, and saves the full transcript read on every event.
+Archived chats (see archive) are decompressed on a miss and validated by
+their archived seq range.
+
+save_category / append_message write through on this worker, so its own turns
+never need the catch-up read. Entries are evicted least recently used first,
+after CHAT_CACHE_TTL_SECONDS idle, and when over CHAT_CACHE_MAX_ENTRIES or
+CHAT_CACHE_MAX_BYTES of message text (see lru).
+"""
+import os
+import time
+
+import archive
+import db
+import lru
+
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "5000"))
+CHAT_CACHE_MAX_BYTES = int(os.getenv("CHAT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CHAT_CACHE_TTL_SECONDS = float(os.getenv("CHAT_CACHE_TTL_SECONDS", "900"))
+
+
+class _Chat:
+    __slots__ = ('paid', 'category', 'history', 'first_seq', 'last_seq', 'nbytes', 'last_used')
+
+    def __init__(self, paid, category, history, first_seq, last_seq):
+        self.paid = paid
+        self.category = category
+        self.history = history        # [{'sender', 'text'}], shared read-only with callers
+        self.first_seq = first_seq    # seq range the history covers (0, 0 when empty)
+        self.last_seq = last_seq
+        self.nbytes = lru.text_size(history)
+        self.last_used = time.monotonic()
+
+
+def _probe(conn, user_id):
+    return conn.execute("SELECT paid, category, (SELECT MIN(seq) FROM messages WHERE user_id=?), "
+                        "(SELECT MAX(seq) FROM messages WHERE user_id=?) FROM chats WHERE user_id=?",
+                        (user_id, user_id, user_id)).fetchone()
+
+
+def _messages(conn, user_id, after_seq):
+    rows = conn.execute("SELECT sender, text FROM messages WHERE user_id=? AND seq > ? ORDER BY seq",
+                        (user_id, after_seq)).fetchall()
+    return [{'sender': r[0], 'text': r[1]} for r in rows]
+
+
+def _load_chat(conn, user_id, seqs):
+    """
+    (probe row, (first_seq, last_seq), new messages, reload?) given the cached
+    (first_seq, last_seq) or None.
+    """
+    row = _probe(conn, user_id)
+    if not row:
+        return None, (0, 0), [], True
+    if row[2] is None:
+        archived = archive.archived_range(conn, user_id)
+        if archived:
+            # Cold chat: its messages sit compressed in chat_archive until the next append
+            if seqs == tuple(archived):
+                return row, seqs, [], False
+            return row, tuple(archived), [{'sender': r[1], 'text': r[2]} for r in archive.load(conn, user_id)], True
+    current = (row[2] or 0, row[3] or 0)
+    if seqs is not None and seqs[0] == current[0] and seqs[1] <= current[1]:
+        if seqs[1] == current[1]:
+            return row, current, [], False
+        return row, current, _messages(conn, user_id, seqs[1]), False
+    return row, current, _messages(conn, user_id, 0), True
+
+
+class ChatCache(lru.LRUCache):
+    """user_id -> _Chat."""
+
+    def __init__(self, max_entries=CHAT_CACHE_MAX_ENTRIES, max_bytes=CHAT_CACHE_MAX_BYTES,
+                 ttl=CHAT_CACHE_TTL_SECONDS):
+        super().__init__(max_entries, max_bytes, ttl)
+        self.partial = 0       # hits that fetched only newer messages
+
+    def get(self, user_id):
+        """{'history', 'paid', 'category'} with a fresh history list the caller may append to."""
+        cached = self._entries.get(user_id)
+        seqs = (cached.first_seq, cached.last_seq) if cached else None
+        row, (first_seq, last_seq), new, reload = db.run(_load_chat, user_id, seqs, op='load_chat')
+        if not reload and (self._entries.get(user_id) is not cached or (cached.first_seq, cached.last_seq) != seqs):
+            # Written through or evicted while we were reading: start over (rare)
+            row, (first_seq, last_seq), new, reload = db.run(_load_chat, user_id, None, op='load_chat')
+        if row is None:
+            self._drop(user_id)
+            return {'history': [], 'paid': False, 'category': None}
+        if reload:
+            self.misses += 1
+            entry = _Chat(bool(row[0]), row[1], new, first_seq, last_seq)
+            self._put(user_id, entry)
+        else:
+            self.hits += 1
+            entry = cached
+            entry.paid, entry.category = bool(row[0]), row[1]
+            self._touch(user_id, entry)
+            if new:
+                self.partial += 1
+                self._append(user_id, entry, new, last_seq)
+        return {'history': list(entry.history), 'paid': entry.paid, 'category': entry.category}
+
+    def _append(self, user_id, entry, messages, last_seq):
+        entry.history.extend(messages)
+        entry.last_seq = last_seq
+        self._grow(entry, lru.text_size(messages))
+
+    # ---- write-through ----
+    def categorized(self, user_id, category):
+        entry = self._entries.get(user_id)
+        if entry:
+            entry.category = category
+
+    def appended(self, user_id, seq, sender, text):
+        """Message `seq` was stored; extend the entry, or drop it if another writer got in between."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        if entry.last_seq != seq - 1:
+            self._drop(user_id)
+            return
+        if not entry.first_seq:
+            entry.first_seq = seq
+        self._append(user_id, entry, [{'sender': sender, 'text': text}], seq)
+
+    def invalidate(self, user_id):
+        self._drop(user_id)
+
+    def stats(self):
+        return {**super().stats(), 'partial': self.partial, 'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes}
@@ -0,0 +1,182 @@
+"""
+Expert category classifier.
+
+A small TF-IDF nearest-centroid model runs locally; the LLM is only asked when
+the local model isn't confident. The model starts from hand-written keyword
+seeds and is retrained from chats that already have a category.
+"""
+import math
+import os
+import re
+import time
+from collections import Counter, OrderedDict
+
+import archive
+import db
+
+CATEGORIES = (
+    "medical", "legal", "automotive", "veterinary", "plumbing", "electrical", "tech", "tax",
+    "relationships", "appliance-repair", "hvac", "construction", "business", "real-estate",
+    "finance", "psychology", "education", "fitness", "nutrition", "other",
+)
+
+CONFIDENCE_THRESHOLD = float(os.getenv("CLASSIFIER_CONFIDENCE", "0.65"))
+TRAINING_LIMIT = int(os.getenv("CLASSIFIER_TRAINING_CHATS", "5000"))
+MEMO_SIZE = 10000
+
+# Seed vocabulary so the model is useful before any chat has been classified.
+SEED_KEYWORDS = {
+    "medical": "doctor pain symptoms fever rash medication prescription blood pressure headache injury infection hospital dose",
+    "legal": "lawyer attorney lawsuit court contract sue custody divorce lease eviction rights police ticket visa immigration",
+    "automotive": "car engine brake transmission tire battery mechanic oil check engine light vehicle truck starter mileage",
+    "veterinary": "dog cat puppy kitten pet vet vomiting fur paw bird horse rabbit litter",
+    "plumbing": "leak pipe toilet drain clog faucet sink water heater sewer shower pressure plumber",
+    "electrical": "outlet breaker wiring circuit switch fuse electrician voltage socket panel sparks power outage",
+    "tech": "computer laptop phone wifi router windows mac iphone android error software app install password email printer crash",
+    "tax": "tax irs return refund deduction w2 1099 audit filing vat withholding",
+    "relationships": "boyfriend girlfriend husband wife partner marriage dating breakup cheating relationship family",
+    "appliance-repair": "washer dryer dishwasher fridge refrigerator oven microwave freezer appliance stove ice maker",
+    "hvac": "furnace air conditioner ac heating cooling thermostat hvac heat pump duct vent boiler",
+    "construction": "roof wall foundation drywall contractor renovation concrete deck framing permit crack remodel",
+    "business": "startup company llc marketing customers employees sales business plan invoice supplier",
+    "real-estate": "house mortgage realtor buying selling property landlord tenant closing appraisal listing rent",
+    "finance": "loan credit debt investment stocks bank savings retirement budget credit card interest crypto",
+    "psychology": "anxiety depression stress panic therapy therapist mental health sleep trauma lonely",
+    "education": "school college university homework exam study teacher course student math essay",
+    "fitness": "workout gym exercise muscle weight training running cardio strength",
+    "nutrition": "diet calories protein meal vitamins keto vegan eating food weight loss",
+    "other": "",
+}
+
+_WORD = re.compile(r"[a-z0-9']{2,}")
+_STOPWORDS = frozenset(
+    "the and for are but not you your with have this that was what when where which who why how can could "
+    "would should there their them they its it's i'm im my me our out get got just like from about into "
+    "been has had will all any some yes no hi hello thanks thank please ok okay".split()
+)
+
+
+def tokenize(text):
+    return [w for w in _WORD.findall((text or "").lower()) if w not in _STOPWORDS]
+
+
+def customer_text(history):
+    """The classifier only looks at what the customer wrote."""
+    return "\n".join(m.get('text') or '' for m in history if m.get('sender') == 'user')
+
+
+class CategoryClassifier:
+    """
+    classify(history) -> (category, confidence, source); source is
+    'local', 'llm' or 'memo'. llm_fallback(history) -> category is called
+    when local confidence < threshold.
+    """
+
+    def __init__(self, llm_fallback=None, threshold=CONFIDENCE_THRESHOLD):
+        self.llm_fallback = llm_fallback
+        self.threshold = threshold
+        self._idf = {}
+        self._centroids = {}   # category -> {term: weight}, L2-normalized
+        self._memo = OrderedDict()
+        self.trained_on = 0
+        self.counts = Counter()
+        self.fit([])
+
+    # ---- model ----
+    def fit(self, examples):
+        """examples: iterable of (text, category). Seed keywords are always included."""
+        docs = [(tokenize(kw), cat) for cat, kw in SEED_KEYWORDS.items() if kw]
+        docs += [(tokenize(text), cat) for text, cat in examples if cat in CATEGORIES]
+        df = Counter()
+        for tokens, _ in docs:
+            df.update(set(tokens))
+        n = len(docs)
+        idf = {t: math.log((1 + n) / (1 + c)) + 1.0 for t, c in df.items()}
+
+        sums = {}
+        for tokens, cat in docs:
+            vec = self._vector(tokens, idf)
+            acc = sums.setdefault(cat, Counter())
+            for t, w in vec.items():
+                acc[t] += w
+        self._idf = idf
+        self._centroids = {cat: _normalize(acc) for cat, acc in sums.items()}
+        self._memo.clear()
+        self.trained_on = n - sum(1 for kw in SEED_KEYWORDS.values() if kw)
+
+    def _vector(self, tokens, idf=None):
+        idf = self._idf if idf is None else idf
+        tf = Counter(t for t in tokens if t in idf)
+        return _normalize({t: (1 + math.log(c)) * idf[t] for t, c in tf.items()})
+
+    def predict(self, text):
+        """Local model only: (category, confidence in [0, 1])."""
+        vec = self._vector(tokenize(text))
+        if not vec:
+            return "other", 0.0
+        scores = sorted(
+            ((sum(w * centroid.get(t, 0.0) for t, w in vec.items()), cat) for cat, centroid in self._centroids.items()),
+            reverse=True,
+        )
+        best, cat = scores[0]
+        second = scores[1][0] if len(scores) > 1 else 0.0
+        if best <= 0:
+            return "other", 0.0
+        # How clearly the winner beats the runner-up, scaled by absolute similarity
+        confidence = (best / (best + second)) * min(1.0, best / 0.15)
+        return cat, round(confidence, 4)
+
+    # ---- runtime ----
+    def classify(self, history):
+        text = customer_text(history)
+        key = hash(text)
+        hit = self._memo.get(key)
+        if hit:
+            self._memo.move_to_end(key)
+            self.counts['memo'] += 1
+            return hit[0], hit[1], 'memo'
+
+        category, confidence = self.predict(text)
+        source = 'local'
+        if confidence < self.threshold and self.llm_fallback:
+            category = self.llm_fallback(history)
+            source = 'llm'
+        self.counts[source] += 1
+
+        self._memo[key] = (category, confidence)
+        if len(self._memo) > MEMO_SIZE:
+            self._memo.popitem(last=False)
+        return category, confidence, source
+
+    def train_from_db(self, limit=TRAINING_LIMIT):
+        start = time.monotonic()
+        examples = load_training_examples(limit)
+        self.fit(examples)
+        print(f"[CLASSIFIER] trained on {len(examples)} chats in {time.monotonic() - start:.2f}s")
+
+    def stats(self):
+        return {'trained_on': self.trained_on, 'threshold': self.threshold, **self.counts}
+
+
+def load_training_examples(limit=TRAINING_LIMIT):
+    """(customer text, category) for the most recent classified chats."""
+    def _load(conn):
+        users = conn.execute(
+            "SELECT user_id, category FROM chats WHERE category IS NOT NULL AND category != 'other' "
+            "ORDER BY rowid DESC LIMIT ?", (limit,)).fetchall()
+        texts = {}
+        for user_id, _ in users:
+            rows = conn.execute("SELECT text FROM messages WHERE user_id=? AND sender='user' ORDER BY seq",
+                                (user_id,)).fetchall()
+            if not rows:
+                rows = [(r[2],) for r in archive.load(conn, user_id) or () if r[1] == 'user']
+            texts[user_id] = "\n".join(r[0] or '' for r in rows)
+        return [(texts[u], cat) for u, cat in users if texts.get(u)]
+    return db.run(_load)
+
+
+def _normalize(vec):
+    norm = math.sqrt(sum(w * w for w in vec.values()))
+    if not norm:
+        return {}
+    return {t: w / norm for t, w in vec.items()}
@@ -0,0 +1,104 @@
+"""
+Keeps the prompt sent to Gemini inside a per-model token budget.
+
+When a live session grows past its budget, everything but the most recent
+stored messages is folded into a running summary (persisted in chat_summaries,
+so a rebuilt session reuses it instead of summarizing again) and the session
+history becomes: summary turn + recent turns.
+"""
+import os
+
+import db
+
+CHARS_PER_TOKEN = 4
+INTAKE_CONTEXT_TOKENS = int(os.getenv("INTAKE_CONTEXT_TOKENS", "4000"))
+EXPERT_CONTEXT_TOKENS = int(os.getenv("EXPERT_CONTEXT_TOKENS", "6000"))
+KEEP_RECENT_MESSAGES = int(os.getenv("CONTEXT_KEEP_RECENT_MESSAGES", "8"))
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARY_ACK = "Understood, I have the earlier context."
+
+
+# Bot-sent entries that are UI, not conversation (built in server.py)
+APPOINTMENT_FORM_MARKER = "<form id='ava-appointment-form'"
+APPOINTMENT_NOTE_PREFIX = "Appointment requested: "
+
+
+def is_conversational(msg):
+    """False for the bot's appointment form HTML and request notes; customer text always counts."""
+    if msg.get('sender') != 'bot':
+        return True
+    text = msg.get('text') or ''
+    return not (text.startswith(APPOINTMENT_NOTE_PREFIX) or APPOINTMENT_FORM_MARKER in text)
+
+
+def estimate_tokens(contents, extra_text=""):
+    chars = len(extra_text or "")
+    for c in contents:
+        for part in c.parts:
+            chars += len(part.text)
+    return chars // CHARS_PER_TOKEN
+
+
+def summary_turns(summary):
+    return [
+        {'role': 'user', 'parts': [SUMMARY_PREFIX + summary]},
+        {'role': 'model', 'parts': [SUMMARY_ACK]},
+    ]
+
+
+def load_summary(user_id, mode):
+    row = db.query_one("SELECT covered, summary FROM chat_summaries WHERE user_id=? AND mode=?", (user_id, mode))
+    return (row[1], row[0]) if row else ("", 0)
+
+
+def save_summary(user_id, mode, summary, covered):
+    db.execute("INSERT INTO chat_summaries (user_id, mode, covered, summary) VALUES (?, ?, ?, ?) "
+               "ON CONFLICT(user_id, mode) DO UPDATE SET covered=excluded.covered, summary=excluded.summary",
+               (user_id, mode, covered, summary))
+
+
+class ContextWindow:
+    """
+    budget: max estimated prompt tokens for one model.
+    summarize(previous_summary, messages) -> new summary text (an LLM call).
+    """
+
+    def __init__(self, mode, budget, summarize, keep_recent=KEEP_RECENT_MESSAGES):
+        self.mode = mode
+        self.budget = budget
+        self.summarize = summarize
+        self.keep_recent = keep_recent
+
+    def fit(self, session, user_id, history, to_turn, pending_text=""):
+        """
+        Compact session (an llm.SessionCache entry reflecting `history`, the stored
+        messages before this turn) if the next prompt would exceed the budget.
+        Returns the estimated prompt tokens that will be sent.
+        """
+        tokens = estimate_tokens(session.chat.history, pending_text)
+        if tokens <= self.budget:
+            return tokens
+
+        summary, covered = load_summary(user_id, self.mode)
+        fold_to = len(history) - self.keep_recent
+        if fold_to > covered:
+            try:
+                summary = self.summarize(summary, [m for m in history[covered:fold_to] if is_conversational(m)])
+            except Exception as e:
+                # Over budget is better than no reply; try again next turn
+                print(f"[CONTEXT] summarize failed for {user_id}: {e}")
+                return tokens
+            covered = fold_to
+            save_summary(user_id, self.mode, summary, covered)
+        if covered <= session.covered:
+            return tokens
+
+        turns = summary_turns(summary) + [t for t in map(to_turn, history[covered:]) if t]
+        session.chat.history = turns
+        session.nbytes = sum(len(p) for t in turns for p in t['parts'])
+        session.covered = covered
+        session.base = len(session.chat.history)
+        new_tokens = estimate_tokens(session.chat.history, pending_text)
+        print(f"[CONTEXT] {self.mode} {user_id}: folded {covered} messages, ~{tokens} -> ~{new_tokens} tokens")
+        return new_tokens
@@ -0,0 +1,137 @@
+"""
+Crisp REST client.
+
+- One pooled requests.Session (keep-alive, no TLS handshake per call).
+- A global cap on in-flight Crisp requests.
+- Token -> session polling with exponential backoff + full jitter.
+
+push_transcript() blocks while polling; server.py runs it as a background job
+(deduplicated per token_id).
+
+Import after eventlet.monkey_patch() so the semaphore and sleeps are green.
+"""
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+CRISP_API_IDENTIFIER = os.getenv("CRISP_API_IDENTIFIER")
+CRISP_API_KEY = os.getenv("CRISP_API_KEY")
+CRISP_WEBSITE_ID = os.getenv("CRISP_WEBSITE_ID")
+CRISP_API_BASE = os.getenv("CRISP_API_BASE", "https://api.crisp.chat/v1")
+
+CRISP_MAX_CONCURRENCY = int(os.getenv("CRISP_MAX_CONCURRENCY", "8"))
+CRISP_POLL_SECONDS = float(os.getenv("CRISP_POLL_SECONDS", "10"))   # give up binding after this
+CRISP_BACKOFF_BASE = 0.25
+CRISP_BACKOFF_MAX = 2.0
+CRISP_SEND_RETRIES = 3
+REQUEST_TIMEOUT = 10
+
+_http = requests.Session()
+_http.auth = (CRISP_API_IDENTIFIER, CRISP_API_KEY)
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CRISP_MAX_CONCURRENCY)
+_http.mount("https://", _adapter)
+_http.mount("http://", _adapter)
+
+_slots = threading.BoundedSemaphore(CRISP_MAX_CONCURRENCY)
+
+
+def enabled():
+    return all([CRISP_API_IDENTIFIER, CRISP_API_KEY, CRISP_WEBSITE_ID])
+
+
+def backoff_delay(attempt):
+    """Full jitter: uniform(0, min(max, base * 2**attempt))."""
+    return random.uniform(0, min(CRISP_BACKOFF_MAX, CRISP_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _request(method, path, op, **kwargs):
+    try:
+        with _slots, metrics.OUTBOUND_SECONDS.time(service='crisp', op=op):
+            r = _http.request(method, f"{CRISP_API_BASE}{path}", timeout=REQUEST_TIMEOUT, **kwargs)
+        r.raise_for_status()
+    except requests.RequestException:
+        metrics.OUTBOUND_ERRORS.inc(service='crisp', op=op)
+        raise
+    return r
+
+
+def get_session_id_from_token(token_id: str):
+    """
+    Resolve Crisp token_id -> session_id
+    GET /v1/website/{website_id}/visitors/token/{token_id}
+    """
+    payload = _request("GET", f"/website/{CRISP_WEBSITE_ID}/visitors/token/{token_id}", "resolve_token").json()
+
+    data = payload.get("data")
+    # Crisp can return list or dict depending on endpoint behavior / account
+    if isinstance(data, list) and data:
+        return data[0].get("session_id")
+    if isinstance(data, dict):
+        return data.get("session_id")
+    return None
+
+
+def send_message(session_id: str, content: str):
+    """
+    Push a message into Crisp conversation so agents see it in Inbox.
+    POST /v1/website/{website_id}/conversation/{session_id}/message
+    Retries 429/5xx with backoff.
+    """
+    body = {
+        "type": "text",
+        "from": "operator",     # shows as operator-side in inbox
+        "origin": "chat",
+        "content": content
+    }
+    for attempt in range(CRISP_SEND_RETRIES):
+        try:
+            _request("POST", f"/website/{CRISP_WEBSITE_ID}/conversation/{session_id}/message", "send_message",
+                     json=body)
+            return
+        except requests.HTTPError as e:
+            status = e.response.status_code if e.response is not None else 0
+            if (status != 429 and status < 500) or attempt == CRISP_SEND_RETRIES - 1:
+                raise
+        except requests.ConnectionError:
+            if attempt == CRISP_SEND_RETRIES - 1:
+                raise
+        time.sleep(backoff_delay(attempt + 1))
+
+
+def wait_for_session_id(token_id, max_seconds=CRISP_POLL_SECONDS):
+    """Crisp binds token -> session only after the chat widget loads; poll with backoff."""
+    deadline = time.monotonic() + max_seconds
+    attempt = 0
+    while True:
+        try:
+            session_id = get_session_id_from_token(token_id)
+            if session_id:
+                return session_id
+        except requests.HTTPError as e:
+            # 404 = not bound yet; anything else but 429/5xx is a real error
+            status = e.response.status_code if e.response is not None else 0
+            if status not in (404, 429) and status < 500:
+                raise
+        delay = backoff_delay(attempt)
+        if time.monotonic() + delay > deadline:
+            return None
+        time.sleep(delay)
+        attempt += 1
+
+
+def push_transcript(token_id, message):
+    """
+    Wait for token_id to bind to a Crisp session, then post `message` into it.
+    `message` may be a callable, read just before posting.
+    """
+    session_id = wait_for_session_id(token_id)
+    if not session_id:
+        raise RuntimeError(f"No Crisp session bound yet for token={token_id}")
+    send_message(session_id, message() if callable(message) else message)
+    print(f"[CRISP] Transcript pushed. session_id={session_id}, token={token_id}")
@@ -0,0 +1,149 @@
+"""
+SQLite access layer shared by every handler.
+
+- One pool of long-lived connections (no connect/close per socket event).
+- WAL journaling so readers don't block behind writers.
+- Per-connection statement cache (sqlite3 reuses prepared statements by SQL text).
+- busy_timeout + retry with backoff when the database stays locked.
+
+Import this AFTER eventlet.monkey_patch(): queue/threading/time are then green,
+so waiting for a free connection or backing off yields to other greenlets.
+"""
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+DB_FILE = os.getenv("DB_FILE", "/data/chat_data.db")
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+POOL_WAIT_SECONDS = float(os.getenv("DB_POOL_WAIT_SECONDS", "10"))
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+STATEMENT_CACHE_SIZE = 256
+LOCK_RETRIES = 5
+
+# Every connection gets these, in this order. journal_mode=WAL is persistent in
+# the file, the rest are per-connection. auto_vacuum must come first: it only
+# applies to a file with no tables yet (a new database), and switching to WAL
+# already writes the header. Older files are converted once (archive.enable_compaction).
+PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+
+
+class Pool:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT_MS / 1000.0,
+            check_same_thread=False,  # connections may be handed to tpool threads
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=POOL_WAIT_SECONDS)
+        except queue.Empty:
+            raise sqlite3.OperationalError("db pool exhausted")
+
+    def release(self, conn):
+        self._idle.put(conn)
+
+    def stats(self):
+        return {'size': self.size, 'open': self._created, 'idle': self._idle.qsize()}
+
+
+_pool = Pool(DB_FILE, POOL_SIZE)
+
+
+def _is_locked(exc):
+    msg = str(exc).lower()
+    return "locked" in msg or "busy" in msg
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection; commits on success, rolls back on error."""
+    conn = _pool.acquire()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        _pool.release(conn)
+
+
+def run(fn, *args, op=None):
+    """
+    Run fn(conn, *args) as one transaction, retrying while the DB stays locked.
+    Timed under `op` (default: fn's name) in the db_transaction_seconds metric.
+    """
+    op = op or fn.__name__.lstrip('_')
+    start = time.monotonic()
+    try:
+        for attempt in range(LOCK_RETRIES):
+            try:
+                with connection() as conn:
+                    return fn(conn, *args)
+            except sqlite3.OperationalError as e:
+                if not _is_locked(e) or attempt == LOCK_RETRIES - 1:
+                    raise
+                metrics.DB_RETRIES.inc(op=op)
+                time.sleep(min(0.05 * (2 ** attempt), 1.0) * random.uniform(0.5, 1.5))
+    finally:
+        metrics.DB_SECONDS.observe(time.monotonic() - start, op=op)
+
+
+def query(sql, params=(), op='query'):
+    return run(lambda conn: conn.execute(sql, params).fetchall(), op=op)
+
+
+def query_one(sql, params=(), op='query'):
+    return run(lambda conn: conn.execute(sql, params).fetchone(), op=op)
+
+
+def execute(sql, params=(), op='execute'):
+    """Execute one write statement; returns the cursor's rowcount."""
+    return run(lambda conn: conn.execute(sql, params).rowcount, op=op)
+
+
+def pool_stats():
+    return _pool.stats()
@@ -0,0 +1,95 @@
+"""
+Batched, coalescing writes of chat snapshots to Firestore.
+
+put(user_id, doc) buffers a snapshot keyed by user_id; a second put for the
+same user before the flush just replaces the buffered doc. The buffer is
+written as one Firestore batch (set() on chats/{user_id}, so repeats update
+the same document instead of adding new ones) when it reaches max_batch
+documents or `window` seconds after the first buffered put, and on exit.
+
+put() waits for its batch to commit and raises if it failed, so the caller
+(the firebase_sync job) is retried by the job queue.
+
+`client` is anything with firestore.Client's collection()/batch() surface:
+the real client (which honours FIRESTORE_EMULATOR_HOST) or an in-memory fake.
+"""
+import atexit
+import os
+
+import eventlet
+from eventlet import tpool
+from eventlet.event import Event
+
+import metrics
+
+FIREBASE_BATCH_SIZE = min(500, int(os.getenv("FIREBASE_BATCH_SIZE", "100")))   # Firestore caps batches at 500
+FIREBASE_FLUSH_SECONDS = float(os.getenv("FIREBASE_FLUSH_SECONDS", "2.0"))
+
+
+class FirestoreBatcher:
+    def __init__(self, client, collection='chats', max_batch=FIREBASE_BATCH_SIZE, window=FIREBASE_FLUSH_SECONDS):
+        self.client = client
+        self.collection = collection
+        self.max_batch = max_batch
+        self.window = window
+        self._pending = {}   # doc_id -> [doc, Event]
+        self._timer = None
+        self.counts = {'puts': 0, 'coalesced': 0, 'writes': 0, 'batches': 0, 'failed_batches': 0}
+        atexit.register(self.close)
+
+    def put(self, doc_id, doc, wait=True):
+        self.counts['puts'] += 1
+        entry = self._pending.get(doc_id)
+        if entry:
+            entry[0] = doc
+            self.counts['coalesced'] += 1
+        else:
+            entry = self._pending[doc_id] = [doc, Event()]
+        done = entry[1]
+
+        if len(self._pending) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = eventlet.spawn_after(self.window, self.flush)
+        if wait:
+            done.wait()
+
+    def flush(self, blocking=False):
+        """Write everything buffered. blocking=True commits on this thread (shutdown)."""
+        # Take the buffer before cancelling the timer: cancel() yields to the hub,
+        # and puts arriving meanwhile must start the next batch, not grow this one
+        timer, self._timer = self._timer, None
+        items, self._pending = list(self._pending.items()), {}
+        if timer is not None:
+            timer.cancel()
+        if not items:
+            return
+
+        batch = self.client.batch()
+        coll = self.client.collection(self.collection)
+        for doc_id, (doc, _) in items:
+            batch.set(coll.document(doc_id), doc)
+        try:
+            with metrics.OUTBOUND_SECONDS.time(service='firebase', op='batch_commit'):
+                # gRPC isn't green: commit on a real thread so the hub keeps running
+                batch.commit() if blocking else tpool.execute(batch.commit)
+        except Exception as e:
+            self.counts['failed_batches'] += 1
+            metrics.OUTBOUND_ERRORS.inc(service='firebase', op='batch_commit')
+            print(f"[FIREBASE] batch of {len(items)} failed: {e}")
+            for _, (_, done) in items:
+                done.send_exception(e)
+            return
+        self.counts['batches'] += 1
+        self.counts['writes'] += len(items)
+        for _, (_, done) in items:
+            done.send()
+
+    def close(self):
+        try:
+            self.flush(blocking=True)
+        except Exception as e:
+            print(f"[FIREBASE] flush on shutdown failed: {e}")
+
+    def stats(self):
+        return {**self.counts, 'buffered': len(self._pending)}
@@ -0,0 +1,224 @@
+"""
+Durable background jobs stored in SQLite (the `jobs` table).
+
+Side effects (Firebase sync, Crisp pushes, the delayed "Expert Joined"
+announcement) are enqueued here instead of fire-and-forget greenlets, so they
+survive restarts, retry with backoff, dead-letter after max_attempts and never
+run more than their type's concurrency at once.
+
+    jobs.register('firebase_sync', fn, concurrency=2)   # fn(payload: dict)
+    jobs.enqueue('firebase_sync', {'user_id': uid})
+    jobs.enqueue('expert_announce', {...}, delay=10)
+    jobs.start()
+
+Claiming is an UPDATE ... WHERE status='queued', so several workers can share
+one database without running a job twice, and a keyed job is never claimed
+while another job with its key is running. A job left 'running' by a crashed
+process counts as a failed attempt after JOB_LEASE_SECONDS.
+"""
+import json
+import os
+import random
+import socket
+import time
+import traceback
+
+import eventlet
+from eventlet.event import Event
+
+import db
+
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "0.5"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_KEEP_DONE_SECONDS = float(os.getenv("JOB_KEEP_DONE_SECONDS", str(24 * 3600)))
+JOB_BACKOFF_BASE = 2.0
+JOB_BACKOFF_MAX = 300.0
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_handlers = {}   # type -> {'fn', 'pool', 'max_attempts', 'while_running'}
+_wakeup = Event()
+_started = False
+
+
+def register(job_type, fn, concurrency=1, max_attempts=5, while_running='follow'):
+    """
+    while_running: what a keyed enqueue does when a job with that key is running.
+    'follow' queues one follow-up run (for handlers that read current state);
+    'merge' hands the newest payload to the running job instead (see latest_payload).
+    """
+    _handlers[job_type] = {
+        'fn': fn,
+        'pool': eventlet.GreenPool(concurrency),
+        'max_attempts': max_attempts,
+        'while_running': while_running,
+    }
+
+
+def enqueue(job_type, payload, delay=0, key=None, conn=None):
+    """
+    Queue a job to run after `delay` seconds. With `key`, a still-queued job of
+    the same type and key is updated (newest payload wins) instead of adding
+    a duplicate; if one is running, the type's while_running policy applies.
+    With `conn`, the job is written in the caller's transaction and only
+    exists if that commits.
+    """
+    now = time.time()
+    handler = _handlers.get(job_type, {})
+    max_attempts = handler.get('max_attempts', 5)
+    merge = handler.get('while_running') == 'merge'
+    body = json.dumps(payload)
+
+    def _insert(conn):
+        if key is not None:
+            statuses = "('queued', 'running')" if merge else "('queued')"
+            cur = conn.execute(f"UPDATE jobs SET payload=? WHERE type=? AND dedupe_key=? AND status IN {statuses}",
+                               (body, job_type, key))
+            if cur.rowcount:
+                return
+        conn.execute("INSERT INTO jobs (type, payload, dedupe_key, status, attempts, max_attempts, run_at, created_at) "
+                     "VALUES (?, ?, ?, 'queued', 0, ?, ?, ?)",
+                     (job_type, body, key, max_attempts, now + delay, now))
+
+    if conn is not None:
+        _insert(conn)
+    else:
+        db.run(_insert, op='jobs_enqueue')
+    if not delay and not _wakeup.ready():
+        _wakeup.send()
+
+
+def latest_payload(job_type, key):
+    """Payload of the running `job_type` job with `key`, including merged enqueues, or None."""
+    row = db.query_one("SELECT payload FROM jobs WHERE type=? AND dedupe_key=? AND status='running'",
+                       (job_type, key), op='jobs_latest')
+    return json.loads(row[0]) if row else None
+
+
+def _backoff(attempts):
+    return random.uniform(0.5, 1.0) * min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE ** attempts)
+
+
+def _claim(job_type, limit):
+    def _do(conn):
+        rows = conn.execute("SELECT id, payload, attempts, max_attempts, run_at FROM jobs q "
+                            "WHERE status='queued' AND type=? AND run_at<=? AND (dedupe_key IS NULL OR NOT EXISTS "
+                            "(SELECT 1 FROM jobs r WHERE r.type=q.type AND r.dedupe_key=q.dedupe_key "
+                            "AND r.status='running')) ORDER BY run_at LIMIT ?",
+                            (job_type, time.time(), limit)).fetchall()
+        claimed = []
+        for row in rows:
+            cur = conn.execute("UPDATE jobs SET status='running', locked_by=?, started_at=? "
+                               "WHERE id=? AND status='queued' AND (dedupe_key IS NULL OR NOT EXISTS "
+                               "(SELECT 1 FROM jobs r WHERE r.type=jobs.type AND r.dedupe_key=jobs.dedupe_key "
+                               "AND r.status='running'))", (WORKER_ID, time.time(), row[0]))
+            if cur.rowcount:
+                claimed.append(row)
+        return claimed
+    return db.run(_do, op='jobs_claim')
+
+
+def _run(job_type, job_id, payload, attempts, max_attempts):
+    fn = _handlers[job_type]['fn']
+    try:
+        fn(json.loads(payload))
+    except Exception as e:
+        attempts += 1
+        error = f"{e.__class__.__name__}: {e}"
+        if attempts >= max_attempts:
+            print(f"[JOBS] {job_type}#{job_id} dead after {attempts} attempts: {error}")
+            traceback.print_exc()
+            db.execute("UPDATE jobs SET status='dead', attempts=?, last_error=?, finished_at=? WHERE id=?",
+                       (attempts, error, time.time(), job_id))
+        else:
+            print(f"[JOBS] {job_type}#{job_id} failed (attempt {attempts}/{max_attempts}): {error}")
+            db.execute("UPDATE jobs SET status='queued', attempts=?, last_error=?, run_at=?, locked_by=NULL "
+                       "WHERE id=?", (attempts, error, time.time() + _backoff(attempts), job_id))
+        return
+    db.execute("UPDATE jobs SET status='done', attempts=?, finished_at=? WHERE id=?",
+               (attempts + 1, time.time(), job_id))
+
+
+def _recover():
+    """
+    Requeue jobs whose worker died mid-run, counting the lost run as an
+    attempt (dead once max_attempts is reached, so max_attempts=1 never reruns);
+    prune old finished jobs.
+    """
+    now = time.time()
+
+    def _expire(conn):
+        conn.execute("BEGIN IMMEDIATE")
+        expired = "status='running' AND started_at < ?"
+        error = "'lease expired on ' || COALESCE(locked_by, '?')"
+        dead = conn.execute(f"UPDATE jobs SET status='dead', attempts=attempts + 1, last_error={error}, "
+                            f"finished_at=?, locked_by=NULL WHERE {expired} AND attempts + 1 >= max_attempts",
+                            (now, now - JOB_LEASE_SECONDS)).rowcount
+        conn.execute(f"UPDATE jobs SET status='queued', attempts=attempts + 1, last_error={error}, "
+                     f"locked_by=NULL WHERE {expired}", (now - JOB_LEASE_SECONDS,))
+        return dead
+    dead = db.run(_expire, op='jobs_recover')
+    if dead:
+        print(f"[JOBS] {dead} job(s) dead: lease expired on their last attempt")
+    db.execute("DELETE FROM jobs WHERE status='done' AND finished_at < ?", (now - JOB_KEEP_DONE_SECONDS,))
+
+
+def _dispatch_loop():
+    global _wakeup
+    last_recover = 0.0
+    while True:
+        try:
+            if time.monotonic() - last_recover > 60:
+                _recover()
+                last_recover = time.monotonic()
+            for job_type, h in _handlers.items():
+                free = h['pool'].free()
+                if not free:
+                    continue
+                for job_id, payload, attempts, max_attempts, _ in _claim(job_type, free):
+                    h['pool'].spawn_n(_run, job_type, job_id, payload, attempts, max_attempts)
+        except Exception as e:
+            print(f"[JOBS] dispatcher error: {e}")
+        _wakeup = Event()
+        with eventlet.Timeout(JOB_POLL_SECONDS, False):
+            _wakeup.wait()
+
+
+def start():
+    global _started
+    if _started:
+        return
+    _started = True
+    eventlet.spawn_n(_dispatch_loop)
+
+
+def stats():
+    """Queue depth per type/status and latency over the last hour."""
+    now = time.time()
+
+    def _q(conn):
+        depth = conn.execute("SELECT type, status, COUNT(*) FROM jobs GROUP BY type, status").fetchall()
+        oldest = conn.execute("SELECT type, MIN(run_at) FROM jobs WHERE status='queued' AND run_at<=? GROUP BY type",
+                              (now,)).fetchall()
+        latency = conn.execute("SELECT type, COUNT(*), AVG(started_at - run_at), AVG(finished_at - started_at) "
+                               "FROM jobs WHERE status='done' AND finished_at>=? GROUP BY type",
+                               (now - 3600,)).fetchall()
+        return depth, oldest, latency
+
+    depth, oldest, latency = db.run(_q, op='jobs_stats')
+    out = {}
+    for job_type, status, count in depth:
+        out.setdefault(job_type, {})[status] = count
+    for job_type, run_at in oldest:
+        out.setdefault(job_type, {})['oldest_due_seconds'] = round(now - run_at, 3)
+    for job_type, count, wait, run in latency:
+        out.setdefault(job_type, {}).update(
+            done_last_hour=count, avg_wait_seconds=round(wait or 0, 3), avg_run_seconds=round(run or 0, 3))
+    for job_type, n in running().items():
+        out.setdefault(job_type, {})['running_here'] = n
+    return out
+
+
+def running():
+    """Jobs executing in this process, by type."""
+    return {job_type: h['pool'].running() for job_type, h in _handlers.items()}
@@ -0,0 +1,381 @@
+"""
+Gemini calls run here, in eventlet's native thread pool (tpool), never on the hub.
+
+google-generativeai talks gRPC/HTTP through code monkey_patch() can't make
+cooperative, so calling it from a greenlet freezes every socket on the worker
+until the reply arrives. call() hands the blocking function to a real thread,
+caps how many run at once and gives up waiting after a timeout.
+
+Model discovery (which Gemini model name to use) lives here too: one
+list_models() round-trip, cached on disk, and never on the import path.
+"""
+import json
+import os
+import time
+
+import eventlet
+import google.generativeai as genai
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
+from google.generativeai import protos
+
+import lru
+import metrics
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL")   # pin a model name and skip discovery
+DEFAULT_MODEL = "gemini-1.5-flash"
+MODEL_CACHE_FILE = os.getenv("MODEL_CACHE_FILE", os.path.join(
+    os.path.dirname(os.getenv("DB_FILE", "/data/chat_data.db")), "gemini_model.json"))
+MODEL_CACHE_TTL_SECONDS = float(os.getenv("MODEL_CACHE_TTL_SECONDS", str(24 * 3600)))
+
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "2000"))
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "1800"))
+
+# tpool is lazily started; make sure it has a thread for every LLM slot plus
+# headroom for the other tpool users (Firestore commits, model discovery).
+tpool.set_num_threads(max(int(os.getenv("EVENTLET_THREADPOOL_SIZE", "20")), LLM_MAX_CONCURRENCY + 4))
+
+
+class LLMTimeout(Exception):
+    pass
+
+
+_slots = Semaphore(LLM_MAX_CONCURRENCY)
+_stats = {
+    'waiting': 0,        # queued for a slot
+    'in_flight': 0,      # running in a tpool thread
+    'max_waiting': 0,
+    'completed': 0,
+    'errors': 0,
+    'timeouts': 0,
+    'abandoned': 0,      # timed out while queued; never sent
+    'total_seconds': 0.0,
+    'streams': 0,
+    'ttft_total_seconds': 0.0,   # time to first streamed chunk, summed over streams
+}
+
+
+def _acquire():
+    """Wait for an LLM slot; returns the time spent queued."""
+    _stats['waiting'] += 1
+    _stats['max_waiting'] = max(_stats['max_waiting'], _stats['waiting'])
+    queued = time.monotonic()
+    try:
+        _slots.acquire()
+    finally:
+        _stats['waiting'] -= 1
+    return time.monotonic() - queued
+
+
+def _release(start, fn):
+    elapsed = time.monotonic() - start
+    _stats['in_flight'] -= 1
+    _stats['completed'] += 1
+    _stats['total_seconds'] += elapsed
+    metrics.LLM_SECONDS.observe(elapsed, fn=getattr(fn, '__name__', 'call'))
+    _slots.release()
+
+
+def _run(fn, args, kwargs, cancelled):
+    waited = _acquire()
+    if cancelled:
+        # The caller gave up while this was queued: don't spend a slot or API quota on it
+        _slots.release()
+        _stats['abandoned'] += 1
+        return None
+    _stats['in_flight'] += 1
+    start = time.monotonic()
+    metrics.LLM_WAIT_SECONDS.observe(waited)
+    try:
+        return tpool.execute(fn, *args, **kwargs)
+    except Exception:
+        _stats['errors'] += 1
+        metrics.LLM_ERRORS.inc(kind='error')
+        raise
+    finally:
+        _release(start, fn)
+
+
+def call(fn, *args, timeout=None, **kwargs):
+    """
+    Run fn(*args, **kwargs) in a worker thread and wait for it cooperatively.
+    Raises LLMTimeout if no result within `timeout` seconds (queue wait included).
+    A call that times out while still queued is never sent; one already
+    running keeps its slot until the thread returns, so the concurrency cap
+    stays honest.
+    """
+    seconds = LLM_TIMEOUT_SECONDS if timeout is None else timeout
+    cancelled = []
+    worker = eventlet.spawn(_run, fn, args, kwargs, cancelled)
+    try:
+        with eventlet.Timeout(seconds, LLMTimeout(f"LLM call exceeded {seconds}s")):
+            return worker.wait()
+    except LLMTimeout:
+        cancelled.append(True)
+        _stats['timeouts'] += 1
+        metrics.LLM_ERRORS.inc(kind='timeout')
+        raise
+
+
+def _chunk_text(chunk):
+    try:
+        return chunk.text or ""
+    except ValueError:
+        # chunks with no text part (finish_reason-only, safety) have no .text
+        return ""
+
+
+def _wait(worker, seconds):
+    with eventlet.Timeout(seconds, LLMTimeout(f"LLM read exceeded {seconds:.1f}s")):
+        return worker.wait()
+
+
+def _end_stream(reading, chunks, start, fn):
+    """Release the stream's slot once no read is running in its thread; close the response."""
+    try:
+        if reading is not None:
+            try:
+                reading.wait()
+            except Exception:
+                pass
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
+    finally:
+        _release(start, fn)
+
+
+def stream(fn, *args, timeout=None, **kwargs):
+    """
+    Call fn(*args, stream=True, **kwargs) and yield the text of each chunk as it
+    arrives. The stream holds one slot from the request to its last chunk, so
+    open streams count against LLM_MAX_CONCURRENCY and their reads don't queue
+    behind new calls. Reads run in tpool: `timeout` bounds the queue wait plus
+    the request, then each read. The slot is released when the stream ends,
+    fails or is abandoned (the generator closed); after a read timeout, once
+    that read's thread returns.
+    """
+    seconds = LLM_TIMEOUT_SECONDS if timeout is None else timeout
+    start = time.monotonic()
+    try:
+        with eventlet.Timeout(seconds, LLMTimeout(f"LLM stream waited over {seconds}s for a slot")):
+            waited = _acquire()
+    except LLMTimeout:
+        _stats['abandoned'] += 1
+        _stats['timeouts'] += 1
+        metrics.LLM_ERRORS.inc(kind='timeout')
+        raise
+    metrics.LLM_WAIT_SECONDS.observe(waited)
+    _stats['in_flight'] += 1
+    opened = time.monotonic()
+    reading = chunks = None
+    try:
+        reading = eventlet.spawn(tpool.execute, fn, *args, stream=True, **kwargs)
+        chunks = iter(_wait(reading, max(seconds - waited, 0.001)))
+        first = True
+        while True:
+            reading = eventlet.spawn(tpool.execute, next, chunks, None)
+            chunk = _wait(reading, seconds)
+            reading = None
+            if chunk is None:
+                return
+            if first:
+                first = False
+                ttft = time.monotonic() - start
+                _stats['streams'] += 1
+                _stats['ttft_total_seconds'] += ttft
+                metrics.LLM_TTFT_SECONDS.observe(ttft)
+            text = _chunk_text(chunk)
+            if text:
+                yield text
+    except LLMTimeout:
+        _stats['timeouts'] += 1
+        metrics.LLM_ERRORS.inc(kind='timeout')
+        raise
+    except Exception:
+        _stats['errors'] += 1
+        metrics.LLM_ERRORS.inc(kind='error')
+        raise
+    finally:
+        if reading is not None and not reading.dead:
+            # A timed-out read keeps its thread, and the slot, until it returns
+            eventlet.spawn_n(_end_stream, reading, chunks, opened, fn)
+        else:
+            _end_stream(None, chunks, opened, fn)
+
+
+def split_control_token(text, tokens):
+    """(text without a trailing control token, the token or None); both reply paths use this."""
+    text = (text or "").strip()
+    for token in tokens:
+        if text.endswith(token):
+            return text[:-len(token)].strip(), token
+    return text, None
+
+
+class ControlTokenFilter:
+    """
+    Streams model text while keeping trailing control tokens out of it.
+
+    Any tail that could still turn into one of `tokens` (e.g. "...ACTION_TRIG")
+    is held back until the next chunk proves otherwise, so a token split across
+    chunks never reaches the client. finish() strips a trailing token the same
+    way the non-streaming path does (split_control_token).
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tuple(tokens)
+        self.buf = ""
+        self.sent = 0      # chars of buf already released
+        self.emitted = ""  # released text, leading whitespace stripped
+
+    def _held_tail(self, text):
+        hold = 0
+        for token in self.tokens:
+            for k in range(min(len(token), len(text)), hold, -1):
+                if text.endswith(token[:k]):
+                    hold = k
+                    break
+        return hold
+
+    def feed(self, text):
+        """Add a chunk; returns the part that is safe to show now."""
+        self.buf += text
+        if not self.emitted:
+            self.sent = max(self.sent, len(self.buf) - len(self.buf.lstrip()))
+        body = self.buf.rstrip()
+        body = body[:len(body) - self._held_tail(body)].rstrip()
+        safe = len(body)
+        if safe <= self.sent:
+            return ""
+        out = self.buf[self.sent:safe]
+        self.sent = safe
+        self.emitted += out
+        return out
+
+    def finish(self):
+        """Returns (clean_text, token_or_None, unreleased_text)."""
+        text, found = split_control_token(self.buf, self.tokens)
+        rest = text[len(self.emitted):] if text.startswith(self.emitted) else ""
+        return text, found, rest
+
+
+def pick_model(names):
+    """Prefer a stable flash model (no preview/lite builds)."""
+    for name in names:
+        if 'flash' in name.lower() and 'preview' not in name and 'lite' not in name:
+            return name
+    return names[0] if names else DEFAULT_MODEL
+
+
+def cached_model_name():
+    """(name, fresh) from GEMINI_MODEL or the disk cache; never touches the network."""
+    if GEMINI_MODEL:
+        return GEMINI_MODEL, True
+    try:
+        with open(MODEL_CACHE_FILE) as f:
+            cached = json.load(f)
+        return cached['name'], time.time() - cached['resolved_at'] < MODEL_CACHE_TTL_SECONDS
+    except (OSError, ValueError, KeyError, TypeError):
+        return DEFAULT_MODEL, False
+
+
+def discover_model_name():
+    """Blocking: one list_models() round-trip, result written to the disk cache."""
+    names = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
+    chosen = pick_model(names)
+    tmp = MODEL_CACHE_FILE + ".tmp"
+    try:
+        with open(tmp, 'w') as f:
+            json.dump({'name': chosen, 'resolved_at': time.time()}, f)
+        os.replace(tmp, MODEL_CACHE_FILE)
+    except OSError as e:
+        print(f"[LLM] could not cache model name: {e}")
+    return chosen
+
+
+def stats():
+    s = dict(_stats)
+    s['max_concurrency'] = LLM_MAX_CONCURRENCY
+    s['timeout_seconds'] = LLM_TIMEOUT_SECONDS
+    return s
+
+
+class _Session:
+    __slots__ = ('chat', 'count', 'nbytes', 'base', 'covered', 'last_used')
+
+    def __init__(self, chat, count, nbytes):
+        self.chat = chat          # live ChatSession
+        self.count = count        # stored messages it reflects
+        self.nbytes = nbytes      # approx. text size, for the memory cap
+        self.base = 0             # len(chat.history) when checked out
+        self.covered = 0          # stored messages folded into a summary turn (context_window)
+        self.last_used = time.monotonic()
+
+
+def _content(turn):
+    return protos.Content(role=turn['role'], parts=[protos.Part(text=p) for p in turn['parts']])
+
+
+class SessionCache(lru.LRUCache):
+    """
+    LRU + TTL cache of live ChatSessions (key -> _Session), so a turn only
+    appends to the session instead of rebuilding it from the whole stored history.
+
+    checkout() hands out a session reflecting `history` (catching up on messages
+    other handlers stored since, or rebuilding on a miss). After the turn,
+    commit() puts it back with the messages actually persisted, so the cached
+    session always matches what a rebuild from the DB would produce.
+    """
+
+    def __init__(self, max_entries=SESSION_CACHE_MAX_ENTRIES, max_bytes=SESSION_CACHE_MAX_BYTES,
+                 ttl=SESSION_CACHE_TTL_SECONDS):
+        super().__init__(max_entries, max_bytes, ttl)
+
+    def checkout(self, key, history, to_turn, build):
+        """
+        history: stored messages before this turn; to_turn(msg) -> Gemini turn dict or None;
+        build(turns) -> new ChatSession. The entry is removed until commit().
+        """
+        self._evict()
+        entry = self._drop(key)
+        if entry and entry.count <= len(history):
+            self.hits += 1
+            for msg in history[entry.count:]:
+                turn = to_turn(msg)
+                if turn:
+                    entry.chat.history.append(_content(turn))
+            entry.nbytes += lru.text_size(history[entry.count:])
+            entry.count = len(history)
+        else:
+            self.misses += 1
+            turns = [t for t in map(to_turn, history) if t]
+            entry = _Session(build(turns), len(history), lru.text_size(history))
+        entry.base = len(entry.chat.history)
+        return entry
+
+    def commit(self, key, entry, persisted, to_turn):
+        """
+        Store entry after a successful turn. `persisted` are the messages stored
+        during the turn; they replace the raw sent/received pair in the session.
+        """
+        history = entry.chat.history
+        del history[entry.base:]
+        for msg in persisted:
+            turn = to_turn(msg)
+            if turn:
+                history.append(_content(turn))
+        entry.count += len(persisted)
+        entry.nbytes += lru.text_size(persisted)
+        entry.last_used = time.monotonic()
+        self._put(key, entry)
+
+    def discard(self, key):
+        self._drop(key)
@@ -0,0 +1,73 @@
+"""
+LRU + TTL cache bookkeeping with a byte budget, shared by the in-process caches
+(chat_cache.ChatCache, llm.SessionCache).
+
+LRUCache keeps entries least recently used first and evicts from the front
+while the oldest entry has been idle longer than `ttl` or the cache is over
+max_entries or max_bytes. An entry is any object with `nbytes` (its size
+against the budget) and `last_used` (time.monotonic() of its last use); the
+subclass decides what it caches and how it is loaded.
+"""
+import time
+from collections import OrderedDict
+
+
+def text_size(messages):
+    """Approximate size of [{'text': ...}] messages: the text length, in chars."""
+    return sum(len(m.get('text') or '') for m in messages)
+
+
+class LRUCache:
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> entry, least recently used first
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry.nbytes
+        return entry
+
+    def _put(self, key, entry):
+        """Insert or replace key as the most recently used entry, then evict."""
+        self._drop(key)
+        self._entries[key] = entry
+        self._bytes += entry.nbytes
+        self._evict()
+
+    def _touch(self, key, entry):
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(key)
+
+    def _grow(self, entry, size):
+        """A cached entry grew by `size` bytes."""
+        entry.nbytes += size
+        self._bytes += size
+        self._evict()
+
+    def _evict(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if (entry.last_used >= cutoff and len(self._entries) <= self.max_entries
+                    and self._bytes <= self.max_bytes):
+                break
+            self._drop(key)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
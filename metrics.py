@@ -0,0 +1,156 @@
+"""
+In-process metrics rendered in the Prometheus text format (served at /metrics).
+
+Counters, histograms and callback gauges with labels, kept in plain dicts: an
+observation is a dict lookup and a few additions, cheap enough to leave on
+in production. Values are per worker process, like the rest of the
+in-memory state; scrape every worker.
+
+    DB_SECONDS = metrics.histogram('db_query_seconds', 'SQLite transaction time', ('op',))
+    DB_SECONDS.observe(0.002, op='load_chat')
+    with DB_SECONDS.time(op='save_chat'): ...
+    metrics.gauge('online_experts', 'Experts online', lambda: len(ids()))
+"""
+import time
+from contextlib import contextmanager
+
+PREFIX = "ava_"
+
+# Seconds; covers a 1 ms SQLite read up to a 30 s LLM timeout
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []   # metrics in registration order
+
+
+def _label_key(names, labels):
+    return tuple(str(labels.get(n, '')) for n in names)
+
+
+def _fmt_labels(names, key, extra=()):
+    pairs = [(n, v) for n, v in zip(names, key)] + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join('%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for n, v in pairs)
+    return "{" + body + "}"
+
+
+def _fmt_value(v):
+    if v == float('inf'):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = PREFIX + name, help, tuple(labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labels, labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, v in self._values.items():
+            yield self.name + _fmt_labels(self.labels, key), v
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = PREFIX + name, help, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}   # label key -> [bucket counts..., count, sum]
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labels, labels)
+        row = self._values.get(key)
+        if row is None:
+            row = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[i] += 1
+                break
+        row[-2] += 1
+        row[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        n = len(self.buckets)
+        for key, row in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, row[:n]):
+                cumulative += count
+                yield self.name + "_bucket" + _fmt_labels(self.labels, key, [('le', bound)]), cumulative
+            yield self.name + "_bucket" + _fmt_labels(self.labels, key, [('le', '+Inf')]), row[n]
+            yield self.name + "_count" + _fmt_labels(self.labels, key), row[n]
+            yield self.name + "_sum" + _fmt_labels(self.labels, key), row[n + 1]
+
+
+class Gauge:
+    """Read at scrape time: fn() -> number, or {label value: number} for one label."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, label=None):
+        self.name, self.help, self.fn, self.label = PREFIX + name, help, fn, label
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"[METRICS] gauge {self.name} failed: {e}")
+            return
+        if self.label is None:
+            yield self.name, value
+        else:
+            for k, v in value.items():
+                yield self.name + _fmt_labels((self.label,), (k,)), v
+
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help, labels, buckets))
+
+
+def gauge(name, help, fn, label=None):
+    return _register(Gauge(name, help, fn, label))
+
+
+def render():
+    lines = []
+    for m in _registry:
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        for sample, value in m.samples():
+            lines.append(f"{sample} {_fmt_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# Shared by db.py, llm.py, crisp.py, firebase_sync.py and server.py
+DB_SECONDS = histogram('db_transaction_seconds', "SQLite transaction time by operation", ('op',))
+DB_RETRIES = counter('db_lock_retries_total', "SQLite transactions retried because the DB was locked", ('op',))
+LLM_SECONDS = histogram('llm_call_seconds', "Gemini call time in a worker thread, excluding queueing", ('fn',))
+LLM_WAIT_SECONDS = histogram('llm_queue_wait_seconds', "Time waiting for an LLM concurrency slot")
+LLM_TTFT_SECONDS = histogram('llm_time_to_first_chunk_seconds', "Streaming: time to the first chunk")
+LLM_ERRORS = counter('llm_errors_total', "Gemini calls that raised or timed out", ('kind',))
+LLM_TOKENS = counter('llm_tokens_total', "Tokens reported by Gemini usage metadata", ('mode', 'kind'))
+OUTBOUND_SECONDS = histogram('outbound_request_seconds', "Crisp/Firebase/Stripe request time", ('service', 'op'))
+OUTBOUND_ERRORS = counter('outbound_errors_total', "Failed Crisp/Firebase/Stripe requests", ('service', 'op'))
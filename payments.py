@@ -0,0 +1,186 @@
+"""
+Stripe Checkout: one reusable session per user, paid-once confirmation.
+
+checkout_url() keeps the user's open Checkout Session in `checkout_sessions`
+(keyed by user_id, with Stripe's expires_at) and hands it out again until it
+is about to expire, so double clicks and page reloads don't create new
+sessions. Creation carries an idempotency key per user and reuse window, and
+the session's expiry is derived from the same window, so concurrent requests
+from several workers get the same session back from Stripe too.
+
+The /stripe-webhook route passes signed events to handle_event(). confirm()
+flips chats.paid in one transaction that also records the event id (replays
+are ignored) and enqueues the `payment_confirmed` job, so the notify/sync
+side effects run once, in the background, even when Stripe redelivers or
+the client also sends mark_paid.
+
+Import after eventlet.monkey_patch(): the Stripe client does blocking HTTP.
+"""
+import os
+import time
+
+import stripe
+
+import db
+import jobs
+import metrics
+
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# Stripe accepts expires_at 30 min to 24 h after creation. A session expires 1-2
+# reuse windows plus this margin after creation, so a create at the very end of a
+# window (or a request slowed by latency or clock skew) stays above the minimum
+CHECKOUT_EXPIRY_SAFETY_SECONDS = 600
+CHECKOUT_REUSE_SECONDS = min(max(int(os.getenv("CHECKOUT_REUSE_SECONDS", "1800")), 1800),
+                             12 * 3600 - CHECKOUT_EXPIRY_SAFETY_SECONDS)
+CHECKOUT_EXPIRY_MARGIN_SECONDS = 120   # don't hand out a session the user can't finish
+CHECKOUT_PRICE_CENTS = 500
+STRIPE_TIMEOUT_SECONDS = float(os.getenv("STRIPE_TIMEOUT_SECONDS", "20"))
+
+PAID_EVENTS = ('checkout.session.completed', 'checkout.session.async_payment_succeeded')
+
+# The SDK's default client also builds an httpx async fallback, whose trio import
+# fails under eventlet's monkey patching; requests is green. Creates carry an
+# idempotency key, so the SDK's network retries can't double-create.
+stripe.default_http_client = stripe.RequestsClient(timeout=STRIPE_TIMEOUT_SECONDS)
+stripe.max_network_retries = 2
+
+counts = {'create_calls': 0, 'reused': 0, 'already_paid': 0, 'events': 0, 'replayed_events': 0, 'confirmed': 0,
+          'duplicate_confirmations': 0}
+
+
+def cached_session(conn, user_id, now=None):
+    """(session_id, url) of the user's open session, or None if it's missing or about to expire."""
+    now = time.time() if now is None else now
+    return conn.execute("SELECT session_id, url FROM checkout_sessions WHERE user_id=? AND expires_at>?",
+                        (user_id, now + CHECKOUT_EXPIRY_MARGIN_SECONDS)).fetchone()
+
+
+def _create_session(user_id, success_url, cancel_url, now):
+    window = int(now // CHECKOUT_REUSE_SECONDS)
+    try:
+        with metrics.OUTBOUND_SECONDS.time(service='stripe', op='checkout_create'):
+            return stripe.checkout.Session.create(
+                line_items=[{
+                    'price_data': {
+                        'currency': 'usd',
+                        'product_data': {'name': 'Expert Connection Fee', 'description': 'Fully refundable'},
+                        'unit_amount': CHECKOUT_PRICE_CENTS,
+                    },
+                    'quantity': 1,
+                }],
+                mode='payment',
+                client_reference_id=user_id,
+                metadata={'user_id': user_id},
+                success_url=success_url,
+                cancel_url=cancel_url,
+                # Same parameters for the whole window, as idempotent retries require
+                expires_at=(window + 2) * CHECKOUT_REUSE_SECONDS + CHECKOUT_EXPIRY_SAFETY_SECONDS,
+                idempotency_key=f"checkout:{user_id}:{window}",
+            )
+    except Exception:
+        metrics.OUTBOUND_ERRORS.inc(service='stripe', op='checkout_create')
+        raise
+
+
+def checkout_url(user_id, success_url, cancel_url):
+    """
+    Checkout URL for user_id: the cached open session, a new one, or
+    success_url if the chat is already paid. Serialize calls per user to
+    avoid even the in-process duplicates.
+    """
+    now = time.time()
+
+    def _load(conn):
+        paid = conn.execute("SELECT paid FROM chats WHERE user_id=?", (user_id,)).fetchone()
+        return bool(paid and paid[0]), cached_session(conn, user_id, now)
+    paid, cached = db.run(_load, op='checkout_lookup')
+    if paid:
+        counts['already_paid'] += 1
+        return success_url
+    if cached:
+        counts['reused'] += 1
+        return cached[1]
+
+    session = _create_session(user_id, success_url, cancel_url, now)
+    db.execute("INSERT INTO checkout_sessions (user_id, session_id, url, expires_at, created_at) "
+               "VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET session_id=excluded.session_id, "
+               "url=excluded.url, expires_at=excluded.expires_at, created_at=excluded.created_at",
+               (user_id, session.id, session.url, session.expires_at, now), op='checkout_save')
+    counts['create_calls'] += 1
+    return session.url
+
+
+def session_paid(user_id):
+    """Ask Stripe whether the user's latest Checkout Session has been paid."""
+    row = db.query_one("SELECT session_id FROM checkout_sessions WHERE user_id=?", (user_id,), op='checkout_lookup')
+    if not row:
+        return False
+    try:
+        with metrics.OUTBOUND_SECONDS.time(service='stripe', op='checkout_retrieve'):
+            session = stripe.checkout.Session.retrieve(row[0])
+    except Exception:
+        metrics.OUTBOUND_ERRORS.inc(service='stripe', op='checkout_retrieve')
+        raise
+    return session.payment_status == 'paid'
+
+
+def _confirm(conn, user_id, event_id, event_type):
+    conn.execute("BEGIN IMMEDIATE")
+    if event_id is not None:
+        cur = conn.execute("INSERT OR IGNORE INTO stripe_events (event_id, type, user_id, received_at) "
+                           "VALUES (?, ?, ?, CURRENT_TIMESTAMP)", (event_id, event_type, user_id))
+        if not cur.rowcount:
+            return None
+    cur = conn.execute("INSERT INTO chats (user_id, paid, updated_at) VALUES (?, 1, CURRENT_TIMESTAMP) "
+                       "ON CONFLICT(user_id) DO UPDATE SET paid=1, updated_at=excluded.updated_at "
+                       "WHERE NOT COALESCE(chats.paid, 0)", (user_id,))
+    if not cur.rowcount:
+        return False
+    jobs.enqueue('payment_confirmed', {'user_id': user_id}, key=user_id, conn=conn)
+    return True
+
+
+def confirm(user_id, event_id=None, event_type=None):
+    """
+    Mark the chat paid. True only for the call that flipped it (and queued
+    `payment_confirmed`); False if it was already paid, None for a replayed event.
+    """
+    first = db.run(_confirm, user_id, event_id, event_type, op='payment_confirm')
+    if first is None:
+        counts['replayed_events'] += 1
+    elif first:
+        counts['confirmed'] += 1
+    else:
+        counts['duplicate_confirmations'] += 1
+    return first
+
+
+def parse_event(payload, signature):
+    """Verified stripe.Event; raises ValueError or stripe.SignatureVerificationError."""
+    if not STRIPE_WEBHOOK_SECRET:
+        raise ValueError("STRIPE_WEBHOOK_SECRET is not set")
+    return stripe.Webhook.construct_event(payload, signature, STRIPE_WEBHOOK_SECRET)
+
+
+def handle_event(event, on_paid=confirm):
+    """
+    Apply one webhook event: on_paid(user_id, event_id, event_type) for a paid
+    Checkout Session (confirm() or a wrapper of it), whose result is returned.
+    checkout.session.completed arrives unpaid for delayed methods (bank debits);
+    those confirm on async_payment_succeeded.
+    """
+    counts['events'] += 1
+    if event.type not in PAID_EVENTS:
+        return None
+    session = event.data.object
+    if session.payment_status != 'paid':
+        return None
+    user_id = session.client_reference_id or (session.metadata or {}).get('user_id')
+    if not user_id:
+        print(f"[PAYMENTS] {event.id}: session {session.id} has no user id, ignored")
+        return None
+    return on_paid(user_id, event.id, event.type)
+
+
+def stats():
+    return dict(counts, reuse_seconds=CHECKOUT_REUSE_SECONDS, webhook=bool(STRIPE_WEBHOOK_SECRET))
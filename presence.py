@@ -0,0 +1,62 @@
+"""
+Debounced expert-presence updates for the admin dashboard.
+
+Expert logins and disconnects only call changed(). At most every
+PRESENCE_FLUSH_SECONDS the broadcaster asks the shared state for what moved
+since the last publish and sends one delta to admin_room:
+
+    online_experts_delta   {'version': v, 'joined': [ids], 'left': [ids]}
+
+A client holding version v - 1 applies it; any other version means it
+missed something and asks for a snapshot (get_online_experts). Snapshots,
+sent to one socket on admin login or on request, keep the old event:
+
+    online_experts_update  {'version': v, 'online_ids': [ids]}
+
+A reconnect storm of N experts costs a handful of small deltas instead of N
+full lists to every admin.
+"""
+import os
+
+import eventlet
+
+PRESENCE_FLUSH_SECONDS = float(os.getenv("PRESENCE_FLUSH_SECONDS", "1.0"))
+
+
+class PresenceBroadcaster:
+    def __init__(self, shared_state, emit, window=PRESENCE_FLUSH_SECONDS):
+        """emit(event, payload, to=room) is socketio.emit."""
+        self.state = shared_state
+        self.emit = emit
+        self.window = window
+        self._timer = None
+        self.counts = {'changes': 0, 'deltas': 0, 'snapshots': 0}
+
+    def changed(self):
+        self.counts['changes'] += 1
+        if self.window <= 0:
+            self.flush()
+        elif self._timer is None:
+            self._timer = eventlet.spawn_after(self.window, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        delta = self.state.publish_presence()
+        if delta is None:
+            return
+        version, joined, left = delta
+        self.counts['deltas'] += 1
+        self.emit('online_experts_delta', {'version': version, 'joined': sorted(joined), 'left': sorted(left)},
+                  to='admin_room')
+
+    def snapshot(self):
+        """Payload for one admin socket; publishes pending changes first so the two agree."""
+        self.flush()
+        self.counts['snapshots'] += 1
+        version, ids = self.state.presence_snapshot()
+        return {'version': version, 'online_ids': ids}
+
+    def stats(self):
+        return dict(self.counts, pending=self._timer is not None, window=self.window)
@@ -0,0 +1,158 @@
+"""
+Full-text search over chat transcripts (SQLite FTS5).
+
+messages_fts is an external-content FTS5 index over messages.text: triggers
+on `messages` keep it current on every append, so there is no second copy
+of the text.
+
+Only the hot tier is searchable. Archived chats (see archive) leave the
+index with their rows and come back when a new message restores them, so
+chats idle for longer than CHAT_ARCHIVE_AFTER_DAYS can't be found; set it
+to 0 to keep every transcript searchable at the cost of a larger database.
+
+search() ranks the SEARCH_MAX_HITS most recent matching messages the caller
+may see (category/paid filters applied during the scan) with bm25, keeps
+the best hit per chat and returns one page of chats with a snippet (HTML:
+the message text escaped, matches wrapped in <mark>):
+
+    search("printer offline", categories=['tech'], paid=True, limit=20, offset=0)
+    -> ([{'user_id', 'category', 'paid', 'updated_at', 'seq', 'sender',
+          'snippet', 'hits', 'score'}, ...], next_offset or None)
+
+Rebuild offline (e.g. after restoring a backup):
+
+    python search.py --rebuild
+"""
+import html
+import os
+import re
+import sqlite3
+
+import db
+
+SEARCH_PAGE = 20
+# Most recent matching messages ranked per query. FTS5 walks its index in rowid
+# order and stops there, so a word found in most messages costs the same as
+# one found in a few thousand instead of scoring the whole table.
+SEARCH_MAX_HITS = int(os.getenv("SEARCH_MAX_HITS", "5000"))
+SNIPPET_TOKENS = 12
+# snippet() marks matches with these, the text is HTML-escaped, then they become <mark> tags
+_OPEN, _CLOSE = '\ue000', '\ue001'
+
+_TERM = re.compile(r'\w+\*?', re.UNICODE)
+
+
+def ensure_index(conn):
+    """Create messages_fts and its triggers if missing; True if FTS5 is available."""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                     "text, content='messages', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')")
+    except sqlite3.OperationalError as e:
+        print(f"[SEARCH] FTS5 unavailable, search disabled: {e}")
+        return False
+    conn.execute("CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+                 "INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text); END")
+    conn.execute("CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+                 "INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text); END")
+    conn.execute("CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN "
+                 "INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text); "
+                 "INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text); END")
+    return True
+
+
+def has_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name='messages_fts'").fetchone() is not None
+
+
+def rebuild(conn):
+    """Re-index every message; needed after anything that renumbers rowids (a full VACUUM)."""
+    if ensure_index(conn):
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+def to_match(text):
+    """
+    Free text -> FTS5 query: every word must appear, `word*` is a prefix match.
+    Operators and quotes typed by users are treated as plain words, so input
+    never raises an FTS syntax error. Returns None if nothing is searchable.
+    """
+    terms = []
+    for term in _TERM.findall(text or ''):
+        prefix = term.endswith('*')
+        word = term.rstrip('*').replace('"', '')
+        if word:
+            terms.append(f'"{word}"' + ('*' if prefix else ''))
+    return ' '.join(terms[:16]) or None
+
+
+def _snippet_html(text):
+    """Escaped snippet with <mark> around the matches; message text is never passed through as markup."""
+    return html.escape(text).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>')
+
+
+def _search(conn, match, categories, paid, limit, offset):
+    filters, params = [], [match]
+    if categories is not None:
+        filters.append(f"c.category IN ({','.join('?' for _ in categories)})")
+        params += list(categories)
+    if paid is not None:
+        filters.append("c.paid = ?")
+        params.append(int(bool(paid)))
+    where = (" AND " + " AND ".join(filters)) if filters else ""
+    # The chats filters run inside the capped scan: the cap counts matches the caller may see
+    rows = conn.execute(
+        "WITH hits AS (SELECT m.user_id, m.seq, m.sender, f.rowid, bm25(messages_fts) AS score, "
+        "c.category, c.paid, c.updated_at "
+        "FROM messages_fts f JOIN messages m ON m.rowid = f.rowid JOIN chats c ON c.user_id = m.user_id "
+        f"WHERE messages_fts MATCH ?{where} ORDER BY f.rowid DESC LIMIT ?), "
+        "ranked AS (SELECT *, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY score) AS rn, "
+        "COUNT(*) OVER (PARTITION BY user_id) AS n FROM hits) "
+        "SELECT user_id, seq, sender, rowid, score, category, paid, updated_at, n FROM ranked WHERE rn = 1 "
+        "ORDER BY score, user_id LIMIT ? OFFSET ?", params + [SEARCH_MAX_HITS, limit + 1, offset]).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    snippets = {}
+    if rows:
+        snippets = dict(conn.execute(
+            f"SELECT rowid, snippet(messages_fts, 0, ?, ?, '…', {SNIPPET_TOKENS}) "
+            f"FROM messages_fts WHERE messages_fts MATCH ? AND rowid IN ({','.join('?' for _ in rows)})",
+            [_OPEN, _CLOSE, match] + [r[3] for r in rows]).fetchall())
+    results = [{'user_id': r[0], 'seq': r[1], 'sender': r[2], 'snippet': _snippet_html(snippets.get(r[3], '')),
+                'score': r[4],
+                'category': r[5], 'paid': bool(r[6]), 'updated_at': r[7], 'hits': r[8]} for r in rows]
+    return results, (offset + limit if more else None)
+
+
+def search(query, categories=None, paid=None, limit=SEARCH_PAGE, offset=0):
+    """
+    One page of chats matching `query`, best first. categories=None / paid=None
+    mean no filter; an empty categories list matches nothing.
+    """
+    match = to_match(query)
+    if not match or (categories is not None and not categories):
+        return [], None
+    try:
+        return db.run(_search, match, categories, paid, limit, offset, op='search_chats')
+    except sqlite3.OperationalError as e:
+        if 'messages_fts' not in str(e):   # FTS5 missing from this SQLite build
+            raise
+        return [], None
+
+
+def main():
+    import argparse
+    import time
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--rebuild', action='store_true', help="re-index all messages")
+    args = p.parse_args()
+    if args.rebuild:
+        start = time.monotonic()
+        db.run(rebuild, op='search_rebuild')
+        count = db.query_one("SELECT COUNT(*) FROM messages")[0]
+        print(f"[SEARCH] indexed {count} messages in {time.monotonic() - start:.2f}s")
+    else:
+        p.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,22 @@
 # 1) MONKEY PATCH MUST BE FIRST
 import eventlet
 eventlet.monkey_patch()
-from eventlet import tpool
 
 import os
 import random
 import sqlite3
 import json
 import base64
-import requests
 import re
+import functools
+import hmac
+import math
+import time
 
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, rooms
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
 import google.generativeai as genai
 import stripe
@@ -25,57 +28,39 @@ from firebase_admin import credentials, firestore
 # -----------------------------
 load_dotenv()
 
+# Local modules read their settings from the environment at import time
+import archive
+import auth
+import chat_cache
+import classifier
+import context_window
+import crisp
+import db
+import firebase_sync
+import jobs
+import llm
+import metrics
+import payments
+import presence
+import search
+import state
+
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 
+# Reverse proxies in front of the app; their X-Forwarded-For gives the client
+# address the login limiter keys on. 0 if clients connect directly.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+
 # IMPORTANT: set a strong admin password
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "superadmin123")
 
-# CRISP ENV VARS (Render)
-CRISP_API_IDENTIFIER = os.getenv("CRISP_API_IDENTIFIER")
-CRISP_API_KEY = os.getenv("CRISP_API_KEY")
-CRISP_WEBSITE_ID = os.getenv("CRISP_WEBSITE_ID")
-CRISP_API_BASE = "https://api.crisp.chat/v1"
+# Browser/CDN cache lifetime for GET /experts
+EXPERTS_MAX_AGE = int(os.getenv("EXPERTS_MAX_AGE", "60"))
 
 # IMPORTANT: your website domain (Stripe return URL)
 PUBLIC_SITE_URL = os.getenv("PUBLIC_SITE_URL", "https://www.helpbyexperts.com")
 
-def crisp_enabled():
-    return all([CRISP_API_IDENTIFIER, CRISP_API_KEY, CRISP_WEBSITE_ID])
-
-def crisp_get_session_id_from_token(token_id: str):
-    """
-    Resolve Crisp token_id -> session_id
-    GET /v1/website/{website_id}/visitors/token/{token_id}
-    """
-    url = f"{CRISP_API_BASE}/website/{CRISP_WEBSITE_ID}/visitors/token/{token_id}"
-    r = requests.get(url, auth=(CRISP_API_IDENTIFIER, CRISP_API_KEY), timeout=10)
-    r.raise_for_status()
-    payload = r.json()
-
-    data = payload.get("data")
-    # Crisp can return list or dict depending on endpoint behavior / account
-    if isinstance(data, list) and data:
-        return data[0].get("session_id")
-    if isinstance(data, dict):
-        return data.get("session_id")
-    return None
-
-def crisp_send_message(session_id: str, content: str):
-    """
-    Push a message into Crisp conversation so agents see it in Inbox.
-    POST /v1/website/{website_id}/conversation/{session_id}/message
-    """
-    url = f"{CRISP_API_BASE}/website/{CRISP_WEBSITE_ID}/conversation/{session_id}/message"
-    body = {
-        "type": "text",
-        "from": "operator",     # shows as operator-side in inbox
-        "origin": "chat",
-        "content": content
-    }
-    r = requests.post(url, auth=(CRISP_API_IDENTIFIER, CRISP_API_KEY), json=body, timeout=10)
-    r.raise_for_status()
-
 def format_transcript(history: list):
     """
     history items: {'sender': 'user'|'bot'|'agent', 'text': '...'}
@@ -158,33 +143,36 @@ EXPERT_INSTRUCTIONS = (
     "Otherwise, do not mention payment, and do not ask for name/email/phone unless presenting the appointment form."
 )
 
-def setup_model(system_instruction: str):
+def setup_model(model_name, system_instruction):
+    return genai.GenerativeModel(
+        model_name,
+        system_instruction=system_instruction,
+        generation_config={"temperature": 0.85, "top_p": 0.95, "top_k": 64}
+    )
+
+def build_models(model_name):
+    global model, expert_model, summary_model
+    model = setup_model(model_name, AVA_INSTRUCTIONS)
+    expert_model = setup_model(model_name, EXPERT_INSTRUCTIONS)
+    # No system instruction: only used to fold old turns into a running summary
+    summary_model = genai.GenerativeModel(model_name, generation_config={"temperature": 0.2})
+
+def refresh_models():
+    """Run model discovery off the import path; swap the models if the pick changed."""
     try:
-        valid_models = [m for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-        valid_names = [m.name for m in valid_models]
-        chosen = None
-        for name in valid_names:
-            if 'flash' in name.lower() and 'preview' not in name and 'lite' not in name:
-                chosen = name
-                break
-        if not chosen:
-            chosen = valid_names[0] if valid_names else "gemini-1.5-flash"
-
-        return genai.GenerativeModel(
-            chosen,
-            system_instruction=system_instruction,
-            generation_config={"temperature": 0.85, "top_p": 0.95, "top_k": 64}
-        )
+        name = llm.call(llm.discover_model_name)
     except Exception as e:
-        print(f"Model setup error: {e}")
-        return genai.GenerativeModel(
-            "gemini-1.5-flash",
-            system_instruction=system_instruction,
-            generation_config={"temperature": 0.85}
-        )
+        print(f"Model discovery error (keeping {model.model_name}): {e}")
+        return
+    if genai.GenerativeModel(name).model_name != model.model_name:
+        build_models(name)
+        print(f"Model discovery: now using {model.model_name}")
 
-model = setup_model(AVA_INSTRUCTIONS)
-expert_model = setup_model(EXPERT_INSTRUCTIONS)
+# Pinned (GEMINI_MODEL) or last discovered name; a stale/missing cache is refreshed in the background
+_model_name, _model_fresh = llm.cached_model_name()
+build_models(_model_name)
+if not _model_fresh:
+    eventlet.spawn_n(refresh_models)
 
 # -----------------------------
 # SERVER
@@ -192,18 +180,61 @@ expert_model = setup_model(EXPERT_INSTRUCTIONS)
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv("FLASK_SECRET", "secret!")
 CORS(app, resources={r"/*": {"origins": "*"}})
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="eventlet")
+# With REDIS_URL set, emits to rooms reach sockets on every worker/node
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="eventlet", message_queue=state.REDIS_URL)
+if TRUSTED_PROXY_HOPS:
+    # Outside the Socket.IO middleware, so socket handlers see the real client address too
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+SOCKET_EVENT_SECONDS = metrics.histogram('socket_event_seconds', "Socket.IO handler time by event", ('event',))
+SOCKET_EVENT_ERRORS = metrics.counter('socket_event_errors_total', "Socket.IO handlers that raised", ('event',))
+REPLY_DELAY_SECONDS = metrics.histogram('reply_delay_seconds', "Padding added to reach the reply pacing minimum", ('mode',))
+CLASSIFY_SECONDS = metrics.histogram('classify_seconds', "Category classification time", ('source',))
+USER_LOCK_WAIT_SECONDS = metrics.histogram('user_lock_wait_seconds', "Time queued behind the same user's earlier events",
+                                           ('event',))
+
+def timed_event(message):
+    """socketio.on(message) that also records the handler's latency."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def timed(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                SOCKET_EVENT_ERRORS.inc(event=message)
+                raise
+            finally:
+                SOCKET_EVENT_SECONDS.observe(time.monotonic() - start, event=message)
+        return socketio.on(message)(timed)
+    return decorator
 
 stripe.api_key = STRIPE_SECRET_KEY
 
 # -----------------------------
 # DATABASE
 # -----------------------------
-DB_FILE = "/data/chat_data.db"
-
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    """
+    Apply pending MIGRATIONS (PRAGMA user_version counts the ones already
+    applied), then enable archive compaction on a database created without it.
+    """
+    if db.query_one("PRAGMA user_version", op='schema_version')[0] < len(MIGRATIONS):
+        db.run(_migrate)
+    archive.enable_compaction()
+
+def _migrate(conn):
+    # BEGIN IMMEDIATE: one worker migrates, the others wait and then find nothing to do
+    conn.execute("BEGIN IMMEDIATE")
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for migration in MIGRATIONS[version:]:
+        migration(conn.cursor())
+        print(f"Schema migration: {migration.__name__}")
+    conn.execute(f"PRAGMA user_version={len(MIGRATIONS)}")
+
+# Migrations run in order, once each. Databases created before user_version was
+# tracked start at 0, so the early steps stay safe to re-run on an existing schema.
+def _m001_base_tables(c):
     c.execute('''CREATE TABLE IF NOT EXISTS chats
                  (user_id TEXT PRIMARY KEY, history TEXT, paid BOOLEAN, category TEXT)''')
     c.execute('''CREATE TABLE IF NOT EXISTS experts
@@ -213,7 +244,6 @@ def init_db():
                   categories TEXT NOT NULL,
                   password TEXT NOT NULL UNIQUE,
                   created_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
     # Add missing columns safely
     try:
         c.execute('ALTER TABLE chats ADD COLUMN category TEXT')
@@ -223,68 +253,435 @@ def init_db():
         c.execute('ALTER TABLE experts ADD COLUMN created_at DATETIME DEFAULT CURRENT_TIMESTAMP')
     except sqlite3.OperationalError:
         pass
-    conn.close()
+
+def _m002_messages(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS messages
+                 (user_id TEXT NOT NULL,
+                  seq INTEGER NOT NULL,
+                  sender TEXT NOT NULL,
+                  text TEXT,
+                  created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                  PRIMARY KEY (user_id, seq))''')
+    migrate_history_to_messages(c)
+
+def _m003_chat_summaries(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_summaries
+                 (user_id TEXT NOT NULL,
+                  mode TEXT NOT NULL,
+                  covered INTEGER NOT NULL,
+                  summary TEXT NOT NULL,
+                  PRIMARY KEY (user_id, mode))''')
+
+def _m004_chats_updated_at(c):
+    try:
+        c.execute('ALTER TABLE chats ADD COLUMN updated_at DATETIME')
+        c.execute("UPDATE chats SET updated_at = COALESCE("
+                  "(SELECT MAX(created_at) FROM messages m WHERE m.user_id = chats.user_id), CURRENT_TIMESTAMP)")
+    except sqlite3.OperationalError:
+        pass
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chats_paid_category_updated ON chats (paid, category, updated_at)')
+
+def _m005_cache_versions(c):
+    # Bumped whenever a cached table changes, so every worker notices
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_versions
+                 (name TEXT PRIMARY KEY, version INTEGER NOT NULL)''')
+    c.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('experts', 1)")
+
+def _m006_jobs(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  type TEXT NOT NULL,
+                  payload TEXT NOT NULL,
+                  dedupe_key TEXT,
+                  status TEXT NOT NULL,
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  max_attempts INTEGER NOT NULL,
+                  run_at REAL NOT NULL,
+                  created_at REAL NOT NULL,
+                  started_at REAL,
+                  finished_at REAL,
+                  locked_by TEXT,
+                  last_error TEXT)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_type_run ON jobs (status, type, run_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs (type, dedupe_key, status)')
+
+def _m007_user_state(c):
+    # "Expert Joined" flag + post-payment turns; state.MemoryState caches these
+    c.execute('''CREATE TABLE IF NOT EXISTS user_state
+                 (user_id TEXT PRIMARY KEY,
+                  agent_joined INTEGER NOT NULL DEFAULT 0,
+                  turns INTEGER NOT NULL DEFAULT 0,
+                  updated_at DATETIME)''')
+
+def _m008_hash_expert_passwords(c):
+    rows = c.execute("SELECT id, password FROM experts").fetchall()
+    for expert_id, password in rows:
+        if not auth.is_hashed(password):
+            c.execute("UPDATE experts SET password=? WHERE id=?", (auth.hash_password(password), expert_id))
+
+def _m009_chat_archive(c):
+    # Compressed messages of idle chats (see archive); the chats row stays as the index
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_archive
+                 (user_id TEXT PRIMARY KEY,
+                  first_seq INTEGER NOT NULL,
+                  last_seq INTEGER NOT NULL,
+                  message_count INTEGER NOT NULL,
+                  raw_bytes INTEGER NOT NULL,
+                  last_text TEXT,
+                  data BLOB NOT NULL,
+                  archived_at DATETIME)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chats_updated ON chats (updated_at)')
+
+def _m010_messages_fts(c):
+    # Full-text index over messages.text, kept current by triggers (see search)
+    search.rebuild(c)
+
+def _m011_payments(c):
+    # Reusable Checkout Sessions and processed webhook events (see payments)
+    c.execute('''CREATE TABLE IF NOT EXISTS checkout_sessions
+                 (user_id TEXT PRIMARY KEY,
+                  session_id TEXT NOT NULL,
+                  url TEXT NOT NULL,
+                  expires_at REAL NOT NULL,
+                  created_at REAL NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS stripe_events
+                 (event_id TEXT PRIMARY KEY,
+                  type TEXT NOT NULL,
+                  user_id TEXT,
+                  received_at DATETIME)''')
+
+def migrate_history_to_messages(c):
+    """
+    One-time move of the legacy chats.history JSON blob into the messages table.
+    Migrated rows get history=NULL.
+    """
+    c.execute("SELECT user_id, history FROM chats WHERE history IS NOT NULL")
+    rows = c.fetchall()
+    for user_id, raw in rows:
+        try:
+            history = json.loads(raw) or []
+        except ValueError:
+            print(f"History migration: bad JSON for {user_id}, skipped")
+            continue
+        c.execute("DELETE FROM messages WHERE user_id=?", (user_id,))
+        c.executemany(
+            "INSERT INTO messages (user_id, seq, sender, text) VALUES (?, ?, ?, ?)",
+            [(user_id, i, m.get('sender') or '', m.get('text')) for i, m in enumerate(history, start=1)]
+        )
+        c.execute("UPDATE chats SET history=NULL WHERE user_id=?", (user_id,))
+    if rows:
+        print(f"History migration: moved {len(rows)} chats to messages table")
+
+MIGRATIONS = (
+    _m001_base_tables,
+    _m002_messages,
+    _m003_chat_summaries,
+    _m004_chats_updated_at,
+    _m005_cache_versions,
+    _m006_jobs,
+    _m007_user_state,
+    _m008_hash_expert_passwords,
+    _m009_chat_archive,
+    _m010_messages_fts,
+    _m011_payments,
+)
 
 init_db()
 
+# Decoded chats, validated against the DB on every read (see chat_cache)
+chat_states = chat_cache.ChatCache()
+
 def get_chat(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT history, paid, category FROM chats WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    return chat_states.get(user_id)
+
+def get_chat_meta(user_id):
+    """get_chat without the transcript."""
+    row = db.query_one("SELECT paid, category FROM chats WHERE user_id=?", (user_id,))
     if row:
-        return {'history': json.loads(row[0]), 'paid': bool(row[1]), 'category': row[2]}
-    return {'history': [], 'paid': False, 'category': None}
+        return {'paid': bool(row[0]), 'category': row[1]}
+    return {'paid': False, 'category': None}
+
+def save_category(user_id, category):
+    """Set only the category; paid is left to payments.confirm, never rewritten from an earlier read."""
+    db.execute("INSERT INTO chats (user_id, paid, category, updated_at) VALUES (?, 0, ?, CURRENT_TIMESTAMP) "
+               "ON CONFLICT(user_id) DO UPDATE SET category=excluded.category, updated_at=excluded.updated_at",
+               (user_id, category), op='save_category')
+    chat_states.categorized(user_id, category)
+
+def append_message(user_id, sender, text):
+    """Append one message to the user's log (O(1) per turn, no history rewrite)."""
+    seq = db.run(_append_message, user_id, sender, text)
+    chat_states.appended(user_id, seq, sender, text)
+
+def _append_message(conn, user_id, sender, text):
+    conn.execute("INSERT INTO chats (user_id, paid, updated_at) VALUES (?, 0, CURRENT_TIMESTAMP) "
+                 "ON CONFLICT(user_id) DO UPDATE SET updated_at=excluded.updated_at", (user_id,))
+    archive.restore(conn, user_id)   # no-op unless the chat went cold
+    conn.execute("INSERT INTO messages (user_id, seq, sender, text) "
+                 "SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ? FROM messages WHERE user_id=?",
+                 (user_id, sender, text, user_id))
+    return conn.execute("SELECT MAX(seq) FROM messages WHERE user_id=?", (user_id,)).fetchone()[0]
+
+# Public experts directory: rebuilt only when cache_versions['experts'] moves
+# 'by_id' and 'pv' (password fingerprints for session tokens) never leave the server
+_experts_cache = {'version': None, 'experts': [], 'json': '[]', 'by_id': {}, 'pv': {}}
+
+def get_public_experts():
+    """Cached {'version', 'experts', 'json', ...}; costs one version lookup when unchanged."""
+    def _load(conn):
+        version = conn.execute("SELECT version FROM cache_versions WHERE name='experts'").fetchone()[0]
+        if version == _experts_cache['version']:
+            return version, None
+        return version, conn.execute("SELECT id, name, photo_url, categories, password FROM experts "
+                                     "ORDER BY name").fetchall()
+
+    version, rows = db.run(_load)
+    if rows is not None:
+        experts = [
+            {'id': r[0], 'name': r[1], 'photo_url': r[2] or '', 'categories': json.loads(r[3])}
+            for r in rows
+        ]
+        _experts_cache.update(version=version, experts=experts, json=json.dumps(experts),
+                              by_id={e['id']: e for e in experts},
+                              pv={r[0]: auth.fingerprint(r[4]) for r in rows})
+    return _experts_cache
+
+def write_experts(sql, params):
+    """Change the experts table and invalidate the directory cache in one transaction."""
+    def _write(conn):
+        conn.execute(sql, params)
+        conn.execute("UPDATE cache_versions SET version = version + 1 WHERE name='experts'")
+    db.run(_write)
+
+ACTIVE_CHATS_PAGE = int(os.getenv("ACTIVE_CHATS_PAGE", "100"))
+HISTORY_PAGE = int(os.getenv("HISTORY_PAGE", "50"))
+
+def page_arg(value, default, low, high):
+    """Client-sent page size / offset clamped to [low, high]; default when absent, None if it isn't an integer."""
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    try:
+        return max(low, min(int(value), high))
+    except ValueError:
+        return None
+
+def _preview(text, limit=140):
+    text = re.sub(r'<[^>]+>', ' ', text or '')
+    text = ' '.join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + '…'
 
-def save_chat(user_id, history, paid, category=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO chats (user_id, history, paid, category) VALUES (?, ?, ?, ?)",
-              (user_id, json.dumps(history), int(bool(paid)), category))
-    conn.commit()
-    conn.close()
+def load_active_chats(categories, cursor=None, limit=None):
+    """
+    One page of paid chats in `categories`, most recently updated first.
+    cursor is the opaque next_cursor of the previous page ("updated_at|user_id").
+    Returns (chats, next_cursor).
+    """
+    if not categories:
+        return [], None
+    limit = limit or ACTIVE_CHATS_PAGE
+    placeholders = ','.join('?' for _ in categories)
+    sql = (f"SELECT user_id, category, updated_at, "
+           f"COALESCE((SELECT text FROM messages m WHERE m.user_id = chats.user_id ORDER BY seq DESC LIMIT 1), "
+           f"(SELECT last_text FROM chat_archive a WHERE a.user_id = chats.user_id)) "
+           f"FROM chats WHERE paid=1 AND category IN ({placeholders})")
+    params = list(categories)
+    if cursor:
+        updated_at, _, user_id = str(cursor).partition('|')
+        sql += " AND (updated_at < ? OR (updated_at = ? AND user_id < ?))"
+        params += [updated_at, updated_at, user_id]
+    sql += " ORDER BY updated_at DESC, user_id DESC LIMIT ?"
+    params.append(limit + 1)
+    rows = db.query(sql, params)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    chats = [{'user_id': r[0], 'category': r[1], 'updated_at': r[2], 'preview': _preview(r[3])} for r in rows]
+    next_cursor = f"{rows[-1][2]}|{rows[-1][0]}" if more else None
+    return chats, next_cursor
+
+def _load_history_page(conn, user_id, before_seq, limit):
+    if before_seq:
+        rows = conn.execute("SELECT seq, sender, text, created_at FROM messages WHERE user_id=? AND seq < ? "
+                            "ORDER BY seq DESC LIMIT ?", (user_id, before_seq, limit)).fetchall()
+    else:
+        rows = conn.execute("SELECT seq, sender, text, created_at FROM messages WHERE user_id=? "
+                            "ORDER BY seq DESC LIMIT ?", (user_id, limit)).fetchall()
+    if not rows:
+        archived = archive.load(conn, user_id) or []
+        rows = [r for r in archived if not before_seq or r[0] < before_seq][-limit:][::-1]
+    return rows
+
+def load_history_page(user_id, before_seq=None, limit=HISTORY_PAGE):
+    """Newest `limit` messages older than seq before_seq (an int), returned oldest first, plus next cursor."""
+    rows = db.run(_load_history_page, user_id, before_seq, limit)
+    rows.reverse()
+    messages = [{'seq': r[0], 'sender': r[1], 'text': r[2], 'created_at': r[3]} for r in rows]
+    next_cursor = rows[0][0] if rows and rows[0][0] > 1 else None
+    return messages, next_cursor
 
 # -----------------------------
-# ONLINE EXPERT TRACKING (unchanged)
+# ONLINE EXPERT TRACKING
 # -----------------------------
-online_experts = {}          # sid -> expert dict
-online_experts_by_id = {}    # expert_id -> set(sids)
-
-# In-memory per-user state (prevents duplicate "agent joined" banners)
-agent_joined_state = {}      # user_id -> bool
-expert_turn_counter = {}     # user_id -> int (post-payment turns)
+# Presence, "agent joined" flags and post-payment turn counters.
+# In-process by default; shared through Redis when REDIS_URL is set.
+shared_state = state.make_state()
+
+# Handlers that read-modify-write one user's chat (history, paid/category, the
+# Gemini session) run one at a time per user, in arrival order. Per process:
+# Socket.IO's sticky sessions keep a customer's events on one worker.
+user_locks = state.KeyedLock()
+
+def per_user(key):
+    """Run the handler holding user_locks for data[key] (no lock when it's missing)."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def locked(data=None, *args):
+            user_id = (data or {}).get(key) if isinstance(data, dict) else None
+            if not user_id:
+                return handler(data, *args)
+            start = time.monotonic()
+            with user_locks.hold(user_id):
+                USER_LOCK_WAIT_SECONDS.observe(time.monotonic() - start, event=handler.__name__)
+                return handler(data, *args)
+        return locked
+    return decorator
+
+# Expert logins/disconnects reach admin_room as debounced deltas (see presence)
+online_presence = presence.PresenceBroadcaster(shared_state, socketio.emit)
 
 def broadcast_online_status():
-    online_ids = list(online_experts_by_id.keys())
-    socketio.emit('online_experts_update', {'online_ids': online_ids}, to='admin_room')
+    online_presence.changed()
+
+def _presence_heartbeat():
+    # Keeps this worker's experts online in shared state; drops those of workers that died
+    while True:
+        try:
+            if shared_state.heartbeat():
+                broadcast_online_status()
+        except Exception as e:
+            print(f"[STATE] heartbeat error: {e}")
+        eventlet.sleep(state.PRESENCE_HEARTBEAT_SECONDS)
+
+eventlet.spawn_n(_presence_heartbeat)
 
 # -----------------------------
 # FIREBASE SYNC (optional)
 # -----------------------------
-def _save_to_firebase_task(user_id, history):
-    if firebase_db:
-        try:
-            firebase_db.collection('chats').add({
-                'user_id': user_id,
-                'history': history,
-                'timestamp': firestore.SERVER_TIMESTAMP,
-                'status': 'paid'
-            })
-            print(f"Firebase synced for {user_id}")
-        except Exception as e:
-            print(f"Firebase Sync Error: {e}")
+firebase_batcher = firebase_sync.FirestoreBatcher(firebase_db) if firebase_db else None
+
+def _firebase_sync_job(payload):
+    # Waits for the batch holding this snapshot; raises on failure so the job queue retries it
+    if firebase_batcher:
+        user_id = payload['user_id']
+        chat = get_chat(user_id)
+        firebase_batcher.put(user_id, {
+            'user_id': user_id,
+            'history': chat['history'],
+            'category': chat['category'],
+            'timestamp': firestore.SERVER_TIMESTAMP,
+            'status': 'paid'
+        })
+
+def sync_chat_to_firebase(user_id):
+    # Durable background job; reads the latest history when it runs
+    jobs.enqueue('firebase_sync', {'user_id': user_id}, key=user_id)
 
-def sync_chat_to_firebase(user_id, history):
-    # Run firebase write off the main greenlet
-    try:
-        eventlet.spawn_n(_save_to_firebase_task, user_id, history)
-    except Exception:
-        # Fallback to threadpool if available
-        try:
-            tpool.execute(_save_to_firebase_task, user_id, history)
-        except Exception:
-            pass
+# -----------------------------
+# BACKGROUND JOBS
+# -----------------------------
+JOB_CONCURRENCY = {
+    # Jobs mostly wait on a shared batch commit; enough of them to fill one batch
+    'firebase_sync': int(os.getenv("JOBS_FIREBASE_CONCURRENCY", str(firebase_sync.FIREBASE_BATCH_SIZE))),
+    'crisp_sync': int(os.getenv("JOBS_CRISP_CONCURRENCY", "4")),
+    'expert_announce': int(os.getenv("JOBS_ANNOUNCE_CONCURRENCY", "20")),
+    'chat_archive': 1,
+    'payment_confirmed': int(os.getenv("JOBS_PAYMENT_CONCURRENCY", "4")),
+}
+
+def _crisp_sync_job(payload):
+    # A repeat sync while this one waits for the Crisp session is merged in: post its newer transcript once
+    token_id = payload['token_id']
+    crisp.push_transcript(token_id, lambda: (jobs.latest_payload('crisp_sync', token_id) or payload)['message'])
+
+def _expert_announce_job(payload):
+    with user_locks.hold(payload['user_id']):
+        _expert_announce(payload['user_id'])
+
+def _expert_announce(user_id):
+    # Let frontend show "Expert Joined"
+    socketio.emit('agent_connected', {'name': 'Ava (Certified Specialist)', 'photo': ''}, to=user_id)
+
+    # First expert message
+    intro = "✅ Expert Joined<br>A certified specialist is now connected. Tell me the exact error message you see and what happened right before it started."
+    append_message(user_id, 'bot', intro)
+    socketio.emit('bot_message', {'data': intro, 'is_agent': True}, to=user_id)
+
+def _payment_confirmed_job(payload):
+    with user_locks.hold(payload['user_id']):
+        _payment_confirmed(payload['user_id'])
+
+def _payment_confirmed(user_id):
+    # Runs once per paid chat (payments.confirm); durable steps first, so a retry only repeats the emits
+    chat_data = get_chat(user_id)
+    sync_chat_to_firebase(user_id)
+
+    # ✅ After payment, show "Expert Joined" ONCE (prevents duplicates on later messages)
+    if shared_state.claim_agent_joined(user_id):
+        shared_state.reset_turns(user_id)
+        # Small delay to match your UI expectation (10 seconds)
+        jobs.enqueue('expert_announce', {'user_id': user_id}, delay=10)
+
+    payload = {'user_id': user_id, 'history': chat_data['history'], 'category': chat_data.get('category')}
+    socketio.emit('new_paid_user', payload, to='agent_room')
+    if chat_data.get('category'):
+        socketio.emit('new_paid_user', payload, to='experts_' + chat_data['category'])
+    socketio.emit('payment_confirmed', {'user_id': user_id}, to=user_id)
+
+def confirm_payment(user_id, event_id=None, event_type=None):
+    """Mark the chat paid once (see payments.confirm); the side effects run as a job."""
+    first = payments.confirm(user_id, event_id, event_type)
+    if first:
+        chat_states.invalidate(user_id)
+    return first
+
+def _chat_archive_job(payload):
+    archive.run()
+    jobs.enqueue('chat_archive', {}, delay=archive.CHAT_ARCHIVE_INTERVAL_SECONDS, key='chat_archive')
+
+jobs.register('firebase_sync', _firebase_sync_job, concurrency=JOB_CONCURRENCY['firebase_sync'])
+jobs.register('crisp_sync', _crisp_sync_job, concurrency=JOB_CONCURRENCY['crisp_sync'], max_attempts=3,
+              while_running='merge')
+# Announcing twice is worse than not at all: no retries
+jobs.register('expert_announce', _expert_announce_job, concurrency=JOB_CONCURRENCY['expert_announce'],
+              max_attempts=1)
+jobs.register('chat_archive', _chat_archive_job, concurrency=JOB_CONCURRENCY['chat_archive'], max_attempts=3)
+jobs.register('payment_confirmed', _payment_confirmed_job, concurrency=JOB_CONCURRENCY['payment_confirmed'],
+              max_attempts=3)
+if archive.CHAT_ARCHIVE_AFTER_DAYS > 0:
+    # One periodic pass per deployment: the key dedupes the workers' enqueues
+    jobs.enqueue('chat_archive', {}, delay=60, key='chat_archive')
+jobs.start()
+
+# -----------------------------
+# METRICS (gauges read at scrape time)
+# -----------------------------
+metrics.gauge('online_experts', "Experts with at least one connected socket", lambda: len(shared_state.online_expert_ids()))
+metrics.gauge('connected_sockets', "Engine.IO sockets connected to this worker", lambda: len(socketio.server.eio.sockets))
+metrics.gauge('db_pool_connections', "SQLite pool connections by state",
+              lambda: {k: v for k, v in db.pool_stats().items() if k != 'size'}, label='state')
+metrics.gauge('llm_calls', "LLM calls by state", lambda: {k: llm.stats()[k] for k in ('in_flight', 'waiting')},
+              label='state')
+metrics.gauge('user_state_entries', "Per-user state records held in memory",
+              lambda: len(getattr(shared_state, 'users', ())))
+metrics.gauge('chat_cache', "Decoded chat cache size and lookups (get_chat)",
+              lambda: {k: v for k, v in chat_states.stats().items() if not k.startswith(('max_', 'hit_rate'))},
+              label='stat')
+metrics.gauge('session_cache_entries', "Live Gemini chat sessions cached", lambda: chat_sessions.stats()['entries'])
+metrics.gauge('user_locks', "Per-user locks by state", lambda: {k: v for k, v in user_locks.stats().items() if k != 'waits'},
+              label='state')
+metrics.gauge('job_pool_running', "Background jobs running on this worker by type",
+              jobs.running, label='type')
 
 # -----------------------------
 # ROUTES
@@ -293,40 +690,91 @@ def sync_chat_to_firebase(user_id, history):
 def index():
     return "Ava Professional Server - Running"
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/experts', methods=['GET'])
+def public_experts():
+    """CDN-cacheable experts directory; answers If-None-Match with 304."""
+    cache = get_public_experts()
+    resp = app.response_class(cache['json'], mimetype='application/json')
+    resp.set_etag(f"experts-{cache['version']}")
+    resp.headers['Cache-Control'] = f"public, max-age={EXPERTS_MAX_AGE}"
+    return resp.make_conditional(request)
+
 # -----------------------------
 # SOCKET EVENTS
 # -----------------------------
-@socketio.on('get_public_experts')
-def handle_public_experts():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT id, name, photo_url, categories FROM experts ORDER BY name")
-    rows = c.fetchall()
-    conn.close()
-    experts_list = [
-        {'id': r[0], 'name': r[1], 'photo_url': r[2] or '', 'categories': json.loads(r[3])}
-        for r in rows
-    ]
-    emit('public_experts_list', experts_list)
-
-@socketio.on('expert_login')
+@timed_event('get_public_experts')
+def handle_public_experts(data=None):
+    cache = get_public_experts()
+    if isinstance(data, dict) and 'version' in data:
+        # Versioned clients: tiny reply when they already have the current list
+        if data['version'] == cache['version']:
+            emit('public_experts', {'version': cache['version'], 'not_modified': True})
+        else:
+            emit('public_experts', {'version': cache['version'], 'experts': cache['experts']})
+        return
+    emit('public_experts_list', cache['experts'])
+
+login_tokens = auth.TokenSigner(os.getenv("EXPERT_TOKEN_SECRET") or app.config['SECRET_KEY'])
+login_limiter = auth.FailureLimiter()
+
+def _expert_from_token(token):
+    """Expert dict for a valid session token, from the cached directory (no login query)."""
+    claims = login_tokens.verify(token)
+    if not claims:
+        return None
+    cache = get_public_experts()
+    if cache['pv'].get(claims['id']) != claims['pv']:
+        return None   # expert deleted or password changed since the token was issued
+    return cache['by_id'][claims['id']]
+
+def _login_failed(keys=(), retry_after=0):
+    if keys:
+        login_limiter.failed(*keys)
+    emit('login_failed', {'retry_after': math.ceil(retry_after)} if retry_after else None)
+
+@timed_event('expert_login')
 def handle_expert_login(data):
+    # Reconnect: a valid token skips the password check, and the chat index unless asked for
+    token = data.get('token')
+    if token:
+        expert = _expert_from_token(token)
+        if not expert:
+            _login_failed()
+            return
+        _start_expert_session(expert, token, with_chats=bool(data.get('reload_chats')))
+        return
+
     expert_id = data.get('expert_id')
     password = data.get('password')
     if not expert_id or not password:
-        emit('login_failed')
+        _login_failed()
         return
 
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT id, name, photo_url, categories FROM experts WHERE id=? AND password=?",
-              (expert_id, password))
-    row = c.fetchone()
-    conn.close()
+    # Only the client address can block an attempt outright. Expert ids aren't secret,
+    # so a per-id block would let anyone lock an expert out; it only shapes the reply.
+    addr_key, expert_key = f"addr:{request.remote_addr}", f"expert:{expert_id}"
+    retry_after = login_limiter.retry_after(addr_key)
+    if retry_after:
+        _login_failed(retry_after=retry_after)
+        return
 
-    if not row:
-        emit('login_failed')
+    row = db.query_one("SELECT id, name, photo_url, categories, password FROM experts WHERE id=?",
+                       (expert_id,), op='expert_login')
+    if not auth.verify_password(password, row[4] if row else None):
+        login_limiter.failed(addr_key, expert_key)
+        _login_failed(retry_after=login_limiter.retry_after(addr_key, expert_key))
         return
+    login_limiter.reset(addr_key, expert_key)
+
+    stored = row[4]
+    if auth.needs_rehash(stored):
+        # EXPERT_PASSWORD_SCRYPT_N changed since this hash was made
+        stored = auth.hash_password(password)
+        write_experts("UPDATE experts SET password=? WHERE id=?", (stored, row[0]))
 
     expert = {
         'id': row[0],
@@ -334,88 +782,167 @@ def handle_expert_login(data):
         'photo_url': row[2] or '',
         'categories': json.loads(row[3])
     }
+    _start_expert_session(expert, login_tokens.issue(row[0], stored), with_chats=True)
 
+def _start_expert_session(expert, token, with_chats):
     sid = request.sid
-    online_experts[sid] = expert
-    online_experts_by_id.setdefault(expert['id'], set()).add(sid)
+    shared_state.add_expert(sid, expert)
     broadcast_online_status()
 
     for cat in expert['categories']:
         join_room('experts_' + cat)
 
-    # Load active chats for categories
-    if expert['categories']:
-        placeholders = ','.join('?' for _ in expert['categories'])
-        query = f"SELECT user_id, history, category FROM chats WHERE paid=1 AND category IN ({placeholders})"
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(query, expert['categories'])
-        rows = c.fetchall()
-        conn.close()
-        active_chats = [{'user_id': r[0], 'history': json.loads(r[1]), 'category': r[2]} for r in rows]
-    else:
-        active_chats = []
+    payload = {'expert': expert, 'token': token}
+    if with_chats:
+        # Lightweight index only; transcripts are fetched with get_chat_history
+        payload['active_chats'], payload['next_cursor'] = load_active_chats(expert['categories'])
+    emit('login_success', payload)
 
-    emit('login_success', {'expert': expert, 'active_chats': active_chats})
+@timed_event('get_active_chats')
+def handle_get_active_chats(data):
+    expert = shared_state.get_expert(request.sid)
+    if not expert:
+        return
+    active_chats, next_cursor = load_active_chats(expert['categories'], (data or {}).get('cursor'))
+    emit('active_chats', {'active_chats': active_chats, 'next_cursor': next_cursor})
 
-@socketio.on('disconnect')
+@timed_event('get_chat_history')
+def handle_get_chat_history(data):
+    """
+    Paged transcript: {user_id, cursor?, limit?} -> chat_history {messages, next_cursor}.
+    A non-integer cursor or limit gets chat_history {user_id, error: 'bad_request'}.
+    """
+    data = data or {}
+    user_id = data.get('user_id')
+    if not user_id:
+        return
+    if 'admin_room' not in rooms():
+        expert = shared_state.get_expert(request.sid)
+        chat_data = get_chat_meta(user_id)
+        if not expert or not chat_data['paid'] or chat_data['category'] not in expert['categories']:
+            emit('chat_history', {'user_id': user_id, 'error': 'forbidden'})
+            return
+    limit = page_arg(data.get('limit'), HISTORY_PAGE, 1, 500)
+    before_seq = page_arg(data.get('cursor'), 0, 0, 2 ** 63 - 1)   # 0: newest page
+    if limit is None or before_seq is None:
+        emit('chat_history', {'user_id': user_id, 'error': 'bad_request'})
+        return
+    messages, next_cursor = load_history_page(user_id, before_seq, limit)
+    emit('chat_history', {'user_id': user_id, 'messages': messages, 'next_cursor': next_cursor})
+
+@timed_event('search_chats')
+def handle_search_chats(data):
+    """
+    {query, category?, paid?, cursor?, limit?} -> search_results {query, results, next_cursor}.
+    Experts only see paid chats in their categories; admins can search everything.
+    Archived chats are not indexed until they're restored (see search). A
+    non-integer cursor or limit, a non-boolean paid or a non-string query or
+    category gets search_results {query, error: 'bad_request'}.
+    """
+    data = data or {}
+    query, category, paid = data.get('query') or '', data.get('category') or None, data.get('paid')
+    if not (isinstance(query, str) and isinstance(category, (str, type(None))) and paid in (None, True, False)):
+        emit('search_results', {'query': query if isinstance(query, str) else '', 'error': 'bad_request'})
+        return
+    query = query.strip()
+    if 'admin_room' in rooms():
+        categories = [category] if category else None
+        paid = None if paid is None else bool(paid)   # 1/0 compare equal to True/False
+    else:
+        expert = shared_state.get_expert(request.sid)
+        if not expert:
+            emit('search_results', {'query': query, 'error': 'forbidden'})
+            return
+        categories = [c for c in expert['categories'] if not category or c == category]
+        paid = True
+    limit = page_arg(data.get('limit'), search.SEARCH_PAGE, 1, 100)
+    offset = page_arg(data.get('cursor'), 0, 0, 10 ** 6)
+    if limit is None or offset is None:
+        emit('search_results', {'query': query, 'error': 'bad_request'})
+        return
+    results, next_cursor = search.search(query, categories, paid, limit, offset)
+    emit('search_results', {'query': query, 'results': results, 'next_cursor': next_cursor})
+
+@timed_event('disconnect')
 def handle_disconnect():
     sid = request.sid
-    expert = online_experts.pop(sid, None)
+    shared_state.unbind_sid(sid)
+    expert = shared_state.remove_sid(sid)
     if expert:
-        expert_id = expert['id']
-        if expert_id in online_experts_by_id:
-            online_experts_by_id[expert_id].discard(sid)
-            if not online_experts_by_id[expert_id]:
-                del online_experts_by_id[expert_id]
-            broadcast_online_status()
-
-@socketio.on('admin_login')
+        broadcast_online_status()
+
+@timed_event('admin_login')
 def handle_admin_login(data):
-    if data.get('password') == ADMIN_PASSWORD:
+    keys = (f"admin:{request.remote_addr}",)
+    retry_after = login_limiter.retry_after(*keys)
+    if retry_after:
+        _login_failed(retry_after=retry_after)
+    elif hmac.compare_digest(str(data.get('password') or ''), ADMIN_PASSWORD):
+        login_limiter.reset(*keys)
+        snapshot = online_presence.snapshot()
         join_room('admin_room')
         emit('login_success')
-        broadcast_online_status()
+        emit('online_experts_update', snapshot)
     else:
-        emit('login_failed')
+        _login_failed(keys)
+
+@timed_event('get_online_experts')
+def handle_get_online_experts():
+    """Full presence snapshot, for an admin client whose delta versions no longer line up."""
+    if 'admin_room' not in rooms():
+        return
+    emit('online_experts_update', online_presence.snapshot())
 
-@socketio.on('get_experts')
+@timed_event('get_experts')
 def handle_get_experts():
     if 'admin_room' not in rooms():
         return
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT id, name, photo_url, categories, password, created_at FROM experts ORDER BY created_at DESC")
-    rows = c.fetchall()
-    conn.close()
+    rows = db.query("SELECT id, name, photo_url, categories, created_at FROM experts ORDER BY created_at DESC")
     experts_list = [
         {
             'id': r[0],
             'name': r[1],
             'photo_url': r[2] or '',
             'categories': json.loads(r[3]),
-            'password': r[4],
-            'created_at': r[5] if len(r) > 5 else None
+            'created_at': r[4]
         } for r in rows
     ]
     emit('experts_list', experts_list)
 
-@socketio.on('create_expert')
+@timed_event('get_llm_stats')
+def handle_get_llm_stats():
+    if 'admin_room' not in rooms():
+        return
+    emit('llm_stats', {**llm.stats(), 'session_cache': chat_sessions.stats(),
+                       'classifier': category_classifier.stats()})
+
+@timed_event('get_state_stats')
+def handle_get_state_stats():
+    if 'admin_room' not in rooms():
+        return
+    emit('state_stats', dict(shared_state.stats(), user_locks=user_locks.stats(), chat_cache=chat_states.stats(),
+                              presence=online_presence.stats()))
+
+@timed_event('get_job_stats')
+def handle_get_job_stats():
+    if 'admin_room' not in rooms():
+        return
+    emit('job_stats', {**jobs.stats(), 'firebase_batcher': firebase_batcher.stats() if firebase_batcher else None,
+                       'archive': archive.stats(), 'payments': payments.stats()})
+
+@timed_event('create_expert')
 def handle_create_expert(data):
     if 'admin_room' not in rooms():
         return
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("INSERT INTO experts (name, photo_url, categories, password) VALUES (?, ?, ?, ?)",
-                  (data['name'], data.get('photo_url', ''), json.dumps(data['categories']), data['password']))
-        conn.commit()
-        conn.close()
+        write_experts("INSERT INTO experts (name, photo_url, categories, password) VALUES (?, ?, ?, ?)",
+                      (data['name'], data.get('photo_url', ''), json.dumps(data['categories']),
+                       auth.hash_password(data['password'])))
         emit('expert_updated', broadcast=True)
     except Exception as e:
         print("Create expert error:", e)
 
-@socketio.on('update_expert')
+@timed_event('update_expert')
 def handle_update_expert(data):
     if 'admin_room' not in rooms():
         return
@@ -424,37 +951,29 @@ def handle_update_expert(data):
         values = [data['name'], data.get('photo_url', ''), json.dumps(data['categories'])]
         if data.get('password'):
             fields.append("password = ?")
-            values.append(data['password'])
+            values.append(auth.hash_password(data['password']))
         values.append(data['id'])
 
         query = f"UPDATE experts SET {', '.join(fields)} WHERE id = ?"
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(query, values)
-        conn.commit()
-        conn.close()
+        write_experts(query, values)
         emit('expert_updated', broadcast=True)
     except Exception as e:
         print("Update expert error:", e)
 
-@socketio.on('delete_expert')
+@timed_event('delete_expert')
 def handle_delete_expert(data):
     if 'admin_room' not in rooms():
         return
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM experts WHERE id = ?", (data['id'],))
-    conn.commit()
-    conn.close()
+    write_experts("DELETE FROM experts WHERE id = ?", (data['id'],))
     emit('expert_updated', broadcast=True)
 
 # ------------------------------------
 # ✅ CRISP SYNC: push Ava transcript into Crisp
 # called by frontend after Crisp iframe loads
 # ------------------------------------
-@socketio.on('crisp_sync')
+@timed_event('crisp_sync')
 def handle_crisp_sync(data):
-    if not crisp_enabled():
+    if not crisp.enabled():
         emit("crisp_sync_result", {"ok": False, "error": "Crisp env vars missing"}, to=request.sid)
         return
 
@@ -471,82 +990,191 @@ def handle_crisp_sync(data):
         emit("crisp_sync_result", {"ok": False, "error": "No transcript"}, to=request.sid)
         return
 
-    def _task():
-        try:
-            # Crisp binds token -> session only after chat loads
-            session_id = None
-            for _ in range(20):  # up to ~10 seconds
-                session_id = crisp_get_session_id_from_token(token_id)
-                if session_id:
-                    break
-                eventlet.sleep(0.5)
-
-            if not session_id:
-                print(f"[CRISP] No session bound yet for token={token_id}")
-                return
-
-            msg = "Ava pre-payment transcript:\n\n" + transcript
-            crisp_send_message(session_id, msg)
-            print(f"[CRISP] Transcript pushed. session_id={session_id}, token={token_id}")
-
-        except Exception as e:
-            print(f"[CRISP] Sync error: {e}")
-
-    eventlet.spawn_n(_task)
+    jobs.enqueue('crisp_sync', {'token_id': token_id, 'message': "Ava pre-payment transcript:\n\n" + transcript},
+                 key=token_id)
     emit("crisp_sync_result", {"ok": True}, to=request.sid)
 
 # ------------------------------------
 # ORIGINAL CHAT FLOW (kept compatible)
 # ------------------------------------
-@socketio.on('register')
+def _intake_turn(msg):
+    if not context_window.is_conversational(msg):
+        return None
+    if msg['sender'] == 'user':
+        return {'role': 'user', 'parts': [msg['text']]}
+    if msg['sender'] == 'bot':
+        return {'role': 'model', 'parts': [msg['text']]}
+    return None
+
+def _expert_turn(msg):
+    if not context_window.is_conversational(msg):
+        return None
+    if msg['sender'] == 'user':
+        return {'role': 'user', 'parts': [msg['text']]}
+    if msg['sender'] in ('bot', 'agent'):
+        return {'role': 'model', 'parts': [msg['text']]}
+    return None
+
+# Live Gemini ChatSessions per user+mode; a turn appends instead of rebuilding history
+chat_sessions = llm.SessionCache()
+
+def summarize_messages(previous_summary, messages):
+    prompt = (
+        "Update the running summary of this support conversation between a customer and Ava/the specialist. "
+        "Keep the problem, key facts, exact error messages, steps already tried and their results, and open questions. "
+        "Plain text, at most 200 words.\n\n"
+        f"Current summary:\n{previous_summary or '(none)'}\n\n"
+        f"New messages:\n{format_transcript(messages)}"
+    )
+    return llm.call(summary_model.generate_content, prompt).text.strip()
+
+intake_context = context_window.ContextWindow('intake', context_window.INTAKE_CONTEXT_TOKENS, summarize_messages)
+expert_context = context_window.ContextWindow('expert', context_window.EXPERT_CONTEXT_TOKENS, summarize_messages)
+
+def _log_prompt_tokens(mode, user_id, estimate, response=None):
+    usage = getattr(response, 'usage_metadata', None)
+    actual = getattr(usage, 'prompt_token_count', None) if usage else None
+    if usage:
+        metrics.LLM_TOKENS.inc(actual or 0, mode=mode, kind='prompt')
+        metrics.LLM_TOKENS.inc(getattr(usage, 'candidates_token_count', 0) or 0, mode=mode, kind='output')
+    else:
+        metrics.LLM_TOKENS.inc(estimate, mode=mode, kind='prompt_estimated')
+    if actual:
+        print(f"[LLM] {mode} {user_id}: prompt_tokens={actual} (est ~{estimate})")
+    else:
+        print(f"[LLM] {mode} {user_id}: prompt_tokens~{estimate}")
+
+def llm_classify(history):
+    """Second-opinion path for the local classifier: ask Gemini for the category."""
+    full_convo = "\n".join([f"{m['sender'].title()}: {m['text']}" for m in history])
+    classify_prompt = (
+        "Determine the SINGLE best expert category for this user's issue.\n"
+        "Respond ONLY with one category from:\n"
+        + ", ".join(classifier.CATEGORIES) + "\n\n"
+        "Conversation:\n" + full_convo
+    )
+    classification = llm.call(model.generate_content, classify_prompt)
+    proposed = classification.text.strip().lower().replace(' ', '-')
+    return proposed if proposed in classifier.CATEGORIES else "other"
+
+category_classifier = classifier.CategoryClassifier(llm_fallback=llm_classify)
+eventlet.spawn_n(category_classifier.train_from_db)
+
+def _keep_session(key, session, persisted, to_turn):
+    try:
+        chat_sessions.commit(key, session, persisted, to_turn)
+    except Exception as e:
+        # e.g. broken stream: drop it, the next turn rebuilds from the DB
+        print(f"Session cache commit failed for {key}: {e}")
+
+def stream_reply(ai_chat, msg_text, user_id, control_tokens, is_agent=False):
+    """
+    Send msg_text with stream=True and emit bot_message_chunk as text arrives.
+    Returns (clean_text, control_token_or_None); the caller emits bot_message_done.
+    """
+    extra = {'is_agent': True} if is_agent else {}
+    filt = llm.ControlTokenFilter(control_tokens)
+    for piece in llm.stream(ai_chat.send_message, msg_text):
+        out = filt.feed(piece)
+        if out:
+            emit('bot_message_chunk', {'data': out, **extra}, to=user_id)
+    clean_text, token, rest = filt.finish()
+    if rest:
+        emit('bot_message_chunk', {'data': rest, **extra}, to=user_id)
+    return clean_text, token
+
+@timed_event('register')
 def handle_register(data):
     user_id = data.get('user_id')
     join_room(user_id)
+    shared_state.bind_sid(request.sid, user_id)
     chat_data = get_chat(user_id)
     if chat_data and chat_data['paid']:
         emit('user_status_change', {'user_id': user_id, 'status': 'online'}, to='agent_room')
         if chat_data.get('category'):
             emit('user_status_change', {'user_id': user_id, 'status': 'online'}, to='experts_' + chat_data['category'])
 
-@socketio.on('user_message')
+def _seconds_range(spec):
+    low, _, high = spec.partition('-')
+    return float(low), float(high or low)
+
+# Human-like minimum time from a user's message to a (non-streamed) reply.
+# The LLM call starts right away; only a reply that comes back sooner is padded.
+# REPLY_PACING=off, or a client sending pacing: false, sends replies as soon as ready.
+REPLY_PACING = os.getenv("REPLY_PACING", "on").lower() not in ("off", "0", "false")
+REPLY_MIN_SECONDS = {
+    'intake': _seconds_range(os.getenv("INTAKE_REPLY_MIN_SECONDS", "1.2-3.8")),
+    'expert': _seconds_range(os.getenv("EXPERT_REPLY_MIN_SECONDS", "0.6-1.4")),
+}
+
+def _reply_deadline(mode, data, stream):
+    """Monotonic time before which the reply shouldn't be sent, or None."""
+    if stream or not REPLY_PACING or data.get('pacing') is False:
+        return None
+    low, high = REPLY_MIN_SECONDS[mode]
+    return time.monotonic() + random.uniform(low, high)
+
+def _pace(mode, deadline):
+    if deadline is None:
+        return
+    delay = deadline - time.monotonic()
+    REPLY_DELAY_SECONDS.observe(max(delay, 0.0), mode=mode)
+    if delay > 0:
+        eventlet.sleep(delay)
+
+@timed_event('user_message')
+@per_user('user_id')
 def handle_user_message(data):
     user_id = data.get('user_id')
     msg_text = data.get('message')
+    # Streaming clients get bot_message_chunk... + bot_message_done instead of one bot_message
+    stream = bool(data.get('stream'))
 
     chat_data = get_chat(user_id)
     chat_data['history'].append({'sender': 'user', 'text': msg_text})
-    save_chat(user_id, chat_data['history'], chat_data['paid'], chat_data.get('category'))
+    append_message(user_id, 'user', msg_text)
     join_room(user_id)
+    shared_state.bind_sid(request.sid, user_id)
 
     if chat_data['paid']:
         # Post-payment: Ava continues as the specialist in THIS same chat.
         emit('bot_typing', to=user_id)
-        eventlet.sleep(random.uniform(0.6, 1.4))
+        deadline = _reply_deadline('expert', data, stream)
 
         # Track turns to decide when to offer appointment
-        expert_turn_counter[user_id] = int(expert_turn_counter.get(user_id, 0)) + 1
+        turn_count = shared_state.incr_turns(user_id)
 
+        session_key = user_id + ':expert'
+        turn_start = len(chat_data['history']) - 1
         try:
-            # Build Gemini history from stored chat
-            gemini_history = []
-            for msg in chat_data['history'][:-1]:
-                if msg['sender'] == 'user':
-                    gemini_history.append({'role': 'user', 'parts': [msg['text']]})
-                elif msg['sender'] in ('bot', 'agent'):
-                    gemini_history.append({'role': 'model', 'parts': [msg['text']]})
-
-            ai_chat = expert_model.start_chat(history=gemini_history)
-            response = ai_chat.send_message(msg_text)
-            ai_text = (response.text or "").strip()
+            session = chat_sessions.checkout(session_key, chat_data['history'][:-1], _expert_turn,
+                                             lambda turns: expert_model.start_chat(history=turns))
+            prompt_tokens = expert_context.fit(session, user_id, chat_data['history'][:-1], _expert_turn, msg_text)
+            ai_chat = session.chat
+            if stream:
+                _log_prompt_tokens('expert', user_id, prompt_tokens)
+                ai_text, token = stream_reply(ai_chat, msg_text, user_id, ("ACTION_APPOINTMENT",), is_agent=True)
+            else:
+                response = llm.call(ai_chat.send_message, msg_text)
+                _log_prompt_tokens('expert', user_id, prompt_tokens, response)
+                ai_text, token = llm.split_control_token(response.text, ("ACTION_APPOINTMENT",))
             # Prevent duplicate join banners from the model
             ai_text = re.sub(r'^(✅\s*Expert Joined|Agent joined ✅).*?(?:\n|$)', '', ai_text, flags=re.IGNORECASE).strip() or ai_text
 
-            if ai_text == "ACTION_APPOINTMENT" or expert_turn_counter[user_id] >= 8:
+            if token == "ACTION_APPOINTMENT" or turn_count >= 8:
+                # Keep any text the model wrote before the token (streamed: the user already saw it)
+                if ai_text:
+                    chat_data['history'].append({'sender': 'bot', 'text': ai_text})
+                    append_message(user_id, 'bot', ai_text)
+                if stream:
+                    emit('bot_message_done', {'data': ai_text, 'is_agent': True}, to=user_id)
+                elif ai_text:
+                    emit('bot_message', {'data': ai_text, 'is_agent': True}, to=user_id)
                 # Show appointment form in chat (HTML is allowed in your frontend bot bubble)
                 form_html = (
                     "<strong>📞 Callback Appointment</strong><br>"
                     "If you'd like, we can call you and finish this with a specialist.<br><br>"
-                    "<form id='ava-appointment-form' style='display:flex;flex-direction:column;gap:10px;'>"
+                    f"{context_window.APPOINTMENT_FORM_MARKER} style='display:flex;flex-direction:column;gap:10px;'>"
                     "<input name='full_name' required placeholder='Full name' "
                     "style='padding:10px;border:1px solid #cbd5e1;border-radius:10px;width:100%;' />"
                     "<input name='phone' required placeholder='Phone number (with country code)' "
@@ -567,76 +1195,68 @@ def handle_user_message(data):
                     "</div>"
                 )
                 chat_data['history'].append({'sender': 'bot', 'text': form_html})
-                save_chat(user_id, chat_data['history'], True, chat_data.get('category'))
+                append_message(user_id, 'bot', form_html)
+                _pace('expert', deadline)
                 emit('bot_message', {'data': form_html, 'is_agent': True}, to=user_id)
+                _keep_session(session_key, session, chat_data['history'][turn_start:], _expert_turn)
                 return
 
             # Normal expert reply
             chat_data['history'].append({'sender': 'bot', 'text': ai_text})
-            save_chat(user_id, chat_data['history'], True, chat_data.get('category'))
-            emit('bot_message', {'data': ai_text, 'is_agent': True}, to=user_id)
+            append_message(user_id, 'bot', ai_text)
+            _pace('expert', deadline)
+            emit('bot_message_done' if stream else 'bot_message', {'data': ai_text, 'is_agent': True}, to=user_id)
+            _keep_session(session_key, session, chat_data['history'][turn_start:], _expert_turn)
             return
 
         except Exception as e:
             print(f"Expert AI Error: {e}")
             fallback = "I’m here with you — tell me the exact error text you see on the screen, and we’ll fix it step-by-step."
             chat_data['history'].append({'sender': 'bot', 'text': fallback})
-            save_chat(user_id, chat_data['history'], True, chat_data.get('category'))
-            emit('bot_message', {'data': fallback, 'is_agent': True}, to=user_id)
+            append_message(user_id, 'bot', fallback)
+            _pace('expert', deadline)
+            emit('bot_message_done' if stream else 'bot_message', {'data': fallback, 'is_agent': True}, to=user_id)
             return
 
     emit('bot_typing', to=user_id)
-    eventlet.sleep(random.uniform(1.2, 3.8))
+    deadline = _reply_deadline('intake', data, stream)
 
+    session_key = user_id + ':intake'
+    turn_start = len(chat_data['history']) - 1
     try:
-        gemini_history = []
-        for msg in chat_data['history'][:-1]:
-            if msg['sender'] == 'user':
-                gemini_history.append({'role': 'user', 'parts': [msg['text']]})
-            elif msg['sender'] == 'bot':
-                gemini_history.append({'role': 'model', 'parts': [msg['text']]})
-
-        ai_chat = model.start_chat(history=gemini_history)
-        response = ai_chat.send_message(msg_text)
-        ai_text = response.text.strip()
-
-        trigger = False
-        if ai_text.endswith("ACTION_TRIGGER_PAYMENT"):
-            trigger = True
-            clean_text = ai_text[:-len("ACTION_TRIGGER_PAYMENT")].strip()
+        session = chat_sessions.checkout(session_key, chat_data['history'][:-1], _intake_turn,
+                                         lambda turns: model.start_chat(history=turns))
+        prompt_tokens = intake_context.fit(session, user_id, chat_data['history'][:-1], _intake_turn, msg_text)
+        ai_chat = session.chat
+        if stream:
+            _log_prompt_tokens('intake', user_id, prompt_tokens)
+            clean_text, token = stream_reply(ai_chat, msg_text, user_id, ("ACTION_TRIGGER_PAYMENT",))
+        else:
+            response = llm.call(ai_chat.send_message, msg_text)
+            _log_prompt_tokens('intake', user_id, prompt_tokens, response)
+            clean_text, token = llm.split_control_token(response.text, ("ACTION_TRIGGER_PAYMENT",))
 
+        trigger = token == "ACTION_TRIGGER_PAYMENT"
+        if trigger:
             # classify category once
             if not chat_data.get('category'):
                 try:
-                    full_convo = "\n".join([f"{m['sender'].title()}: {m['text']}" for m in chat_data['history']])
-                    classify_prompt = (
-                        "Determine the SINGLE best expert category for this user's issue.\n"
-                        "Respond ONLY with one category from:\n"
-                        "medical, legal, automotive, veterinary, plumbing, electrical, tech, tax, relationships, "
-                        "appliance-repair, hvac, construction, business, real-estate, finance, psychology, education, "
-                        "fitness, nutrition, other\n\n"
-                        "Conversation:\n" + full_convo
-                    )
-                    classification = model.generate_content(classify_prompt)
-                    proposed = classification.text.strip().lower().replace(' ', '-')
-
-                    valid = {
-                        "medical","legal","automotive","veterinary","plumbing","electrical","tech","tax",
-                        "relationships","appliance-repair","hvac","construction","business","real-estate",
-                        "finance","psychology","education","fitness","nutrition","other"
-                    }
-                    chat_data['category'] = proposed if proposed in valid else "other"
-                    print(f"Classified category for {user_id}: {chat_data['category']}")
+                    start = time.monotonic()
+                    category, confidence, source = category_classifier.classify(chat_data['history'])
+                    CLASSIFY_SECONDS.observe(time.monotonic() - start, source=source)
+                    chat_data['category'] = category
+                    print(f"Classified category for {user_id}: {category} ({source}, confidence {confidence:.2f})")
                 except Exception as e:
                     print("Classification failed:", e)
                     chat_data['category'] = "other"
 
-        else:
-            clean_text = ai_text
-
         chat_data['history'].append({'sender': 'bot', 'text': clean_text})
-        save_chat(user_id, chat_data['history'], chat_data['paid'], chat_data.get('category'))
-        emit('bot_message', {'data': clean_text}, to=user_id)
+        append_message(user_id, 'bot', clean_text)
+        if trigger:
+            save_category(user_id, chat_data.get('category'))
+        _pace('intake', deadline)
+        emit('bot_message_done' if stream else 'bot_message', {'data': clean_text}, to=user_id)
+        _keep_session(session_key, session, chat_data['history'][turn_start:], _intake_turn)
 
         if trigger:
             emit('payment_trigger', to=user_id)
@@ -645,81 +1265,67 @@ def handle_user_message(data):
         print(f"AI Error: {e}")
         fallback = "Please allow me a moment to process your message."
         chat_data['history'].append({'sender': 'bot', 'text': fallback})
-        save_chat(user_id, chat_data['history'], chat_data['paid'], chat_data.get('category'))
-        emit('bot_message', {'data': fallback}, to=user_id)
+        append_message(user_id, 'bot', fallback)
+        _pace('intake', deadline)
+        emit('bot_message_done' if stream else 'bot_message', {'data': fallback}, to=user_id)
 
-@socketio.on('agent_message')
+@timed_event('agent_message')
+@per_user('to_user')
 def handle_agent_reply(data):
     target_user = data.get('to_user')
     text = data.get('message')
     chat_data = get_chat(target_user)
     chat_data['history'].append({'sender': 'agent', 'text': text})
-    save_chat(target_user, chat_data['history'], chat_data['paid'], chat_data.get('category'))
+    append_message(target_user, 'agent', text)
     emit('bot_message', {'data': text, 'is_agent': True}, to=target_user)
 
-@socketio.on('agent_typing')
+@timed_event('agent_typing')
 def handle_agent_typing(data):
     target_user = data.get('to_user')
     emit('bot_typing', to=target_user)
 
-@socketio.on('agent_joined_chat')
+@timed_event('agent_joined_chat')
 def handle_agent_notify(data):
     target_user = data.get('to_user')
     if not target_user:
         return
     # Avoid duplicate "joined" banners
-    if agent_joined_state.get(target_user):
+    if not shared_state.claim_agent_joined(target_user):
         return
 
-    agent_joined_state[target_user] = True
-    expert_turn_counter[target_user] = 0
+    shared_state.reset_turns(target_user)
 
-    expert = online_experts.get(request.sid)
+    expert = shared_state.get_expert(request.sid)
     if expert:
         emit('agent_connected', {'name': expert['name'], 'photo': expert['photo_url']}, to=target_user)
     else:
         emit('agent_connected', {'name': 'Expert Agent', 'photo': ''}, to=target_user)
 
-@socketio.on('mark_paid')
+@timed_event('mark_paid')
+@per_user('user_id')
 def handle_payment_confirm(data):
+    """
+    Sent by the client after the Checkout redirect. Repeats are no-ops. With
+    STRIPE_WEBHOOK_SECRET set the webhook is authoritative, and this only
+    confirms early if Stripe already reports the user's session as paid.
+    """
     user_id = data.get('user_id')
     join_room(user_id)
-    chat_data = get_chat(user_id)
-    chat_data['paid'] = True
-    save_chat(user_id, chat_data['history'], True, chat_data.get('category'))
-
-    payload = {'user_id': user_id, 'history': chat_data['history'], 'category': chat_data.get('category')}
-    emit('new_paid_user', payload, to='agent_room')
-    if chat_data.get('category'):
-        emit('new_paid_user', payload, to='experts_' + chat_data['category'])
-
-    sync_chat_to_firebase(user_id, chat_data['history'])
-
-    # ✅ After payment, show "Expert Joined" ONCE (prevents duplicates on later messages)
-    if not agent_joined_state.get(user_id):
-        agent_joined_state[user_id] = True
-        expert_turn_counter[user_id] = 0
-
-        def _announce():
-            try:
-                # Small delay to match your UI expectation (10 seconds)
-                eventlet.sleep(10)
-
-                # Let frontend show "Expert Joined"
-                emit('agent_connected', {'name': 'Ava (Certified Specialist)', 'photo': ''}, to=user_id)
-
-                # First expert message
-                intro = "✅ Expert Joined<br>A certified specialist is now connected. Tell me the exact error message you see and what happened right before it started."
-                chat_data2 = get_chat(user_id)
-                chat_data2['history'].append({'sender': 'bot', 'text': intro})
-                save_chat(user_id, chat_data2['history'], True, chat_data2.get('category'))
-                emit('bot_message', {'data': intro, 'is_agent': True}, to=user_id)
-            except Exception as e:
-                print("Post-payment announce error:", e)
-
-        eventlet.spawn_n(_announce)
+    if get_chat(user_id)['paid']:
+        emit('payment_confirmed', {'user_id': user_id})
+        return
+    if payments.STRIPE_WEBHOOK_SECRET:
+        try:
+            paid = payments.session_paid(user_id)
+        except Exception as e:
+            print("Stripe session lookup error:", e)
+            paid = False   # the webhook will confirm it
+        if not paid:
+            return
+    confirm_payment(user_id)
 
-@socketio.on('appointment_request')
+@timed_event('appointment_request')
+@per_user('user_id')
 def handle_appointment_request(data):
     """Save appointment request and notify admin/agents."""
     try:
@@ -728,9 +1334,9 @@ def handle_appointment_request(data):
         if not user_id:
             return
         chat_data = get_chat(user_id)
-        note = "Appointment requested: " + json.dumps(details, ensure_ascii=False)
+        note = context_window.APPOINTMENT_NOTE_PREFIX + json.dumps(details, ensure_ascii=False)
         chat_data['history'].append({'sender': 'bot', 'text': note})
-        save_chat(user_id, chat_data['history'], True, chat_data.get('category'))
+        append_message(user_id, 'bot', note)
 
         emit('bot_message', {'data': "✅ Got it — we received your callback request. We’ll reach out at the time you provided.", 'is_agent': True}, to=user_id)
 
@@ -749,23 +1355,27 @@ def create_checkout_session():
     try:
         data = request.json or {}
         uid = data.get('userId')
-
-        session = stripe.checkout.Session.create(
-            line_items=[{
-                'price_data': {
-                    'currency': 'usd',
-                    'product_data': {'name': 'Expert Connection Fee', 'description': 'Fully refundable'},
-                    'unit_amount': 500,
-                },
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url=f"{PUBLIC_SITE_URL}/?payment_success=true&uid={uid}",
-            cancel_url=f"{PUBLIC_SITE_URL}/?payment_canceled=true",
-        )
-        return jsonify(url=session.url)
+        if not uid:
+            return jsonify(error="userId is required"), 400
+
+        # Double clicks wait here and get the session the first click created
+        with user_locks.hold(uid):
+            url = payments.checkout_url(uid, success_url=f"{PUBLIC_SITE_URL}/?payment_success=true&uid={uid}",
+                                        cancel_url=f"{PUBLIC_SITE_URL}/?payment_canceled=true")
+        return jsonify(url=url)
     except Exception as e:
         return jsonify(error=str(e)), 500
 
+@app.route('/stripe-webhook', methods=['POST'])
+def stripe_webhook():
+    try:
+        event = payments.parse_event(request.get_data(), request.headers.get('Stripe-Signature'))
+    except (ValueError, stripe.SignatureVerificationError) as e:
+        return jsonify(error=str(e)), 400
+    # No user lock: turns never write chats.paid (save_category), so the ack doesn't wait behind a Gemini call
+    payments.handle_event(event, on_paid=confirm_payment)
+    # Any 2xx stops Stripe's retries; replays and other event types are acknowledged too
+    return jsonify(received=True)
+
 if __name__ == '__main__':
     socketio.run(app, debug=True, port=int(os.getenv("PORT", 5000)))
@@ -0,0 +1,392 @@
+"""
+Shared presence / per-user state.
+
+MemoryState keeps everything in this process (single worker, the old
+behaviour). Per-user records (the "Expert Joined" flag and post-payment turn
+count) are a bounded cache over the user_state table: written through on
+every change, dropped after USER_STATE_IDLE_SECONDS without a connected
+socket or when over USER_STATE_MAX_ENTRIES, and reloaded on next use, so
+eviction or a restart never changes behaviour.
+
+RedisState keeps it in Redis so several gunicorn/eventlet workers or nodes
+agree on who is online and never double-announce "Expert Joined"; per-user
+keys expire after USER_STATE_TTL_SECONDS. Each worker lists the expert
+sockets it holds under its own id and refreshes a heartbeat key; heartbeat()
+also reaps the sockets of workers whose heartbeat expired (a crash or a
+redeploy), so their experts don't stay online. RedisState only uses plain
+commands (no Lua), so a fake client such as fakeredis.FakeRedis() can be
+passed in for local testing.
+
+make_state() picks the backend from REDIS_URL.
+
+KeyedLock serializes work per key (user_id) inside this process: one user's
+events run one at a time, in arrival order, while other users run
+concurrently.
+"""
+import json
+import os
+import secrets
+import socket
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from eventlet.semaphore import Semaphore
+
+import db
+
+REDIS_URL = os.getenv("REDIS_URL")
+KEY_PREFIX = os.getenv("STATE_KEY_PREFIX", "ava:")
+USER_STATE_TTL_SECONDS = int(os.getenv("USER_STATE_TTL_SECONDS", str(30 * 24 * 3600)))
+USER_STATE_MAX_ENTRIES = int(os.getenv("USER_STATE_MAX_ENTRIES", "10000"))
+USER_STATE_IDLE_SECONDS = float(os.getenv("USER_STATE_IDLE_SECONDS", "900"))
+PRESENCE_WORKER_TTL_SECONDS = int(os.getenv("PRESENCE_WORKER_TTL_SECONDS", "30"))
+PRESENCE_HEARTBEAT_SECONDS = PRESENCE_WORKER_TTL_SECONDS / 3
+
+
+class _UserState:
+    __slots__ = ('joined', 'turns', 'sockets', 'last_seen')
+
+    def __init__(self, joined, turns):
+        self.joined = joined      # "Expert Joined" already announced
+        self.turns = turns        # post-payment turns
+        self.sockets = 0          # connected sockets bound to this user
+        self.last_seen = time.monotonic()
+
+
+class MemoryState:
+    def __init__(self, persist=True, max_entries=USER_STATE_MAX_ENTRIES, idle_seconds=USER_STATE_IDLE_SECONDS):
+        self.online_experts = {}          # sid -> expert dict
+        self.online_experts_by_id = {}    # expert_id -> set(sids)
+        self.users = OrderedDict()        # user_id -> _UserState, least recently used first
+        self.sid_users = {}               # sid -> user_id
+        self.persist = persist
+        self.max_entries = max_entries
+        self.idle_seconds = idle_seconds
+        self.evicted = 0
+        self.presence_version = 0         # bumped by each published presence delta
+        self._published = set()           # online expert ids as of presence_version
+
+    # ---- expert presence ----
+    def add_expert(self, sid, expert):
+        self.online_experts[sid] = expert
+        self.online_experts_by_id.setdefault(expert['id'], set()).add(sid)
+
+    def remove_sid(self, sid):
+        """Drop a socket; returns the expert it belonged to (or None)."""
+        expert = self.online_experts.pop(sid, None)
+        if expert:
+            sids = self.online_experts_by_id.get(expert['id'])
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self.online_experts_by_id[expert['id']]
+        return expert
+
+    def get_expert(self, sid):
+        return self.online_experts.get(sid)
+
+    def online_expert_ids(self):
+        return list(self.online_experts_by_id.keys())
+
+    def publish_presence(self):
+        """(version, joined, left) since the last publish, or None if nothing changed."""
+        current = set(self.online_experts_by_id)
+        if current == self._published:
+            return None
+        joined, left = current - self._published, self._published - current
+        self._published = current
+        self.presence_version += 1
+        return self.presence_version, joined, left
+
+    def presence_snapshot(self):
+        """(version, ids): the published set that deltas after `version` apply to."""
+        return self.presence_version, sorted(self._published)
+
+    # ---- per-user chat state ----
+    def _user(self, user_id):
+        rec = self.users.get(user_id)
+        if rec is None:
+            row = None
+            if self.persist:
+                row = db.query_one("SELECT agent_joined, turns FROM user_state WHERE user_id=?", (user_id,),
+                                   op='user_state_load')
+            rec = self.users[user_id] = _UserState(bool(row and row[0]), row[1] if row else 0)
+            self._evict()
+        else:
+            self.users.move_to_end(user_id)
+            rec.last_seen = time.monotonic()
+        return rec
+
+    def _evict(self):
+        """Drop least recently used records that are idle, or any unconnected ones while over the cap."""
+        now = time.monotonic()
+        for _ in range(len(self.users)):
+            user_id, rec = next(iter(self.users.items()))
+            over = len(self.users) > self.max_entries
+            if not over and now - rec.last_seen <= self.idle_seconds:
+                break
+            if rec.sockets:
+                self.users.move_to_end(user_id)   # still connected: keep
+                continue
+            del self.users[user_id]
+            self.evicted += 1
+
+    def bind_sid(self, sid, user_id):
+        """Tie a customer socket to user_id so its record is kept while connected."""
+        if self.sid_users.get(sid) == user_id:
+            return
+        self.unbind_sid(sid)
+        self.sid_users[sid] = user_id
+        self._user(user_id).sockets += 1
+
+    def unbind_sid(self, sid):
+        user_id = self.sid_users.pop(sid, None)
+        rec = self.users.get(user_id) if user_id is not None else None
+        if rec is not None:
+            rec.sockets = max(0, rec.sockets - 1)
+            rec.last_seen = time.monotonic()
+        self._evict()
+
+    def _save(self, user_id, rec):
+        if self.persist:
+            db.execute("INSERT INTO user_state (user_id, agent_joined, turns, updated_at) "
+                       "VALUES (?, ?, ?, CURRENT_TIMESTAMP) ON CONFLICT(user_id) DO UPDATE SET "
+                       "agent_joined=excluded.agent_joined, turns=excluded.turns, updated_at=excluded.updated_at",
+                       (user_id, int(rec.joined), rec.turns), op='user_state_save')
+
+    def claim_agent_joined(self, user_id):
+        """True the first time for user_id, False afterwards."""
+        rec = self._user(user_id)
+        if rec.joined:
+            return False
+        rec.joined = True
+        if not self.persist:
+            return True
+        # Conditional upsert: exactly one caller flips the stored flag
+        return db.execute("INSERT INTO user_state (user_id, agent_joined, turns, updated_at) "
+                          "VALUES (?, 1, ?, CURRENT_TIMESTAMP) ON CONFLICT(user_id) DO UPDATE SET "
+                          "agent_joined=1, updated_at=excluded.updated_at WHERE user_state.agent_joined=0",
+                          (user_id, rec.turns), op='user_state_claim') > 0
+
+    def incr_turns(self, user_id):
+        rec = self._user(user_id)
+        rec.turns += 1
+        self._save(user_id, rec)
+        return rec.turns
+
+    def reset_turns(self, user_id):
+        rec = self._user(user_id)
+        rec.turns = 0
+        self._save(user_id, rec)
+
+    def heartbeat(self):
+        """Nothing outlives this process here; see RedisState.heartbeat."""
+        return []
+
+    def stats(self):
+        approx = (sys.getsizeof(self.users) + sys.getsizeof(self.sid_users)
+                  + sum(sys.getsizeof(k) + sys.getsizeof(r) for k, r in self.users.items())
+                  + sum(sys.getsizeof(k) for k in self.sid_users))
+        return {
+            'backend': 'memory',
+            'users': len(self.users),
+            'connected_users': sum(1 for r in self.users.values() if r.sockets),
+            'user_sockets': len(self.sid_users),
+            'expert_sockets': len(self.online_experts),
+            'online_experts': len(self.online_experts_by_id),
+            'evicted': self.evicted,
+            'max_entries': self.max_entries,
+            'idle_seconds': self.idle_seconds,
+            'approx_bytes': approx,
+        }
+
+
+class RedisState:
+    def __init__(self, client, prefix=KEY_PREFIX, worker_ttl=PRESENCE_WORKER_TTL_SECONDS):
+        self.r = client
+        self.p = prefix
+        # Fresh per process, so a restarted worker never adopts its predecessor's sockets
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self.worker_ttl = worker_ttl
+        self.reaped = 0
+
+    def _k(self, *parts):
+        return self.p + ":".join(str(x) for x in parts)
+
+    # ---- expert presence ----
+    def add_expert(self, sid, expert):
+        pipe = self.r.pipeline()
+        pipe.hset(self._k("experts", "by_sid"), sid, json.dumps(expert))
+        pipe.sadd(self._k("experts", "sids", expert['id']), sid)
+        pipe.sadd(self._k("experts", "online"), expert['id'])
+        pipe.sadd(self._k("workers"), self.worker_id)
+        pipe.sadd(self._k("worker", self.worker_id, "sids"), sid)
+        pipe.set(self._k("worker", self.worker_id, "alive"), 1, ex=self.worker_ttl)
+        pipe.execute()
+
+    def remove_sid(self, sid):
+        raw = self.r.hget(self._k("experts", "by_sid"), sid)
+        if raw is None:
+            return None
+        expert = json.loads(raw)
+        sids_key = self._k("experts", "sids", expert['id'])
+        online_key = self._k("experts", "online")
+        pipe = self.r.pipeline()
+        pipe.hdel(self._k("experts", "by_sid"), sid)
+        pipe.srem(self._k("worker", self.worker_id, "sids"), sid)
+        pipe.srem(sids_key, sid)
+        pipe.scard(sids_key)
+        remaining = pipe.execute()[-1]
+        if not remaining:
+            self.r.srem(online_key, expert['id'])
+            # another worker may have logged the same expert in meanwhile
+            if self.r.scard(sids_key):
+                self.r.sadd(online_key, expert['id'])
+        return expert
+
+    def get_expert(self, sid):
+        raw = self.r.hget(self._k("experts", "by_sid"), sid)
+        return json.loads(raw) if raw is not None else None
+
+    def online_expert_ids(self):
+        return [int(x) for x in self.r.smembers(self._k("experts", "online"))]
+
+    def publish_presence(self):
+        """
+        Same as MemoryState.publish_presence, shared by all workers: WATCH makes
+        exactly one of several workers flushing the same change publish it.
+        """
+        from redis.exceptions import WatchError   # fakeredis raises the same class
+
+        online_key, pub_key, ver_key = (self._k("experts", "online"), self._k("presence", "published"),
+                                        self._k("presence", "version"))
+        with self.r.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(pub_key, ver_key)
+                    current = {int(x) for x in pipe.smembers(online_key)}
+                    published = {int(x) for x in pipe.smembers(pub_key)}
+                    if current == published:
+                        pipe.unwatch()
+                        return None
+                    version = int(pipe.get(ver_key) or 0) + 1
+                    pipe.multi()
+                    pipe.delete(pub_key)
+                    if current:
+                        pipe.sadd(pub_key, *current)
+                    pipe.set(ver_key, version)
+                    pipe.execute()
+                    return version, current - published, published - current
+                except WatchError:
+                    continue
+
+    def heartbeat(self):
+        """
+        Refresh this worker's liveness and reap workers whose key expired.
+        Returns the experts whose sockets were reaped; call every
+        PRESENCE_HEARTBEAT_SECONDS.
+        """
+        workers_key = self._k("workers")
+        pipe = self.r.pipeline()
+        pipe.set(self._k("worker", self.worker_id, "alive"), 1, ex=self.worker_ttl)
+        pipe.sadd(workers_key, self.worker_id)
+        pipe.smembers(workers_key)
+        workers = pipe.execute()[-1]
+        removed = []
+        for worker_id in workers:
+            if worker_id == self.worker_id or self.r.exists(self._k("worker", worker_id, "alive")):
+                continue
+            sids_key = self._k("worker", worker_id, "sids")
+            sids = self.r.smembers(sids_key)
+            for sid in sids:
+                expert = self.remove_sid(sid)   # idempotent if another worker reaps it too
+                if expert:
+                    removed.append(expert)
+            self.r.delete(sids_key)
+            self.r.srem(workers_key, worker_id)
+            print(f"[STATE] reaped worker {worker_id}: {len(sids)} expert sockets")
+        self.reaped += len(removed)
+        return removed
+
+    def presence_snapshot(self):
+        pipe = self.r.pipeline()   # MULTI: version and set read together
+        pipe.get(self._k("presence", "version"))
+        pipe.smembers(self._k("presence", "published"))
+        version, ids = pipe.execute()
+        return int(version or 0), sorted(int(x) for x in ids)
+
+    # ---- per-user chat state ----
+    def claim_agent_joined(self, user_id):
+        return bool(self.r.set(self._k("joined", user_id), 1, nx=True, ex=USER_STATE_TTL_SECONDS))
+
+    def incr_turns(self, user_id):
+        key = self._k("turns", user_id)
+        pipe = self.r.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, USER_STATE_TTL_SECONDS)
+        return int(pipe.execute()[0])
+
+    def reset_turns(self, user_id):
+        self.r.set(self._k("turns", user_id), 0, ex=USER_STATE_TTL_SECONDS)
+
+    # Per-user keys carry their own TTL; nothing is held per socket here
+    def bind_sid(self, sid, user_id):
+        pass
+
+    def unbind_sid(self, sid):
+        pass
+
+    def stats(self):
+        return {
+            'backend': 'redis',
+            'expert_sockets': self.r.hlen(self._k("experts", "by_sid")),
+            'online_experts': self.r.scard(self._k("experts", "online")),
+            'workers': self.r.scard(self._k("workers")),
+            'reaped_sockets': self.reaped,
+            'redis_used_memory': self._used_memory(),
+        }
+
+    def _used_memory(self):
+        try:
+            return self.r.info('memory').get('used_memory')
+        except Exception:   # INFO is disabled on some managed Redis, and fakeredis lacks it
+            return None
+
+
+class KeyedLock:
+    """
+    One FIFO lock per key, created on first use and dropped once nobody holds
+    or waits for it, so idle users cost nothing. Not reentrant.
+    """
+
+    def __init__(self):
+        self._locks = {}      # key -> [Semaphore, holders + waiters]
+        self.waits = 0        # acquisitions that had to queue
+
+    @contextmanager
+    def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [Semaphore(1), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self.waits += 1
+            with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def stats(self):
+        return {'keys': len(self._locks), 'queued': sum(n - 1 for _, n in self._locks.values()), 'waits': self.waits}
+
+
+def make_state(url=REDIS_URL):
+    if not url:
+        return MemoryState()
+    import redis  # optional: only needed for multi-worker deployments
+    return RedisState(redis.Redis.from_url(url, decode_responses=True))